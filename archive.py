@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from db import BatchWriter, SQLiteDB
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS spots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    submission_id TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    user_id INTEGER,
+    waterbody_name TEXT NOT NULL,
+    waterbody_hashtag TEXT NOT NULL,
+    coordinates TEXT NOT NULL,
+    tackle TEXT NOT NULL,
+    clip TEXT,
+    depth TEXT,
+    temperature TEXT,
+    comment TEXT,
+    game_nickname TEXT NOT NULL,
+    nickname_key TEXT NOT NULL,
+    photos TEXT NOT NULL,
+    coord_x INTEGER,
+    coord_y INTEGER
+);
+CREATE INDEX IF NOT EXISTS spots_waterbody ON spots (waterbody_hashtag, id);
+CREATE INDEX IF NOT EXISTS spots_waterbody_tackle ON spots (waterbody_hashtag, tackle, id);
+CREATE INDEX IF NOT EXISTS spots_tackle ON spots (tackle, id);
+CREATE INDEX IF NOT EXISTS spots_nickname ON spots (nickname_key, id);
+CREATE INDEX IF NOT EXISTS spots_created_at ON spots (created_at);
+CREATE TABLE IF NOT EXISTS photo_hashes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    submission_id TEXT NOT NULL,
+    file_unique_id TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    user_id INTEGER,
+    created_at REAL NOT NULL,
+    UNIQUE (submission_id, file_unique_id)
+);
+"""
+
+_COLUMNS = (
+    "submission_id", "created_at", "user_id", "waterbody_name", "waterbody_hashtag", "coordinates", "tackle",
+    "clip", "depth", "temperature", "comment", "game_nickname", "nickname_key", "photos", "coord_x", "coord_y",
+)
+_INSERT = f"INSERT OR IGNORE INTO spots ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})"
+_SELECT = "SELECT id, created_at, waterbody_name, waterbody_hashtag, coordinates, tackle, clip, depth, temperature, comment, game_nickname FROM spots"
+
+
+@dataclass
+class Spot:
+    id: int
+    created_at: float
+    waterbody_name: str
+    waterbody_hashtag: str
+    coordinates: str
+    tackle: str
+    clip: Optional[str]
+    depth: Optional[str]
+    temperature: Optional[str]
+    comment: Optional[str]
+    game_nickname: str
+
+
+def nickname_key(nickname: str) -> str:
+    return nickname.strip().casefold()
+
+
+@dataclass
+class SpotQuery:
+    """Фильтр архива; каждое сочетание полей покрыто своим индексом."""
+    waterbody_hashtag: Optional[str] = None
+    tackle: Optional[str] = None
+    nickname: Optional[str] = None
+
+    def where(self) -> Tuple[str, tuple]:
+        clauses, params = [], []
+        if self.waterbody_hashtag:
+            clauses.append("waterbody_hashtag = ?")
+            params.append(self.waterbody_hashtag)
+        if self.tackle:
+            clauses.append("tackle = ?")
+            params.append(self.tackle)
+        if self.nickname:
+            clauses.append("nickname_key = ?")
+            params.append(nickname_key(self.nickname))
+        return " AND ".join(clauses) or "1", tuple(params)
+
+
+class Archive:
+    """Архив отправленных точек с индексами по водоёму, снасти, нику и времени.
+
+    Вставки копятся в буфере и пишутся пачкой (раз в `flush_interval` секунд
+    или по `batch_size` записей), чтобы не тормозить отправку поста.
+    """
+
+    def __init__(self, db: SQLiteDB, flush_interval: float = 0.5, batch_size: int = 200):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer: List[tuple] = []
+        self._writer = BatchWriter(self.flush, "Archive", flush_interval, batch_size)
+        self._flush_lock = asyncio.Lock()
+        # Вызывается после каждой записи пачки (например, чтобы дообновить пространственный индекс)
+        self.on_flush: Optional[Callable[[], Awaitable[None]]] = None
+
+    async def setup(self):
+        for column in ("coord_x", "coord_y"):
+            try:
+                await self.db.execute(f"ALTER TABLE spots ADD COLUMN {column} INTEGER")
+            except sqlite3.OperationalError:
+                pass  # колонка уже есть или таблицы ещё нет
+        await self.db.executescript(_SCHEMA)
+
+    @staticmethod
+    def _row(submission_id: str, created_at: float, user_id: Optional[int], spot: Dict[str, Any]) -> tuple:
+        return (
+            submission_id, created_at, user_id, spot["waterbody_name"], spot["waterbody_hashtag"], spot["coordinates"],
+            spot["tackle"], spot.get("clip"), spot.get("depth"), spot.get("temperature"), spot.get("comment"),
+            spot["game_nickname"], nickname_key(spot["game_nickname"]), json.dumps(spot.get("photos", [])),
+            spot.get("coord_x"), spot.get("coord_y"),
+        )
+
+    def add(self, submission_id: str, user_id: Optional[int], spot: Dict[str, Any], created_at: Optional[float] = None):
+        """Ставит точку в очередь на запись; повтор submission_id игнорируется."""
+        self._buffer.append(self._row(submission_id, created_at or time.time(), user_id, spot))
+        self._writer.touch(len(self._buffer))
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            try:
+                await self.db.transaction([(_INSERT, rows)])
+            except Exception:
+                self._buffer[:0] = rows
+                raise
+        await self._notify()
+        return len(rows)
+
+    async def _notify(self):
+        if self.on_flush is not None:
+            try:
+                await self.on_flush()
+            except Exception as e:
+                logging.error(f"Archive on_flush hook failed: {e}")
+
+    async def add_many(self, items: List[tuple]) -> int:
+        """Пишет сразу пачку (submission_id, created_at, user_id, spot)."""
+        rows = [self._row(sid, created_at, user_id, spot) for sid, created_at, user_id, spot in items]
+        await self.db.transaction([(_INSERT, rows)])
+        await self._notify()
+        return len(rows)
+
+    async def unarchived(self) -> List[Tuple[str, float, Dict[str, Any]]]:
+        """Заявки из outbox (таблица submissions в той же базе), которых нет в архиве: (id, время, payload)."""
+        rows = await self.db.fetchall(
+            "SELECT s.id, s.created_at, s.payload FROM submissions s LEFT JOIN spots ON spots.submission_id = s.id "
+            "WHERE spots.id IS NULL ORDER BY s.created_at"
+        )
+        return [(sid, created_at, json.loads(payload)) for sid, created_at, payload in rows]
+
+    async def find(self, query: SpotQuery, limit: int = 5, before: Optional[int] = None, after: Optional[int] = None) -> List[Spot]:
+        """Последние точки по фильтру, новые первыми. Страницы — по id (keyset), без OFFSET."""
+        where, params = query.where()
+        if after is not None:
+            rows = await self.db.fetchall(f"{_SELECT} WHERE {where} AND id > ? ORDER BY id ASC LIMIT ?", params + (after, limit))
+            rows.reverse()
+        else:
+            cursor = before if before is not None else 2 ** 62
+            rows = await self.db.fetchall(f"{_SELECT} WHERE {where} AND id < ? ORDER BY id DESC LIMIT ?", params + (cursor, limit))
+        return [Spot(*row) for row in rows]
+
+    async def exists(self, query: SpotQuery, before: Optional[int] = None, after: Optional[int] = None) -> bool:
+        where, params = query.where()
+        if before is not None:
+            where, params = f"{where} AND id < ?", params + (before,)
+        if after is not None:
+            where, params = f"{where} AND id > ?", params + (after,)
+        return await self.db.fetchone(f"SELECT 1 FROM spots WHERE {where} LIMIT 1", params) is not None
+
+    async def get_many(self, ids: Iterable[int]) -> Dict[int, Spot]:
+        ids = list(ids)
+        if not ids:
+            return {}
+        rows = await self.db.fetchall(f"{_SELECT} WHERE id IN ({', '.join('?' * len(ids))})", tuple(ids))
+        return {row[0]: Spot(*row) for row in rows}
+
+    async def points_since(self, last_id: int, limit: int = 50000) -> List[Tuple[int, str, Optional[int], Optional[int], str]]:
+        """Новые точки после last_id: (id, хэштег, x, y, исходный текст координат)."""
+        return await self.db.fetchall(
+            "SELECT id, waterbody_hashtag, coord_x, coord_y, coordinates FROM spots WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, limit),
+        )
+
+    async def stats_rows_since(self, last_id: int, limit: int = 50000) -> List[Tuple[int, str, str, str, str, float]]:
+        """Новые точки для счётчиков: (id, водоём, снасть, ключ ника, ник, время)."""
+        return await self.db.fetchall(
+            "SELECT id, waterbody_name, tackle, nickname_key, game_nickname, created_at FROM spots WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, limit),
+        )
+
+    async def aggregate_all(self) -> Dict[str, Any]:
+        """Счётчики по всему архиву одним проходом агрегатов (для пересборки без снимка)."""
+        def _run(conn):
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM spots").fetchone()[0]
+            where, params = "WHERE id <= ?", (last_id,)
+            return {
+                "last_id": last_id,
+                "total": conn.execute(f"SELECT COUNT(*) FROM spots {where}", params).fetchone()[0],
+                "waterbody": conn.execute(f"SELECT waterbody_name, COUNT(*) FROM spots {where} GROUP BY waterbody_name", params).fetchall(),
+                "tackle": conn.execute(f"SELECT tackle, COUNT(*) FROM spots {where} GROUP BY tackle", params).fetchall(),
+                "day": conn.execute(
+                    f"SELECT date(created_at, 'unixepoch', 'localtime'), COUNT(*) FROM spots {where} GROUP BY 1", params
+                ).fetchall(),
+                "nickname": conn.execute(
+                    f"SELECT nickname_key, MAX(game_nickname), COUNT(*) FROM spots {where} GROUP BY nickname_key", params
+                ).fetchall(),
+            }
+
+        return await self.db.run(_run)
+
+    async def add_photo_hashes(self, submission_id: str, user_id: Optional[int], hashes: Dict[str, int], created_at: Optional[float] = None):
+        # SQLite INTEGER знаковый, 64-битный хэш храним в дополнительном коде
+        created_at = created_at or time.time()
+        rows = [(submission_id, uid, h - (1 << 64) if h >= 1 << 63 else h, user_id, created_at) for uid, h in hashes.items()]
+        await self.db.transaction([(
+            "INSERT OR IGNORE INTO photo_hashes (submission_id, file_unique_id, hash, user_id, created_at) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )])
+
+    async def photo_hashes_since(self, last_id: int, limit: int = 50000) -> List[Tuple[int, str, int, Optional[int], float]]:
+        """Хэши фото после last_id: (id, submission_id, хэш, user_id, время)."""
+        rows = await self.db.fetchall(
+            "SELECT id, submission_id, hash, user_id, created_at FROM photo_hashes WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, limit),
+        )
+        return [(row_id, sid, h & ((1 << 64) - 1), user_id, ts) for row_id, sid, h, user_id, ts in rows]
+
+    async def close(self):
+        await self._writer.close()
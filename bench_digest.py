@@ -0,0 +1,49 @@
+"""Сколько сообщений получают админы за час пика: обычная рассылка против сводок.
+
+Час пика сжат по времени в `--scale` раз: `--users` заявок (по 1-4 фото) —
+это один час, окно сводки DIGEST_WINDOW делится на тот же коэффициент.
+Оба прогона идут через loadtest против фейкового Bot API.
+
+    python bench_digest.py
+    python bench_digest.py --users 600 --admins 5 --max-items 20
+"""
+import argparse
+import asyncio
+from typing import List
+
+import loadtest
+
+
+async def measure(args, digest: bool) -> dict:
+    argv = ["--users", str(args.users), "--concurrency", str(args.concurrency), "--admins", str(args.admins), "--seed", str(args.seed)]
+    if digest:
+        argv += [
+            "--env", "DIGEST_MODE=1",
+            "--env", f"DIGEST_WINDOW={args.window / args.scale:g}",
+            "--env", f"DIGEST_MAX_ITEMS={args.max_items}",
+        ]
+    report = await loadtest.run(loadtest.parse_args(argv))
+    if report["completed"] != args.users or report["admin_pending"]:
+        raise SystemExit(f"run incomplete: {report['completed']}/{args.users} posts, {report['admin_pending']} admin deliveries queued")
+    return report
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Admin messages per peak hour with and without digest mode")
+    parser.add_argument("--users", type=int, default=300, help="submissions in the peak hour")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--admins", type=int, default=3)
+    parser.add_argument("--window", type=float, default=300, help="DIGEST_WINDOW of the real hour, seconds")
+    parser.add_argument("--max-items", type=int, default=10, help="DIGEST_MAX_ITEMS")
+    parser.add_argument("--scale", type=float, default=100, help="how much faster than real time the hour runs")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    for digest in (False, True):
+        report = asyncio.run(measure(args, digest))
+        admin_calls = round(report["admin_api_calls_per_post"] * report["completed"])
+        print(f"{'digest' if digest else 'per-submission':<15} {report['admin_messages']} messages/hour to {args.admins} admins, {admin_calls} API calls")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Бенчмарк проверки фото: dhash на JPEG 1280x720 и поиск в HammingIndex.
+
+dhash меряется в текущем процессе и через ProcessPoolExecutor, как в
+PhotoHasher. Индекс строится из `--hashes` случайных хэшей; запросы — хэши
+из индекса с перевёрнутыми битами, полнота сверяется с перебором.
+
+    python bench_phash.py
+    python bench_phash.py --images 500 --workers 4 --hashes 200000
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from PIL import Image
+
+from phash import HammingIndex, dhash
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fixtures", "catch.jpg")
+
+
+def sample_jpegs(count: int) -> List[bytes]:
+    """Скриншоты 1280x720: фикстура, слегка отличающаяся от кадра к кадру."""
+    base = Image.open(FIXTURE).convert("RGB").resize((1280, 720))
+    images = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        base.rotate(i % 7 - 3).save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+async def hash_in_pool(images: List[bytes], workers: int) -> float:
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        await loop.run_in_executor(executor, dhash, images[0])  # прогрев: запуск процессов не считаем
+        started = time.perf_counter()
+        await asyncio.gather(*(loop.run_in_executor(executor, dhash, data) for data in images))
+        return time.perf_counter() - started
+
+
+def bench_dhash(count: int, workers: int):
+    images = sample_jpegs(count)
+    started = time.perf_counter()
+    for data in images:
+        dhash(data)
+    inline = time.perf_counter() - started
+    pooled = asyncio.run(hash_in_pool(images, workers))
+    print(f"dhash 1280x720 JPEG: {count / inline:.0f} img/s inline, {count / pooled:.0f} img/s in a pool of {workers}")
+
+
+def bench_index(count: int, queries: int, distance: int, seed: int):
+    rng = random.Random(seed)
+    values = [rng.getrandbits(64) for _ in range(count)]
+    started = time.perf_counter()
+    index = HammingIndex(max_distance=distance)
+    for position, value in enumerate(values):
+        index.add(value, position)
+    build = time.perf_counter() - started
+
+    probes = []
+    for _ in range(queries):
+        value = rng.choice(values)
+        for bit in rng.sample(range(64), rng.randint(0, distance)):
+            value ^= 1 << bit
+        probes.append(value)
+    started = time.perf_counter()
+    results = [index.search(value) for value in probes]
+    per_query = (time.perf_counter() - started) / queries
+
+    found = expected = 0
+    for value, result in list(zip(probes, results))[:20]:
+        exact = {position for position, other in enumerate(values) if (other ^ value).bit_count() <= distance}
+        expected += len(exact)
+        found += len(exact & {item for _, item in result})
+    print(f"HammingIndex {count} hashes, distance {distance}: build {build:.2f} s, {per_query * 1000:.3f} ms/query, recall {found / expected:.3f}")
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Photo hash benchmark")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2, help="PHOTO_HASH_WORKERS")
+    parser.add_argument("--hashes", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--distance", type=int, default=5, help="PHOTO_HASH_DISTANCE")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    bench_dhash(args.images, args.workers)
+    bench_index(args.hashes, args.queries, args.distance, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Микробенчмарк render.py: время и аллокации на апдейт против прежнего кода.
+
+Прежние варианты (клавиатура собирается заново на каждый ответ, подпись —
+конкатенацией) воспроизведены здесь же, чтобы сравнение не зависело от истории.
+
+    python bench_render.py
+"""
+import timeit
+import tracemalloc
+
+from aiogram import types
+
+import render
+
+OFFER_URL = "https://t.me/your_channel_link"
+WATERBODIES = [f"оз.Водоём {i}" for i in range(17)]
+DATA = {
+    "waterbody_hashtag": "#медное@rr4world", "coordinates": "75:42", "clip": "12", "depth": "3.5", "temperature": "20",
+    "comment": "Ловится хорошо с утра, брал на опарыша. " * 3, "game_nickname": "Рыбак",
+}
+
+
+# --- Прежний код ---
+def old_waterbody_keyboard():
+    buttons = []
+    for i in range(0, len(WATERBODIES), 2):
+        row = [types.KeyboardButton(text=WATERBODIES[i])]
+        if i + 1 < len(WATERBODIES):
+            row.append(types.KeyboardButton(text=WATERBODIES[i + 1]))
+        buttons.append(row)
+    return types.ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+
+
+def old_confirm_keyboard():
+    return types.ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text="Отправить пост")], [types.KeyboardButton(text="Редактировать")], [types.KeyboardButton(text="Отмена")]],
+        resize_keyboard=True,
+    )
+
+
+def old_post_caption(d, escape=str):
+    text = f"<b>Локация:</b> {escape(d['waterbody_hashtag'])}\n<b>Координаты:</b> {escape(d['coordinates'])}\n"
+    if d.get('clip') and d['clip'] != "Нет клипсы": text += f"<b>Клипса:</b> {escape(d['clip'])}\n"
+    if d.get('depth'): text += f"<b>Глубина:</b> {escape(d['depth'])}\n"
+    if d.get('temperature'): text += f"<b>Температура:</b> {escape(d['temperature'])}\n"
+    if d.get('comment'): text += f"<b>Комментарий:</b>\n<blockquote>{escape(d['comment'])}</blockquote>\n"
+    text += f"<b>Игровой ник:</b> {escape(d['game_nickname'])}\n\n🎁 Автору отправлено 200 кофе\n<a href='{OFFER_URL}'>ПРЕДЛОЖИТЬ ПОСТ</a>"
+    return text
+
+
+def old_post_caption_checked(d):
+    # Прежняя конкатенация, дополненная тем, что теперь делает render: экранирование и проверка длины
+    text = old_post_caption(d, render.escape)
+    render.visible_length(text)
+    return text
+
+
+# --- Новый код ---
+WATERBODY_KEYBOARD = render.reply_keyboard(render.chunked(WATERBODIES, 2))
+
+
+def new_waterbody_keyboard():
+    return WATERBODY_KEYBOARD
+
+
+def new_confirm_keyboard():
+    return render.CONFIRM_KEYBOARD
+
+
+def new_post_caption():
+    return render.post_caption(DATA, OFFER_URL)
+
+
+def measure(fn, number: int):
+    """(мкс на вызов, байт, которые вызов оставляет в памяти, пока результат нужен)."""
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    fn()
+    tracemalloc.start()
+    results = [fn() for _ in range(100)]  # держим результаты, как держит их отправка в aiogram
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return seconds * 1e6, current / 100
+
+
+def main():
+    assert new_post_caption() == old_post_caption(DATA), "без спецсимволов подпись должна совпадать с прежней"
+    cases = [
+        ("клавиатура водоёмов", old_waterbody_keyboard, new_waterbody_keyboard, 5000),
+        ("клавиатура подтверждения", old_confirm_keyboard, new_confirm_keyboard, 20000),
+        ("подпись поста (прежняя, без экранирования)", lambda: old_post_caption(DATA), new_post_caption, 20000),
+        ("подпись поста (прежняя + escape + разбор HTML)", lambda: old_post_caption_checked(DATA), new_post_caption, 20000),
+    ]
+    print(f"{'':48} {'было, мкс':>10} {'стало, мкс':>11} {'было, Б':>9} {'стало, Б':>9}")
+    for name, old, new, number in cases:
+        old_time, old_bytes = measure(old, number)
+        new_time, new_bytes = measure(new, number)
+        print(f"{name:48} {old_time:10.2f} {new_time:11.2f} {old_bytes:9.0f} {new_bytes:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
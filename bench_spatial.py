@@ -0,0 +1,59 @@
+"""Бенчмарк spatial.GridIndex: построение и запросы /nearby на миллионе точек.
+
+Точки случайные, равномерно по водоёмам и по полю координат 0..COORD_MAX.
+Результаты запросов сверяются с полным перебором на части запросов.
+
+    python bench_spatial.py
+    python bench_spatial.py --points 200000 --radius 5 10 25 50
+"""
+import argparse
+import math
+import random
+import time
+from typing import List, Tuple
+
+from spatial import GridIndex
+
+WATERBODIES = [f"водоём{i}" for i in range(18)]
+COORD_MAX = 150
+
+
+def brute_force(points: List[Tuple[str, int, int, int]], group: str, x: int, y: int, radius: float, limit: int) -> List[Tuple[float, int]]:
+    found = [(math.hypot(px - x, py - y), item_id) for g, px, py, item_id in points if g == group]
+    return sorted(d for d in found if d[0] <= radius)[:limit]
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="GridIndex build and query benchmark")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--radius", type=float, nargs="+", default=[5, 10, 25])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    points = [(rng.choice(WATERBODIES), rng.randint(0, COORD_MAX), rng.randint(0, COORD_MAX), i) for i in range(1, args.points + 1)]
+
+    started = time.perf_counter()
+    index = GridIndex()
+    for group, x, y, item_id in points:
+        index.add(group, x, y, item_id)
+    build = time.perf_counter() - started
+    cells = [cell for grid in index._grids.values() for cell in grid.values()]
+    payload = sum(len(a) * a.itemsize for cell in cells for a in (cell.xs, cell.ys, cell.ids))
+    print(f"build: {args.points} points in {build:.2f} s ({args.points / build:,.0f} points/s), {len(cells)} cells, arrays {payload / 2 ** 20:.1f} MB")
+
+    queries = [(rng.choice(WATERBODIES), rng.randint(0, COORD_MAX), rng.randint(0, COORD_MAX)) for _ in range(args.queries)]
+    for radius in args.radius:
+        started = time.perf_counter()
+        results = [index.nearby(group, x, y, radius) for group, x, y in queries]
+        per_query = (time.perf_counter() - started) / len(queries)
+        # Сверка с перебором: расстояния совпадают (при равных расстояниях id могут отличаться)
+        for (group, x, y), result in list(zip(queries, results))[:5]:
+            expected = brute_force(points, group, x, y, radius, 10)
+            assert [round(d, 6) for d, _ in result] == [round(d, 6) for d, _ in expected], (group, x, y, radius)
+        print(f"radius {radius:g}: {per_query * 1000:.3f} ms/query, {sum(map(len, results)) / len(results):.1f} results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Бенчмарк счётчиков /stats на большом архиве.
+
+Архив заполняется `--spots` синтетическими точками за `--days` дней от
+`--nicknames` авторов. Меряются: пересборка счётчиков агрегатами, ответ /stats
+через feed_update, stats.add, запись и чтение снимка, дочитывание `--replay`
+строк после снимка. Снимок и дочитывание сверяются с полной пересборкой.
+
+    python bench_stats.py
+    python bench_stats.py --spots 200000 --nicknames 10000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = tempfile.TemporaryDirectory(prefix="bench-stats-")
+# main.py читает конфигурацию при импорте: бот без сети, база во временном каталоге
+os.environ.update({
+    "BOT_TOKEN": "123456:TEST", "ADMIN_CHAT_IDS": "900000001", "RUN_MODE": "polling", "WEBHOOK_BASE_URL": "",
+    "FSM_STORAGE": "memory", "DB_PATH": os.path.join(DATA_DIR.name, "bot.db"), "THROTTLE_RATE": "100000", "THROTTLE_BURST": "100000",
+})
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+import main  # noqa: E402
+from fakes import make_bot, text_update  # noqa: E402
+from stats import SubmissionStats  # noqa: E402
+
+BATCH = 50000
+
+
+def _state(s: SubmissionStats) -> tuple:
+    return s.total, s.by_waterbody, s.by_tackle, s.by_day, s.nicknames.counts, s.nicknames.top()
+
+
+async def fill(count: int, nicknames: int, days: int, seed: int):
+    rng = random.Random(seed)
+    waterbodies = list(main.WATERBODY_MAPPING.items())
+    started = time.time() - days * 86400
+    for offset in range(0, count, BATCH):
+        items = []
+        for i in range(offset, min(offset + BATCH, count)):
+            name, hashtag = rng.choice(waterbodies)
+            spot = {
+                "waterbody_name": name, "waterbody_hashtag": hashtag, "coordinates": f"{rng.randint(0, 150)}:{rng.randint(0, 150)}",
+                "tackle": rng.choice(main.TACKLES), "game_nickname": f"Angler{int(rng.paretovariate(1.2)) % nicknames}",
+            }
+            items.append((f"bench:{i}", started + i * days * 86400 / count, 100000 + i % nicknames, spot))
+        await main.archive.add_many(items)
+
+
+async def bench(args):
+    await main.archive.setup()
+    await main.stats.setup()
+    t = time.perf_counter()
+    await fill(args.spots, args.nicknames, args.days, args.seed)
+    print(f"archive: {args.spots} spots in {time.perf_counter() - t:.1f} s")
+
+    t = time.perf_counter()
+    main.stats.merge(await main.archive.aggregate_all())
+    print(f"full rebuild from aggregates: {time.perf_counter() - t:.2f} s")
+
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    bot = make_bot()
+    latencies = []
+    for _ in range(args.requests):
+        t = time.perf_counter()
+        await main.dp.feed_update(bot, text_update("/stats"))
+        latencies.append(time.perf_counter() - t)
+    assert bot.session.names() == ["sendMessage"] * args.requests
+    print(f"/stats through feed_update: p50 {statistics.median(latencies) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms")
+
+    t = time.perf_counter()
+    await main.stats.save()
+    save = time.perf_counter() - t
+    restored = SubmissionStats(main.data_db)
+    t = time.perf_counter()
+    await restored.load()
+    print(f"snapshot: save {save * 1000:.0f} ms, load {(time.perf_counter() - t) * 1000:.0f} ms")
+    assert _state(restored) == _state(main.stats), "snapshot differs from the rebuild"
+
+    # Дочитывание после снимка: счётчики с нуля от last_id = всего - replay
+    replayed = SubmissionStats(main.data_db)
+    replayed.last_id = args.spots - args.replay
+    rows = 0
+    t = time.perf_counter()
+    while batch := await main.archive.stats_rows_since(replayed.last_id):
+        for row in batch:
+            replayed.add(*row)
+        rows += len(batch)
+    replay = time.perf_counter() - t
+    assert replayed.total == rows == args.replay
+    print(f"replay: {rows} rows in {replay:.2f} s")
+
+    batch = await main.archive.stats_rows_since(0, limit=args.replay)
+    fresh = SubmissionStats(main.data_db)
+    t = time.perf_counter()
+    for row in batch:
+        fresh.add(*row)
+    print(f"stats.add: {(time.perf_counter() - t) / len(batch) * 1e6:.1f} µs")
+
+
+def main_(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="/stats counters benchmark")
+    parser.add_argument("--spots", type=int, default=2_000_000)
+    parser.add_argument("--nicknames", type=int, default=100_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--replay", type=int, default=200_000, help="rows written after the snapshot")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(bench(args))
+    finally:
+        main.data_db.close()
+        DATA_DIR.cleanup()
+
+
+if __name__ == "__main__":
+    main_()
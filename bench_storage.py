@@ -0,0 +1,63 @@
+"""Бенчмарк FSM-хранилищ: N одновременных пользователей проходят анкету.
+
+Каждый пользователь делает столько же обращений к хранилищу, сколько шаги
+PostCreation без кэша состояния: чтение состояния, чтение и запись данных,
+смена состояния — `--steps` раз.
+
+    python bench_storage.py --users 100 1000
+    python bench_storage.py --users 1000 --redis redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from storage import SessionTTL, create_storage
+
+BOT_ID = 123456
+
+
+async def user_flow(storage: BaseStorage, user_id: int, steps: int):
+    key = StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id)
+    for step in range(steps):
+        await storage.get_state(key)
+        data = await storage.get_data(key)
+        data[f"field{step}"] = f"value{step}"
+        await storage.set_data(key, data)
+        await storage.set_state(key, f"PostCreation:step{step}")
+
+
+async def run(kind: str, users: int, steps: int, redis_url: str = None) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = create_storage(kind, db_path=os.path.join(tmp, "bench.db"), redis_url=redis_url, ttl=SessionTTL(3600))
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(user_flow(storage, 100000 + i, steps) for i in range(users)))
+            if hasattr(storage, "flush"):
+                await storage.flush()  # последний пакет записей тоже входит в замер
+            return time.perf_counter() - started
+        finally:
+            await storage.close()
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="FSM storage benchmark")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--steps", type=int, default=10, help="steps per user, 4 storage ops each")
+    parser.add_argument("--redis", help="REDIS_URL, to include the redis backend")
+    args = parser.parse_args(argv)
+    kinds = ["memory", "sqlite"] + (["redis"] if args.redis else [])
+    ops = args.steps * 4
+    print(f"{'backend':8} {'users':>6} {'seconds':>9} {'ops/s':>10}")
+    for users in args.users:
+        for kind in kinds:
+            seconds = asyncio.run(run(kind, users, args.steps, args.redis))
+            print(f"{kind:8} {users:6} {seconds:9.3f} {users * ops / seconds:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Sequence, Set, TypeVar
+
+T = TypeVar("T")
+
+
+class SQLiteDB:
+    """Пул соединений SQLite (WAL) поверх потоков, чтобы не блокировать event loop.
+
+    У каждого потока пула своё соединение; несколько процессов бота могут
+    открывать один и тот же файл одновременно.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sqlite")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn: Callable[..., T], args: Sequence[Any]) -> T:
+        return fn(self._connection(), *args)
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Выполняет `fn(conn, *args)` в потоке пула."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def transaction(self, statements: Iterable[tuple]) -> None:
+        """Выполняет пачку (sql, params | [params...]) одной транзакцией."""
+        def _run(conn: sqlite3.Connection):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        conn.executemany(sql, params)
+                    else:
+                        conn.execute(sql, params)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        await self.run(_run)
+
+    async def executescript(self, script: str) -> None:
+        await self.run(lambda conn: conn.executescript(script))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class BatchWriter:
+    """Планировщик записи пачками для буферов в памяти (архив, FSM в SQLite).
+
+    Владелец держит буфер и пишет его в `flush()` (под своим замком; при ошибке
+    возвращает записи в буфер и пробрасывает исключение), а после каждой правки
+    зовёт `touch(размер буфера)`. Пачка пишется через `interval` секунд после
+    первой правки или сразу, когда набралось `batch_size`. Ошибка фоновой записи
+    логируется, запись повторяется через `retry_interval` секунд.
+    """
+
+    def __init__(self, flush: Callable[[], Awaitable[Any]], name: str, interval: float, batch_size: int, retry_interval: float = 1.0):
+        self._flush = flush
+        self.name = name
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self._timer: Optional[asyncio.Task] = None  # отложенная запись, ещё не начатая
+        self._tasks: Set[asyncio.Task] = set()
+        self.failures = 0
+
+    def touch(self, pending: int):
+        if pending >= self.batch_size:
+            self._spawn(0)
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self.interval)
+
+    def _spawn(self, delay: float) -> asyncio.Task:
+        task = asyncio.create_task(self._flush_later(delay))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        if self._timer is asyncio.current_task():
+            self._timer = None  # запись началась: новые правки ставят следующий таймер
+        try:
+            await self._flush()
+        except Exception as e:
+            self.failures += 1
+            logging.error(f"{self.name} flush failed, retrying in {self.retry_interval:g} s: {e}")
+            if self._timer is None or self._timer.done():
+                self._timer = self._spawn(self.retry_interval)
+
+    async def close(self):
+        """Отменяет отложенную запись и пишет остаток сразу (ошибка пробрасывается)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self._flush()
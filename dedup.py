@@ -0,0 +1,57 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+
+def submission_fingerprint(waterbody_hashtag: str, x: Optional[int], y: Optional[int], tackle: str, photo_uids: Iterable[str]) -> str:
+    """Отпечаток заявки: водоём, координаты, снасть и file_unique_id фото (порядок фото не важен)."""
+    parts = [waterbody_hashtag, f"{x}:{y}", tackle, *sorted(photo_uids)]
+    return hashlib.blake2b("\x1f".join(parts).encode(), digest_size=16).hexdigest()
+
+
+class Deduplicator:
+    """LRU отпечатков с окном по времени.
+
+    Отпечаток старше `window` секунд считается новым; при переполнении
+    вытесняются самые давние. `hits`/`checks` — для метрики доли дублей.
+    """
+
+    def __init__(self, window: float = 86400, max_size: int = 50000):
+        self.window = window
+        self.max_size = max_size
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self.checks = 0
+        self.hits = 0
+
+    def seen(self, fingerprint: str, now: Optional[float] = None) -> bool:
+        """True — такая заявка уже была в окне; иначе запоминает её и возвращает False."""
+        now = time.time() if now is None else now
+        self.checks += 1
+        ts = self._seen.get(fingerprint)
+        if ts is not None and now - ts < self.window:
+            self.hits += 1
+            return True
+        self.remember(fingerprint, now)
+        return False
+
+    def remember(self, fingerprint: str, ts: float):
+        """Запоминает отпечаток без учёта в статистике (восстановление после рестарта)."""
+        self._seen[fingerprint] = ts
+        self._seen.move_to_end(fingerprint)
+        self._expire(ts)
+
+    def forget(self, fingerprint: str):
+        """Снимает отпечаток (например, если заявку так и не удалось записать)."""
+        self._seen.pop(fingerprint, None)
+
+    def _expire(self, now: float):
+        # Записи упорядочены по времени добавления: старые и лишние — в начале
+        while self._seen:
+            fingerprint, ts = next(iter(self._seen.items()))
+            if len(self._seen) <= self.max_size and now - ts < self.window:
+                break
+            self._seen.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._seen)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+
+class TokenBucket:
+    """Классический token bucket: `rate` токенов в секунду, не больше `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def is_full(self) -> bool:
+        """Ведро полное — им давно не пользовались, его можно выбросить."""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self, tokens: float = 1.0):
+        # Запрос больше ёмкости всё равно должен когда-то пройти
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+@dataclass
+class DeliveryResult:
+    ok: bool
+    attempts: int
+    error: Optional[str] = None
+    result: Any = None
+
+
+class Delivery:
+    """Отправка в чаты через общий лимит бота и лимит на каждый чат, с повтором 429.
+
+    Лимиты по умолчанию взяты из рекомендаций Bot API: ~30 сообщений в секунду
+    на бота и не чаще раза в секунду в один чат.
+    """
+
+    def __init__(self, global_rate: float = 25, per_chat_rate: float = 1, per_chat_burst: float = 10, retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.retries = retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable[Any]], cost: float = 1) -> DeliveryResult:
+        """Выполняет `call()` с учётом лимитов; `cost` — число сообщений в запросе."""
+        attempts = 0
+        while True:
+            attempts += 1
+            await self._chat_bucket(chat_id).acquire(cost)
+            await self.global_bucket.acquire(cost)
+            try:
+                return DeliveryResult(ok=True, attempts=attempts, result=await call())
+            except TelegramRetryAfter as e:
+                if attempts > self.retries:
+                    return DeliveryResult(ok=False, attempts=attempts, error=str(e))
+                logging.warning(f"Flood wait {e.retry_after}s for chat {chat_id}")
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempts > self.retries:
+                    return DeliveryResult(ok=False, attempts=attempts, error=str(e))
+                await asyncio.sleep(2 ** (attempts - 1))
+            except Exception as e:
+                return DeliveryResult(ok=False, attempts=attempts, error=str(e))
+
@@ -0,0 +1,523 @@
+"""Нагрузочный стенд: локальный фейковый Bot API + виртуальные пользователи.
+
+Бот (main.py) запускается отдельным процессом и ходит в фейковый сервер через
+TELEGRAM_API_URL. Виртуальные пользователи проходят весь сценарий PostCreation
+по всем веткам и меряют время от апдейта до ответа бота.
+
+    python loadtest.py --users 2000 --concurrency 200 --mode webhook
+    python loadtest.py --mode polling --api-latency 0.05 --flood-rate 0.05
+    python loadtest.py --users 2000 --concurrency 200 --workers 4
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+SEND_METHODS = {"sendMessage", "sendMediaGroup", "copyMessages", "copyMessage", "sendPhoto"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: отвечает на запросы бота и запоминает, что куда отправлено."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_rate: float = 0.0, flood_chats: Optional[Set[int]] = None, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_chats = flood_chats  # None = 429 для всех чатов
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.chat_calls: Counter = Counter()  # запросов по чатам (chat_id из параметров)
+        self.floods: Counter = Counter()
+        self.delivered: Counter = Counter()  # сообщений по чатам
+        self.webhook_url: Optional[str] = None
+        self.ready = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates: List[dict] = []
+        self._updates_ready = asyncio.Event()
+        self._chat_queues: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+
+    # --- Что бот отправил пользователям ---
+    def replies(self, chat_id: int) -> asyncio.Queue:
+        return self._chat_queues[chat_id]
+
+    # --- Апдейты для getUpdates ---
+    def next_update_id(self) -> int:
+        return next(self._update_ids)
+
+    def push_update(self, update: dict):
+        self._updates.append(update)
+        self._updates_ready.set()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        chat_id = _int(params.get("chat_id"))
+        if chat_id is not None:
+            self.chat_calls[chat_id] += 1
+        if method in SEND_METHODS and self.flood_rate and (self.flood_chats is None or chat_id in self.flood_chats):
+            if random.random() < self.flood_rate:
+                self.floods[method] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                })
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    async def _params(request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str) and value[:1] in "[{":
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+        message.update({k: v for k, v in extra.items() if v is not None})
+        return message
+
+    def _deliver(self, chat_id: int, message: dict):
+        self.delivered[chat_id] += 1
+        self._chat_queues[chat_id].put_nowait(message)
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_setWebhook(self, params):
+        self.webhook_url = params.get("url")
+        self.ready.set()
+        return True
+
+    async def api_deleteWebhook(self, params):
+        self.webhook_url = None
+        return True
+
+    async def api_getUpdates(self, params):
+        self.ready.set()
+        offset = _int(params.get("offset")) or 0
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), timeout=float(params.get("timeout") or 0) or 0.01)
+            except asyncio.TimeoutError:
+                pass
+        limit = _int(params.get("limit")) or 100
+        return self._updates[:limit]
+
+    async def api_sendMessage(self, params):
+        chat_id = _int(params["chat_id"])
+        message = self._message(chat_id, text=params.get("text"))
+        self._deliver(chat_id, message)
+        return message
+
+    async def api_sendMediaGroup(self, params):
+        chat_id = _int(params["chat_id"])
+        media = params.get("media") or []
+        messages = [self._message(chat_id, caption=m.get("caption"), photo=[{"file_id": m.get("media"), "file_unique_id": str(m.get("media")), "width": 1, "height": 1}]) for m in media]
+        for message in messages:
+            self._deliver(chat_id, message)
+        return messages
+
+    async def api_copyMessages(self, params):
+        chat_id = _int(params["chat_id"])
+        ids = []
+        for _ in params.get("message_ids") or []:
+            message = self._message(chat_id)
+            self._deliver(chat_id, message)
+            ids.append({"message_id": message["message_id"]})
+        return ids
+
+    async def api_copyMessage(self, params):
+        chat_id = _int(params["chat_id"])
+        message = self._message(chat_id)
+        self._deliver(chat_id, message)
+        return {"message_id": message["message_id"]}
+
+    async def api_editMessageText(self, params):
+        return self._message(_int(params.get("chat_id")) or 0, text=params.get("text"))
+
+
+def _int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# --- Сценарии ---
+WATERBODIES = ["оз.Комариное", "р.Белая", "оз.Куори", "р.Волхов", "Ладожское оз.", "р.Ахтуба", "р.Яма"]
+
+
+@dataclass
+class Scenario:
+    name: str
+    steps: List[Tuple[str, Any, str]]  # (шаг, текст или число фото, ожидаемая подстрока ответа)
+
+
+def build_scenario(rng: random.Random) -> Scenario:
+    """Случайная ветка PostCreation: Мах/Матч/прочие снасти, Медное, комментарий или пропуск."""
+    mednoe = rng.random() < 0.25
+    waterbody = "оз.Медное" if mednoe else rng.choice(WATERBODIES)
+    tackle = rng.choice(["Мах", "Матч", "Спиннинг", "Донка", "Морская ловля"])
+    comment = rng.random() < 0.5
+    steps = [
+        ("start", "/start", "Выберите водоем"),
+        ("waterbody", waterbody, "Введите координаты"),
+        ("coordinates", f"{rng.randint(1, 150)}:{rng.randint(1, 150)}", "Выберите снасть"),
+    ]
+    after_depth = "температуру воды" if mednoe else "Добавить комментарий"
+    if tackle == "Мах":
+        steps.append(("tackle", tackle, "Укажите глубину"))
+        steps.append(("depth", str(rng.randint(1, 30)), after_depth))
+    elif tackle == "Матч":
+        steps.append(("tackle", tackle, "Укажите клипсу"))
+        steps.append(("clip", str(rng.randint(10, 40)), "укажите глубину"))
+        steps.append(("depth", str(rng.randint(1, 30)), after_depth))
+    else:
+        steps.append(("tackle", tackle, "Укажите клипсу"))
+        steps.append(("clip", rng.choice(["Пропустить клипсу", str(rng.randint(10, 40))]), after_depth))
+    if mednoe:
+        steps.append(("temperature", str(rng.randint(5, 25)), "Добавить комментарий"))
+    if comment:
+        steps.append(("comment_choice", "Добавить комментарий", "Введите комментарий"))
+        steps.append(("comment", "Клюёт на опарыша", "игровой ник"))
+    else:
+        steps.append(("comment_choice", "Пропустить комментарий", "игровой ник"))
+    steps.append(("nickname", f"nick{rng.randint(1, 10 ** 6)}", "Прикрепите фото"))
+    steps.append(("photos", rng.randint(1, 4), "Фото добавлено"))
+    steps.append(("done", "Готово", "Все верно?"))
+    steps.append(("send", "Отправить пост", "Отправлено на модерацию"))
+    label = f"{tackle}{'+Медное' if mednoe else ''}{'+comment' if comment else ''}"
+    return Scenario(label, steps)
+
+
+@dataclass
+class Stats:
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    completed: int = 0
+    failed: int = 0
+    branches: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+
+
+class LoadGenerator:
+    def __init__(self, api: FakeBotAPI, mode: str, webhook_url: str, secret: str, reply_timeout: float = 10.0):
+        self.api = api
+        self.mode = mode
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.reply_timeout = reply_timeout
+        self.stats = Stats()
+        self._message_ids = itertools.count(1)
+        self._http: Optional[ClientSession] = None
+
+    async def __aenter__(self):
+        self._http = ClientSession(timeout=ClientTimeout(total=30))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._http.close()
+
+    def _update(self, user_id: int, **message) -> dict:
+        message.update({
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+        })
+        return {"update_id": self.api.next_update_id(), "message": message}
+
+    async def _send(self, update: dict):
+        if self.mode == "polling":
+            self.api.push_update(update)
+            return
+        async with self._http.post(self.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.secret}) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"webhook HTTP {resp.status}")
+
+    async def _wait_reply(self, user_id: int, expected: str):
+        queue = self.api.replies(user_id)
+        deadline = time.monotonic() + self.reply_timeout
+        while True:
+            message = await asyncio.wait_for(queue.get(), timeout=max(deadline - time.monotonic(), 0.001))
+            if expected in (message.get("text") or message.get("caption") or ""):
+                return
+
+    async def run_user(self, user_id: int, scenario: Scenario):
+        queue = self.api.replies(user_id)
+        for step, payload, expected in scenario.steps:
+            while not queue.empty():
+                queue.get_nowait()
+            if step == "photos":
+                group = f"album{user_id}" if payload > 1 else None
+                updates = [
+                    self._update(user_id, photo=[{"file_id": f"photo{user_id}_{i}", "file_unique_id": f"u{user_id}_{i}", "width": 1280, "height": 720}], **({"media_group_id": group} if group else {}))
+                    for i in range(payload)
+                ]
+            else:
+                updates = [self._update(user_id, text=payload)]
+            started = time.perf_counter()
+            try:
+                for update in updates:
+                    await self._send(update)
+                await self._wait_reply(user_id, expected)
+            except Exception as e:
+                self.stats.failed += 1
+                self.stats.errors[f"{step}: {type(e).__name__}"] += 1
+                return
+            self.stats.latencies[step].append(time.perf_counter() - started)
+        self.stats.completed += 1
+        self.stats.branches[scenario.name] += 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def wait_port(port: int, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Bot did not open port {port}")
+
+
+async def fetch_metric(port: int, name: str) -> Dict[str, float]:
+    """Значения метрики из /metrics бота: {метки: значение}."""
+    async with ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+            text = await resp.text()
+    values = {}
+    for line in text.splitlines():
+        if line.startswith((name + "{", name + " ")):
+            labels, _, value = line.rpartition(" ")
+            values[labels[len(name):]] = float(value)
+    return values
+
+
+def _label(labels: str, name: str) -> str:
+    return labels.partition(f'{name}="')[2].partition('"')[0]
+
+
+async def fetch_worker_load(port: int) -> Dict[str, float]:
+    """Сколько апдейтов обработал каждый воркер (по /metrics супервизора)."""
+    return {_label(labels, "worker"): value for labels, value in (await fetch_metric(port, "bot_worker_updates_handled")).items()}
+
+
+async def wait_admin_delivery(port: int, timeout: float) -> int:
+    """Ждёт, пока outbox бота разошлёт заявки админам; возвращает, сколько доставок не успело уйти."""
+    deadline = time.monotonic() + timeout
+    while True:
+        left: Counter = Counter()
+        for labels, value in (await fetch_metric(port, "bot_outbox_deliveries")).items():
+            status = _label(labels, "status")
+            if status in ("pending", "processing"):
+                left[status] = max(left[status], value)  # база общая: все воркеры видят одну и ту же очередь
+        remaining = int(sum(left.values()))
+        if not remaining or time.monotonic() >= deadline:
+            return remaining
+        await asyncio.sleep(0.5)
+
+
+async def run(args) -> dict:
+    admins = [900000000 + i for i in range(args.admins)]
+    api = FakeBotAPI(
+        latency=args.api_latency, jitter=args.api_jitter, flood_rate=args.flood_rate,
+        flood_chats=None if args.flood_scope == "all" else set(admins),
+    )
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    api_port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    bot_port = free_port()
+    secret = "loadtestsecret"
+    # Своя база на каждый прогон: иначе outbox прошлого прогона восстанавливает окно дедупликации
+    # и те же сценарии (seed) отбрасываются как повторные заявки
+    data_dir = tempfile.TemporaryDirectory(prefix="loadtest-")
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_CHAT_IDS": ",".join(map(str, admins)),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+        "RUN_MODE": args.mode,
+        "WEBHOOK_BASE_URL": f"http://127.0.0.1:{bot_port}" if args.mode == "webhook" else "",
+        "WEBHOOK_SECRET": secret,
+        "WEB_SERVER_HOST": "127.0.0.1",
+        "PORT": str(bot_port),
+        # Сценарий шлёт шаги без пауз, как скрипт; антифлуд иначе резал бы каждого пользователя
+        "THROTTLE_RATE": "1000",
+        "THROTTLE_BURST": "1000",
+        # Фейковый API не ограничивает отправку; с реальными лимитами (1 сообщение в секунду в чат)
+        # рассылка админам шла бы минутами после прогона. Проверить их: --env SEND_PER_CHAT_RATE=1
+        "SEND_GLOBAL_RATE": "1000",
+        "SEND_PER_CHAT_RATE": "1000",
+        "WORKER_PROCESSES": str(args.workers),
+        "DB_PATH": os.path.join(data_dir.name, "bot.db"),
+    })
+    env.update(dict(item.split("=", 1) for item in args.env))
+    bot_proc = await asyncio.create_subprocess_exec(
+        sys.executable, args.bot, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+    )
+    try:
+        # Супервизор ставит webhook и открывает порт, когда запущены все воркеры
+        await asyncio.wait_for(api.ready.wait(), timeout=20.0 * args.workers)
+        await wait_port(bot_port, timeout=20.0 * args.workers)
+        baseline_calls = sum(api.calls.values())
+
+        rng = random.Random(args.seed)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        async with LoadGenerator(api, args.mode, f"http://127.0.0.1:{bot_port}/webhook", secret, args.reply_timeout) as gen:
+            async def one(user_id: int):
+                async with semaphore:
+                    await gen.run_user(user_id, build_scenario(rng))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(100000 + i) for i in range(args.users)))
+            elapsed = time.perf_counter() - started
+        # Вызовы на пост считаем после того, как фоновая рассылка админам закончилась
+        admin_pending = await wait_admin_delivery(bot_port, args.drain)
+        stats = gen.stats
+        worker_load = await fetch_worker_load(bot_port) if args.workers > 1 else {}
+    finally:
+        if bot_proc.returncode is None:
+            bot_proc.terminate()
+            await bot_proc.wait()
+        await runner.cleanup()
+        data_dir.cleanup()
+
+    all_latencies = [v for values in stats.latencies.values() for v in values]
+    api_calls = sum(api.calls.values()) - baseline_calls - api.calls["getUpdates"]
+    admin_calls = sum(api.chat_calls[chat_id] for chat_id in admins)
+    admin_messages = sum(api.delivered[chat_id] for chat_id in admins)
+    per_post = lambda value: value / stats.completed if stats.completed else 0
+    return {
+        "mode": args.mode,
+        "workers": args.workers,
+        "worker_load": worker_load,
+        "users": args.users,
+        "completed": stats.completed,
+        "failed": stats.failed,
+        "elapsed": elapsed,
+        "posts_per_sec": stats.completed / elapsed if elapsed else 0,
+        "updates_per_sec": len(all_latencies) / elapsed if elapsed else 0,
+        "p50": percentile(all_latencies, 0.5),
+        "p99": percentile(all_latencies, 0.99),
+        "steps": {step: (percentile(v, 0.5), percentile(v, 0.99), len(v)) for step, v in stats.latencies.items()},
+        "api_calls_per_post": per_post(api_calls),
+        "user_api_calls_per_post": per_post(api_calls - admin_calls),
+        "admin_api_calls_per_post": per_post(admin_calls),
+        "api_calls": dict(api.calls),
+        "admin_messages": admin_messages,
+        "admin_messages_per_post": per_post(admin_messages),
+        "admin_pending": admin_pending,
+        "drain": args.drain,
+        "floods": dict(api.floods),
+        "branches": dict(stats.branches),
+        "errors": dict(stats.errors),
+    }
+
+
+def print_report(r: dict):
+    print(f"mode={r['mode']} workers={r['workers']} users={r['users']} completed={r['completed']} failed={r['failed']} in {r['elapsed']:.2f}s")
+    print(f"throughput: {r['posts_per_sec']:.1f} posts/s, {r['updates_per_sec']:.1f} replies/s")
+    print(f"reply latency: p50={r['p50'] * 1000:.1f}ms p99={r['p99'] * 1000:.1f}ms")
+    for step, (p50, p99, n) in r["steps"].items():
+        print(f"  {step:<15} p50={p50 * 1000:8.1f}ms p99={p99 * 1000:8.1f}ms n={n}")
+    print(
+        f"API calls per completed post: {r['api_calls_per_post']:.2f} "
+        f"(users {r['user_api_calls_per_post']:.2f}, admins {r['admin_api_calls_per_post']:.2f})"
+    )
+    print(f"API calls: {r['api_calls']}")
+    print(f"admin messages: {r['admin_messages']} ({r['admin_messages_per_post']:.2f} per post)")
+    if r["admin_pending"]:
+        print(f"admin delivery INCOMPLETE: {r['admin_pending']} deliveries still queued after {r['drain']:.0f}s, admin numbers are partial")
+    if r["floods"]:
+        print(f"injected 429: {r['floods']}")
+    if r["worker_load"]:
+        print("updates per worker: " + ", ".join(f"{w}={int(n)}" for w, n in sorted(r["worker_load"].items())))
+    print(f"branches: {r['branches']}")
+    if r["errors"]:
+        print(f"errors: {r['errors']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the post bot against a fake Bot API")
+    parser.add_argument("--users", type=int, default=500, help="virtual users, each completes one post")
+    parser.add_argument("--concurrency", type=int, default=100, help="users active at the same time")
+    parser.add_argument("--mode", choices=["webhook", "polling"], default="webhook")
+    parser.add_argument("--workers", type=int, default=1, help="bot worker processes behind the supervisor (webhook mode)")
+    parser.add_argument("--admins", type=int, default=3)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API latency, seconds")
+    parser.add_argument("--api-jitter", type=float, default=0.0, help="extra random latency, seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of send requests answered with 429")
+    parser.add_argument("--flood-scope", choices=["admins", "all"], default="admins")
+    parser.add_argument("--reply-timeout", type=float, default=15.0)
+    parser.add_argument("--drain", type=float, default=60.0, help="max seconds to wait for admin delivery after the run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"))
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the bot process")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show bot logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.workers > 1 and args.mode != "webhook":
+        raise SystemExit("--workers needs --mode webhook")
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,64 @@
 import asyncio
+import html
 import logging
 import os
+import secrets
+import sys
+import time
 from dotenv import load_dotenv
 
+from aiohttp import web
+
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from delivery import Delivery
+from metrics import (
+    ApiMetrics, HandlerMetricsMiddleware, SlowUpdateProfiler, UpdateMetricsMiddleware, metrics_handler, registry,
+)
+from outbox import KIND_ALBUM, KIND_COPY, KIND_DIGEST, KIND_STAGE, STEP_NEW, Job, Outbox, RetryLater
+from middlewares import (
+    PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, AlbumMiddleware, ApiCallCounter, ConcurrencyLimitMiddleware, StateCacheMiddleware,
+    ThrottlingMiddleware, count_api_calls,
+)
+from archive import Archive, Spot, SpotQuery
+from db import SQLiteDB
+from dedup import Deduplicator, submission_fingerprint
+from phash import HammingIndex, PhotoHasher
+import render
+from spatial import GridIndex, format_coordinates, parse_coordinates
+from stats import SubmissionStats, day_key, save_stats
+from storage import SessionTTL, create_storage, sweep_sessions
+from supervisor import Supervisor, serve_worker
 
 # --- Конфигурация и инициализация ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_IDS_STR = os.getenv("ADMIN_CHAT_IDS")
+CHANNEL_ID = int(os.getenv("CHANNEL_ID")) if os.getenv("CHANNEL_ID") else None  # куда публиковать одобренные посты
 OFFER_POST_CHANNEL_URL = os.getenv("OFFER_POST_CHANNEL_URL", "https://t.me/your_channel_link")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер (или локальный стенд)
+
+# Режим запуска: webhook, если задан внешний адрес, иначе long polling
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv("PORT", "8080"))
+RUN_MODE = os.getenv("RUN_MODE", "webhook" if WEBHOOK_BASE_URL else "polling").lower()
+# Несколько процессов: webhook принимает супервизор и раздаёт апдейты воркерам по user id
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))  # задаёт супервизор
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))  # сколько ждать начатые апдейты при остановке воркера, сек
+WORKER_MAX_BACKLOG = int(os.getenv("WORKER_MAX_BACKLOG", "10000"))     # апдейтов в очереди воркера, дальше webhook отвечает 503
 
 if not BOT_TOKEN:
     raise ValueError("Токен бота не найден.")
@@ -26,10 +70,124 @@ try:
 except ValueError:
     raise ValueError("Некорректный формат ADMIN_CHAT_IDS.")
 
+if RUN_MODE not in ("webhook", "polling", "worker"):
+    raise ValueError("RUN_MODE должен быть webhook или polling.")
+if RUN_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    raise ValueError("Для режима webhook нужен WEBHOOK_BASE_URL.")
+if WORKER_PROCESSES > 1 and RUN_MODE == "polling":
+    raise ValueError("Несколько процессов (WORKER_PROCESSES) работают только в режиме webhook.")
+
+ALBUM_LATENCY = float(os.getenv("ALBUM_LATENCY", "0.6"))  # сколько ждать остальные фото альбома, сек
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))      # сообщений в секунду на весь бот
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", "1"))   # сообщений в секунду в один чат
+# Релей: альбом загружается один раз, остальным админам уходит copy_messages
+ADMIN_RELAY = os.getenv("ADMIN_RELAY", "1").lower() in ("1", "true", "yes")
+STAGING_CHAT_ID = int(os.getenv("STAGING_CHAT_ID")) if os.getenv("STAGING_CHAT_ID") else None
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))  # через сколько задание упавшего воркера забирает другой, сек
+# Сводка: вместо альбома на каждую заявку админ получает одно сообщение со списком и кнопками
+DIGEST_MODE = os.getenv("DIGEST_MODE", "0").lower() in ("1", "true", "yes")
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "300"))     # сколько копить заявки, сек
+DIGEST_MAX_ITEMS = int(os.getenv("DIGEST_MAX_ITEMS", "10"))  # или отправлять сразу, когда набралось столько
+# Повторная заявка (тот же водоём, координаты, снасть и фото) в пределах окна не уходит админам
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", str(24 * 3600)))
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", "50000"))
+STATS_SAVE_INTERVAL = float(os.getenv("STATS_SAVE_INTERVAL", "60"))  # как часто сохранять снимок счётчиков /stats, сек
+# Антифлуд: апдейтов в секунду от одного пользователя (и запас на серию), хендлеров одновременно
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+MAX_CONCURRENT_HANDLERS = int(os.getenv("MAX_CONCURRENT_HANDLERS", "50"))
+# Перцептивные хэши фото: ловят повторно присланные скриншоты (нужен Pillow)
+PHOTO_HASH_ENABLED = os.getenv("PHOTO_HASH_ENABLED", "0").lower() in ("1", "true", "yes")
+PHOTO_HASH_WORKERS = int(os.getenv("PHOTO_HASH_WORKERS", "2"))
+PHOTO_HASH_DISTANCE = int(os.getenv("PHOTO_HASH_DISTANCE", "5"))  # бит из 64, при которых фото считаются одинаковыми
+
+# FSM-хранилище: memory (по умолчанию), sqlite (общий файл для нескольких процессов) или redis
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").lower()
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+REDIS_URL = os.getenv("REDIS_URL")
+# Незаконченная сессия удаляется после простоя: FSM_TTL по умолчанию, FSM_STATE_TTLS — для отдельных шагов
+FSM_TTL = float(os.getenv("FSM_TTL", str(6 * 3600)))
+FSM_STATE_TTLS = os.getenv("FSM_STATE_TTLS", "waiting_for_photos=86400,confirm_post=86400")
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "60"))
+
+# Профайлер медленных апдейтов; включается и командой /profile из админского чата
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0").lower() in ("1", "true", "yes")
+PROFILER_THRESHOLD = float(os.getenv("PROFILER_THRESHOLD", "1.0"))  # сек
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(ApiCallCounter())
+bot.session.middleware(ApiMetrics())
+dp = Dispatcher(storage=create_storage(FSM_STORAGE, db_path=DB_PATH, redis_url=REDIS_URL, ttl=SessionTTL.parse(FSM_TTL, FSM_STATE_TTLS)))
+profiler = SlowUpdateProfiler(threshold=PROFILER_THRESHOLD)
+dp.update.outer_middleware(UpdateMetricsMiddleware(profiler))
+state_cache = StateCacheMiddleware()
+# Лимиты Telegram общие на бота, а в админские чаты шлют все воркеры — делим поровну
+delivery = Delivery(global_rate=SEND_GLOBAL_RATE / WORKER_PROCESSES, per_chat_rate=SEND_PER_CHAT_RATE / WORKER_PROCESSES)
+data_db = SQLiteDB(DB_PATH)
+outbox = Outbox(data_db, max_attempts=OUTBOX_MAX_ATTEMPTS, lease=OUTBOX_LEASE)
+archive = Archive(data_db)
+dedup = Deduplicator(window=DEDUP_WINDOW, max_size=DEDUP_MAX_SIZE)
+photo_hasher = PhotoHasher(bot, workers=PHOTO_HASH_WORKERS) if PHOTO_HASH_ENABLED else None
+photo_index = HammingIndex(max_distance=PHOTO_HASH_DISTANCE)
+photo_index_last_id = 0
+photo_index_lock = asyncio.Lock()
+spot_index = GridIndex()
+stats = SubmissionStats(data_db)
+stats_lock = asyncio.Lock()
+spot_index_lock = asyncio.Lock()
+background_jobs: list[asyncio.Task] = []  # постоянные фоновые циклы
+
+# --- Метрики ---
+FSM_LIVE_SESSIONS = registry.gauge("bot_fsm_live_sessions", "FSM sessions in storage")
+FSM_EVICTED_SESSIONS = registry.gauge("bot_fsm_evicted_sessions", "FSM sessions evicted by TTL since start")
+FSM_STORAGE_OPS = registry.gauge("bot_fsm_storage_ops_per_update", "Average FSM storage operations per handled update")
+OUTBOX_DEPTH = registry.gauge("bot_outbox_deliveries", "Outbox deliveries not yet done", ("status",))
+OUTBOX_API_CALLS = registry.counter("bot_outbox_api_calls_total", "Bot API calls spent on admin deliveries")
+SUBMISSION_API_CALLS = registry.histogram(
+    "bot_submission_api_calls", "Bot API calls spent delivering one submission to all admin chats",
+    buckets=(0.5, 1, 2, 3, 5, 8, 13, 21, 34, 55),
+)
+OUTBOX_LAG = registry.gauge("bot_outbox_lag_seconds", "Age of the oldest undelivered submission")
+DEDUP_CHECKS = registry.counter("bot_dedup_checks_total", "Submissions checked for duplicates")
+DEDUP_HITS = registry.counter("bot_dedup_hits_total", "Submissions dropped as duplicates")
+DEDUP_HIT_RATE = registry.gauge("bot_dedup_hit_rate", "Share of submissions dropped as duplicates")
+THROTTLE_DROPPED = registry.gauge("bot_throttle_dropped_updates", "Updates dropped since start", ("reason",))
+HANDLERS_ACTIVE = registry.gauge("bot_handlers_active", "Handlers running under the concurrency cap")
+HANDLERS_WAITING = registry.gauge("bot_handlers_waiting", "Updates waiting for a handler slot")
+PHOTO_REUSE = registry.counter("bot_photo_reuse_total", "Submitted photos similar to earlier submissions")
+MODERATION_ROUND_TRIP = registry.histogram(
+    "bot_moderation_round_trip_seconds", "From a moderation button click to the post being published (or rejected)", ("decision",),
+)
+ADMIN_MESSAGES = registry.counter("bot_admin_messages_total", "Messages sent to admin chats", ("kind",))
+OUTBOX_DELIVERY_LAG = registry.histogram(
+    "bot_outbox_delivery_lag_seconds", "Time from submission to delivery in an admin chat",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+
+async def collect_bot_metrics():
+    storage = dp.storage
+    if hasattr(storage, "live_sessions"):
+        FSM_LIVE_SESSIONS.set(value=storage.live_sessions)
+    elif hasattr(storage, "count_live_sessions"):
+        FSM_LIVE_SESSIONS.set(value=await storage.count_live_sessions())
+    FSM_EVICTED_SESSIONS.set(value=getattr(storage, "evicted", 0))
+    FSM_STORAGE_OPS.set(value=state_cache.storage_ops / state_cache.updates if state_cache.updates else 0)
+    stats = await outbox.stats()
+    for status in ("pending", "processing", "dead"):
+        OUTBOX_DEPTH.set(status, value=stats[status])
+    OUTBOX_LAG.set(value=stats["lag"])
+    THROTTLE_DROPPED.set("user", value=throttling.throttled)
+    THROTTLE_DROPPED.set("shed", value=handler_limit.shed)
+    HANDLERS_ACTIVE.set(value=handler_limit.active)
+    HANDLERS_WAITING.set(value=handler_limit.waiting)
+    DEDUP_HIT_RATE.set(value=dedup.hits / dedup.checks if dedup.checks else 0)
+
+registry.add_collector(collect_bot_metrics)
 
 # --- Определение состояний для FSM ---
 class PostCreation(StatesGroup):
@@ -67,54 +225,207 @@ WATERBODY_MAPPING = {
     "р.Яма": "яма",
     "Норвежское море": "норвежское_море"
 }
+TACKLES = ("Мах", "Спиннинг", "Донка", "Матч", "Морская ловля")
+SPOTS_PAGE_SIZE = 5
 
-# --- Клавиатуры ---
-def get_waterbody_keyboard():
-    buttons = []
-    waterbodies = list(WATERBODY_MAPPING.keys())
-    for i in range(0, len(waterbodies), 2):
-        row = [types.KeyboardButton(text=waterbodies[i])]
-        if i + 1 < len(waterbodies):
-            row.append(types.KeyboardButton(text=waterbodies[i+1]))
-        buttons.append(row)
-    return types.ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
-
-def get_tackle_keyboard():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="Мах"), types.KeyboardButton(text="Спиннинг"), types.KeyboardButton(text="Донка")],
-            [types.KeyboardButton(text="Матч"), types.KeyboardButton(text="Морская ловля")]
-        ], resize_keyboard=True
-    )
+def waterbody_hashtag(slug: str) -> str:
+    return f"#{slug}@rr4world"
+
+# --- Антифлуд ---
+# Состояния, где ждём только нажатие кнопки: прочий текст под нагрузкой можно не обрабатывать
+BUTTON_CHOICES = {
+    PostCreation.waiting_for_waterbody_selection.state: set(WATERBODY_MAPPING),
+    PostCreation.waiting_for_tackle_choice.state: set(TACKLES),
+    PostCreation.waiting_for_comment_choice.state: {"Добавить комментарий", "Пропустить комментарий"},
+}
+# Завершение поста обрабатывается первым
+FINISHING_STATES = {PostCreation.waiting_for_photos.state, PostCreation.confirm_post.state}
 
-def get_clip_skip_keyboard():
-    return types.ReplyKeyboardMarkup(keyboard=[[types.KeyboardButton(text="Пропустить клипсу")]], resize_keyboard=True)
+def update_priority(event: types.TelegramObject, raw_state: str | None) -> int:
+    if raw_state in FINISHING_STATES:
+        return PRIORITY_HIGH  # и сообщения, и нажатия inline-кнопок
+    if not isinstance(event, types.Message):
+        return PRIORITY_NORMAL
+    text = event.text or ""
+    if text.startswith("/start") and raw_state == PostCreation.waiting_for_waterbody_selection.state:
+        return PRIORITY_LOW  # повторный /start: анкета и так только что начата
+    choices = BUTTON_CHOICES.get(raw_state)
+    if choices is not None and text not in choices and not text.startswith("/") and text.lower() != "отмена":
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
 
-def get_comment_choice_keyboard():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[[types.KeyboardButton(text="Добавить комментарий")], [types.KeyboardButton(text="Пропустить комментарий")]],
-        resize_keyboard=True
-    )
+def throttle_exempt(event: types.TelegramObject, raw_state: str | None) -> bool:
+    # Фото поста приходят пачкой, в том числе без альбома — ведро на них не тратим
+    return raw_state == PostCreation.waiting_for_photos.state and isinstance(event, types.Message) and bool(event.photo)
 
-def get_photo_keyboard(has_photos: bool):
-    buttons = []
-    if has_photos:
-        buttons.append([types.KeyboardButton(text="Готово")])
-    return types.ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+throttling = ThrottlingMiddleware(rate=THROTTLE_RATE, burst=THROTTLE_BURST, exempt=throttle_exempt)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
+# Лимит хендлеров — после буфера альбомов: части альбома слот не занимают и не ждут в очереди
+handler_limit = ConcurrencyLimitMiddleware(max_concurrent=MAX_CONCURRENT_HANDLERS, classify=update_priority)
+dp.message.middleware(AlbumMiddleware(latency=ALBUM_LATENCY))
+dp.message.middleware(handler_limit)
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.message.middleware(state_cache)
+dp.callback_query.middleware(handler_limit)
+
+# --- Клавиатуры ---
+# Собираются один раз: разметка не меняется, а aiogram сериализует её на каждой отправке
+WATERBODY_KEYBOARD = render.reply_keyboard(render.chunked(list(WATERBODY_MAPPING), 2))
+TACKLE_KEYBOARD = render.reply_keyboard([TACKLES[:3], TACKLES[3:]])
 
 # --- Обработчики ---
 
 @dp.message(CommandStart())
 async def command_start_handler(message: types.Message, state: FSMContext):
     await state.clear()
-    await message.answer("Привет! <b>1. Выберите водоем:</b>", reply_markup=get_waterbody_keyboard())
+    await message.answer("Привет! <b>1. Выберите водоем:</b>", reply_markup=WATERBODY_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_waterbody_selection)
 
 @dp.message(Command("cancel"))
 @dp.message(F.text.lower() == "отмена")
 async def cmd_cancel(message: types.Message, state: FSMContext):
     await state.clear()
-    await message.answer("Отменено. Начните заново с /start.", reply_markup=types.ReplyKeyboardRemove())
+    await message.answer("Отменено. Начните заново с /start.", reply_markup=render.REMOVE_KEYBOARD)
+
+@dp.message(Command("profile"), F.chat.id.in_(ADMIN_CHAT_IDS))
+async def cmd_profile(message: types.Message):
+    # /profile on [порог, сек] | /profile off
+    args = (message.text or "").split()[1:]
+    if args and args[0] == "off":
+        profiler.stop()
+        await message.answer("Профайлер выключен.")
+        return
+    try:
+        threshold = float(args[1]) if len(args) > 1 else None
+    except ValueError:
+        await message.answer("Порог укажите числом, в секундах.")
+        return
+    profiler.start(threshold)
+    await message.answer(f"Профайлер включён, порог {profiler.threshold} с.")
+
+# --- Поиск по архиву точек ---
+WATERBODY_SLUGS = list(WATERBODY_MAPPING.values())
+
+class SpotsPage(CallbackData, prefix="sp"):
+    # Водоём и снасть — индексы в WATERBODY_SLUGS и TACKLES: кириллица в UTF-8 не влезает в 64 байта callback_data
+    water: int | None = None
+    tackle: int | None = None
+    nick: str = ""
+    before: int = 0   # страница старше этого id
+    after: int = 0    # страница новее этого id
+
+def _find_waterbody(text: str) -> tuple[str | None, str]:
+    # Название водоёма может быть из нескольких слов: берём самое длинное совпадение в начале
+    folded = text.casefold()
+    for name in sorted(WATERBODY_MAPPING, key=len, reverse=True):
+        slug = WATERBODY_MAPPING[name]
+        for alias in (name.casefold(), slug):
+            if folded == alias or folded.startswith(alias + " "):
+                return slug, text[len(alias):].strip()
+    return None, text
+
+def _format_spot(spot: Spot) -> str:
+    text = f"<b>{html.escape(spot.waterbody_name)}</b> · {html.escape(spot.coordinates)} · {html.escape(spot.tackle)}"
+    if spot.clip and spot.clip != "Нет клипсы": text += f" · клипса {html.escape(spot.clip)}"
+    if spot.depth: text += f" · глубина {html.escape(spot.depth)}"
+    if spot.temperature: text += f" · {html.escape(spot.temperature)}°"
+    date = time.strftime("%d.%m.%Y", time.localtime(spot.created_at))
+    return f"{text}\n{html.escape(spot.game_nickname)}, {date}"
+
+async def _spots_page(page: SpotsPage) -> tuple[str, types.InlineKeyboardMarkup | None]:
+    query = SpotQuery(
+        waterbody_hashtag=waterbody_hashtag(WATERBODY_SLUGS[page.water]) if page.water is not None else None,
+        tackle=TACKLES[page.tackle] if page.tackle is not None else None, nickname=page.nick or None,
+    )
+    spots = await archive.find(query, SPOTS_PAGE_SIZE, before=page.before or None, after=page.after or None)
+    if not spots:
+        return "Ничего не найдено.", None
+
+    buttons = []
+    nav = [("◀ Новее", {"after": spots[0].id, "before": 0}, {"after": spots[0].id}),
+           ("Старше ▶", {"before": spots[-1].id, "after": 0}, {"before": spots[-1].id})]
+    for label, update, cursor in nav:
+        if await archive.exists(query, **cursor):
+            try:
+                buttons.append(types.InlineKeyboardButton(text=label, callback_data=page.model_copy(update=update).pack()))
+            except ValueError:
+                pass  # слишком длинный ник не влезает в 64 байта callback_data
+    text = "\n\n".join(_format_spot(s) for s in spots)
+    return text, types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+@dp.message(Command("spots"))
+async def cmd_spots(message: types.Message, command: CommandObject):
+    slug, rest = _find_waterbody((command.args or "").strip())
+    tackle = rest if rest in TACKLES else None
+    if slug is None or (rest and tackle is None):
+        await message.answer("Использование: /spots &lt;водоём&gt; [снасть], например <code>/spots оз.Медное Мах</code>")
+        return
+    page = SpotsPage(water=WATERBODY_SLUGS.index(slug), tackle=TACKLES.index(tackle) if tackle else None)
+    text, kb = await _spots_page(page)
+    await message.answer(text, reply_markup=kb)
+
+@dp.message(Command("by"))
+async def cmd_by(message: types.Message, command: CommandObject):
+    nick = (command.args or "").strip()
+    if not nick:
+        await message.answer("Использование: /by &lt;игровой ник&gt;")
+        return
+    text, kb = await _spots_page(SpotsPage(nick=nick))
+    await message.answer(text, reply_markup=kb)
+
+NEARBY_DEFAULT_RADIUS = 10
+NEARBY_MAX_RADIUS = 50
+
+@dp.message(Command("nearby"))
+async def cmd_nearby(message: types.Message, command: CommandObject):
+    usage = "Использование: /nearby &lt;водоём&gt; &lt;x:y&gt; [радиус], например <code>/nearby оз.Медное 75:42 5</code>"
+    slug, rest = _find_waterbody((command.args or "").strip())
+    point, radius = parse_coordinates(rest), NEARBY_DEFAULT_RADIUS
+    if point is None and " " in rest:
+        head, _, tail = rest.rpartition(" ")
+        point = parse_coordinates(head)
+        radius = float(tail) if tail.replace(".", "", 1).isdigit() else None
+    if slug is None or point is None or radius is None:
+        await message.answer(usage)
+        return
+    radius = min(radius, NEARBY_MAX_RADIUS)
+    await _sync_spot_index()  # точки, записанные другими воркерами
+    found = spot_index.nearby(waterbody_hashtag(slug), *point, radius=radius, limit=SPOTS_PAGE_SIZE * 2)
+    if not found:
+        await message.answer(f"В радиусе {radius:g} от {format_coordinates(*point)} точек нет.")
+        return
+    spots = await archive.get_many(item_id for _, item_id in found)
+    lines = [f"{_format_spot(spots[item_id])}\n≈ {distance:.1f} от {format_coordinates(*point)}" for distance, item_id in found if item_id in spots]
+    await message.answer("\n\n".join(lines))
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    # Всё берётся из готовых счётчиков: время ответа не зависит от размера архива.
+    # Сначала дочитываем заявки, записанные другими воркерами (один запрос по индексу id)
+    await _sync_stats()
+    lines = [f"<b>📊 Статистика заявок</b>\nВсего: {stats.total}", "\n<b>Водоёмы:</b>"]
+    waterbodies = sorted(((stats.by_waterbody.get(name, 0), name) for name in WATERBODY_MAPPING), reverse=True)
+    lines += [f"{name} — {count}" for count, name in waterbodies if count]
+    lines.append("\n<b>Снасти:</b>")
+    lines += [f"{tackle} — {stats.by_tackle.get(tackle, 0)}" for tackle in TACKLES]
+    lines.append("\n<b>Последние 7 дней:</b>")
+    now = time.time()
+    for i in range(7):
+        day = day_key(now - i * 86400)
+        lines.append(f"{day[8:10]}.{day[5:7]} — {stats.by_day.get(day, 0)}")
+    top = stats.nicknames.top()
+    if top:
+        lines.append("\n<b>Топ авторов:</b>")
+        lines += [f"{i}. {html.escape(nick)} — {count}" for i, (nick, count) in enumerate(top, 1)]
+    await message.answer("\n".join(lines))
+
+@dp.callback_query(SpotsPage.filter())
+async def spots_page_callback(callback: types.CallbackQuery, callback_data: SpotsPage):
+    text, kb = await _spots_page(callback_data)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
 
 @dp.message(PostCreation.waiting_for_waterbody_selection, F.text)
 async def process_waterbody_selection(message: types.Message, state: FSMContext):
@@ -122,87 +433,120 @@ async def process_waterbody_selection(message: types.Message, state: FSMContext)
         await message.answer("Выберите водоем кнопкой.")
         return
     
-    hashtag = f"#{WATERBODY_MAPPING[message.text]}@rr4world"
+    hashtag = waterbody_hashtag(WATERBODY_MAPPING[message.text])
     await state.update_data(waterbody_name=message.text, waterbody_hashtag=hashtag)
     
-    await message.answer("<b>2. Введите координаты:</b>", reply_markup=types.ReplyKeyboardRemove())
+    await message.answer("<b>2. Введите координаты:</b>", reply_markup=render.REMOVE_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_coordinates)
 
 @dp.message(PostCreation.waiting_for_coordinates, F.text)
 async def process_coordinates(message: types.Message, state: FSMContext):
-    await state.update_data(coordinates=message.text)
-    await message.answer("<b>3. Выберите снасть:</b>", reply_markup=get_tackle_keyboard())
+    parsed = parse_coordinates(message.text)
+    if parsed is None:
+        await message.answer("Не понял координаты. Введите два числа, например <code>75:42</code> или <code>75 42</code>.")
+        return
+    x, y = parsed
+    await state.update_data(coordinates=format_coordinates(x, y), coord_x=x, coord_y=y)
+    await message.answer("<b>3. Выберите снасть:</b>", reply_markup=TACKLE_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_tackle_choice)
 
-@dp.message(PostCreation.waiting_for_tackle_choice, F.text.in_({"Мах", "Спиннинг", "Донка", "Матч", "Морская ловля"}))
+@dp.message(PostCreation.waiting_for_tackle_choice, F.text.in_(TACKLES))
 async def process_tackle_choice(message: types.Message, state: FSMContext):
     tackle = message.text
     await state.update_data(tackle=tackle)
     if tackle == "Мах":
-        await message.answer("<b>4. Укажите глубину:</b>", reply_markup=types.ReplyKeyboardRemove())
+        await message.answer("<b>4. Укажите глубину:</b>", reply_markup=render.REMOVE_KEYBOARD)
         await state.set_state(PostCreation.waiting_for_depth)
     else:
-        await message.answer("<b>4. Укажите клипсу:</b>", reply_markup=get_clip_skip_keyboard())
+        await message.answer("<b>4. Укажите клипсу:</b>", reply_markup=render.CLIP_SKIP_KEYBOARD)
         await state.set_state(PostCreation.waiting_for_clip)
 
 @dp.message(PostCreation.waiting_for_clip, F.text)
 async def process_clip(message: types.Message, state: FSMContext):
     clip = "Нет клипсы" if message.text == "Пропустить клипсу" else message.text
-    await state.update_data(clip=clip)
     data = await state.get_data()
+    if not await _fits_caption(message, {**data, "clip": clip}, "Клипса"):
+        return
+    await state.update_data(clip=clip)
     if data.get('tackle') == "Матч":
-        await message.answer("<b>Теперь укажите глубину:</b>", reply_markup=types.ReplyKeyboardRemove())
+        await message.answer("<b>Теперь укажите глубину:</b>", reply_markup=render.REMOVE_KEYBOARD)
         await state.set_state(PostCreation.waiting_for_depth)
     else:
         await _check_temp_or_comment(message, state)
 
 @dp.message(PostCreation.waiting_for_depth, F.text)
 async def process_depth(message: types.Message, state: FSMContext):
+    if not await _fits_caption(message, {**await state.get_data(), "depth": message.text}, "Глубина"):
+        return
     await state.update_data(depth=message.text)
     await _check_temp_or_comment(message, state)
 
+async def _fits_caption(message: types.Message, data: dict, field: str) -> bool:
+    # Подпись альбома ограничена 1024 символами: каждое поле проверяем на своём шаге (с запасом под ник),
+    # чтобы просить сократить именно то, что не влезло
+    overflow = render.caption_overflow(data)
+    if overflow:
+        await message.answer(f"{field} не помещается в подпись к фото. Сократите на {overflow} симв. и отправьте снова.")
+    return not overflow
+
 async def _check_temp_or_comment(message: types.Message, state: FSMContext):
     data = await state.get_data()
     if data.get('waterbody_name') == "оз.Медное":
-        await message.answer("<b>5. Укажите температуру воды:</b>", reply_markup=types.ReplyKeyboardRemove())
+        await message.answer("<b>5. Укажите температуру воды:</b>", reply_markup=render.REMOVE_KEYBOARD)
         await state.set_state(PostCreation.waiting_for_temperature)
     else:
-        await message.answer("<b>5. Добавить комментарий?</b>", reply_markup=get_comment_choice_keyboard())
+        await message.answer("<b>5. Добавить комментарий?</b>", reply_markup=render.COMMENT_CHOICE_KEYBOARD)
         await state.set_state(PostCreation.waiting_for_comment_choice)
 
 @dp.message(PostCreation.waiting_for_temperature, F.text)
 async def process_temperature(message: types.Message, state: FSMContext):
+    if not await _fits_caption(message, {**await state.get_data(), "temperature": message.text}, "Температура"):
+        return
     await state.update_data(temperature=message.text)
-    await message.answer("<b>6. Добавить комментарий?</b>", reply_markup=get_comment_choice_keyboard())
+    await message.answer("<b>6. Добавить комментарий?</b>", reply_markup=render.COMMENT_CHOICE_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_comment_choice)
 
 @dp.message(PostCreation.waiting_for_comment_choice, F.text == "Добавить комментарий")
 async def add_com(message: types.Message,state: FSMContext):
-    await message.answer("Введите комментарий:", reply_markup=types.ReplyKeyboardRemove())
+    await message.answer("Введите комментарий:", reply_markup=render.REMOVE_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_comment)
 
 @dp.message(PostCreation.waiting_for_comment_choice, F.text == "Пропустить комментарий")
 @dp.message(PostCreation.waiting_for_comment, F.text)
 async def skip_or_fill_com(message: types.Message, state: FSMContext):
     if message.text != "Пропустить комментарий":
+        if not await _fits_caption(message, {**await state.get_data(), "comment": message.text}, "Комментарий"):
+            return
         await state.update_data(comment=message.text)
-    await message.answer("<b>7. Ваш игровой ник:</b>", reply_markup=types.ReplyKeyboardRemove())
+    await message.answer("<b>7. Ваш игровой ник:</b>", reply_markup=render.REMOVE_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_game_nickname)
 
 @dp.message(PostCreation.waiting_for_game_nickname, F.text)
 async def process_nick(message: types.Message, state: FSMContext):
+    # Поля до ника влезли с запасом под ник, так что перебор здесь — из-за ника.
+    # Комментарий при нехватке места обрежется, поэтому его не учитываем
+    if not await _fits_caption(message, {**await state.get_data(), "comment": None, "game_nickname": message.text}, "Ник"):
+        return
     await state.update_data(game_nickname=message.text)
-    await message.answer("<b>8. Прикрепите фото улова</b> (Обязательно):\nЗагрузите фото и нажмите 'Готово'.", reply_markup=get_photo_keyboard(False))
+    await message.answer("<b>8. Прикрепите фото улова</b> (Обязательно):\nЗагрузите фото и нажмите 'Готово'.", reply_markup=render.PHOTO_KEYBOARD)
     await state.set_state(PostCreation.waiting_for_photos)
 
 @dp.message(PostCreation.waiting_for_photos, F.photo)
-async def process_photos(message: types.Message, state: FSMContext):
+async def process_photos(message: types.Message, state: FSMContext, album: list[types.Message] | None = None):
+    # Альбом приходит одним вызовом из AlbumMiddleware: одна запись в state и один ответ
     data = await state.get_data()
     photos = data.get('photos', [])
-    if len(photos) < 10:
-        photos.append(message.photo[-1].file_id)
-        await state.update_data(photos=photos)
-    await message.answer(f"Фото добавлено ({len(photos)}/10).", reply_markup=get_photo_keyboard(True))
+    free = 10 - len(photos)
+    new = [m.photo[-1] for m in (album or [message])][:max(free, 0)]
+    if new:
+        # file_unique_id не меняется при пересылке — по нему ищем повторные заявки
+        photos = photos + [p.file_id for p in new]
+        photo_uids = data.get('photo_uids', []) + [p.file_unique_id for p in new]
+        await state.update_data(photos=photos, photo_uids=photo_uids)
+        if photo_hasher is not None:
+            for p in new:
+                photo_hasher.schedule(p.file_id, p.file_unique_id)
+    await message.answer(f"Фото добавлено ({len(photos)}/10).", reply_markup=render.PHOTO_DONE_KEYBOARD)
 
 @dp.message(PostCreation.waiting_for_photos, F.text == "Готово")
 async def photo_done(message: types.Message, state: FSMContext):
@@ -214,52 +558,477 @@ async def photo_done(message: types.Message, state: FSMContext):
 
 async def _send_review(message: types.Message, state: FSMContext):
     d = await state.get_data()
-    text = f"<b>Предпросмотр:</b>\n\n<b>Локация:</b> {d['waterbody_hashtag']}\n<b>Координаты:</b> {d['coordinates']}\n"
-    if d.get('clip') and d['clip'] != "Нет клипсы": text += f"<b>Клипса:</b> {d['clip']}\n"
-    if d.get('depth'): text += f"<b>Глубина:</b> {d['depth']}\n"
-    if d.get('temperature'): text += f"<b>Температура:</b> {d['temperature']}\n"
-    if d.get('comment'): text += f"<b>Комментарий:</b>\n<blockquote>{d['comment']}</blockquote>\n"
-    text += f"<b>Ник:</b> {d['game_nickname']}"
-
-    kb = types.ReplyKeyboardMarkup(keyboard=[[types.KeyboardButton(text="Отправить пост")], [types.KeyboardButton(text="Редактировать")], [types.KeyboardButton(text="Отмена")]], resize_keyboard=True)
-    
-    media = [types.InputMediaPhoto(media=d['photos'][0], caption=text)]
-    for p in d['photos'][1:]: media.append(types.InputMediaPhoto(media=p))
-    await message.answer_media_group(media=media)
-    await message.answer("Все верно?", reply_markup=kb)
+    await message.answer_media_group(media=render.album(d['photos'], render.preview_caption(d)))
+    await message.answer("Все верно?", reply_markup=render.CONFIRM_KEYBOARD)
     await state.set_state(PostCreation.confirm_post)
 
 @dp.message(PostCreation.confirm_post, F.text == "Отправить пост")
 async def final_send(message: types.Message, state: FSMContext):
     d = await state.get_data()
-    post_text = f"<b>Локация:</b> {d['waterbody_hashtag']}\n<b>Координаты:</b> {d['coordinates']}\n"
-    if d.get('clip') and d['clip'] != "Нет клипсы": post_text += f"<b>Клипса:</b> {d['clip']}\n"
-    if d.get('depth'): post_text += f"<b>Глубина:</b> {d['depth']}\n"
-    if d.get('temperature'): post_text += f"<b>Температура:</b> {d['temperature']}\n"
-    if d.get('comment'): post_text += f"<b>Комментарий:</b>\n<blockquote>{d['comment']}</blockquote>\n"
-    post_text += f"<b>Игровой ник:</b> {d['game_nickname']}\n\n🎁 Автору отправлено 200 кофе\n<a href='{OFFER_POST_CHANNEL_URL}'>ПРЕДЛОЖИТЬ ПОСТ</a>"
-
-    user_link = f"<a href='tg://user?id={message.from_user.id}'>{message.from_user.full_name}</a>"
-    username = f"@{message.from_user.username}" if message.from_user.username else f"ID: {message.from_user.id}"
-    service_info = f"<b>👤 Отправитель:</b> {user_link} ({username})"
-
-    for admin_id in ADMIN_CHAT_IDS:
-        try:
-            media = [types.InputMediaPhoto(media=d['photos'][0], caption=post_text)]
-            for p in d['photos'][1:]: media.append(types.InputMediaPhoto(media=p))
-            await bot.send_media_group(chat_id=admin_id, media=media)
-            await bot.send_message(chat_id=admin_id, text=service_info)
-        except Exception as e: logging.error(f"Error sending to admin {admin_id}: {e}")
+    post_text = render.post_caption(d, OFFER_POST_CHANNEL_URL)
+    service_info = render.sender_info(message.from_user.id, message.from_user.full_name, message.from_user.username)
 
-    await message.answer("Отправлено на модерацию!", reply_markup=types.ReplyKeyboardRemove())
+    # Двойное нажатие или повтор той же точки с теми же фото не рассылаем админам ещё раз.
+    # Окно в памяти отсекает дубли этого процесса без запроса к базе; окончательно проверяет outbox
+    # при записи — он общий для всех воркеров и переживает рестарт
+    fingerprint = submission_fingerprint(
+        d['waterbody_hashtag'], d.get('coord_x'), d.get('coord_y'), d['tackle'], d.get('photo_uids') or d['photos'],
+    )
+    DEDUP_CHECKS.inc()
+    if dedup.seen(fingerprint):
+        await _reject_duplicate(message, state)
+        return
+
+    submission_id = f"{message.chat.id}:{message.message_id}"
+    photo_hashes = {}
+    if photo_hasher is not None and d.get('photo_uids'):
+        photo_hashes = await photo_hasher.hashes(zip(d['photos'], d['photo_uids']))
+        service_info += await _photo_reuse_warnings(submission_id, message.from_user.id, d['photo_uids'], photo_hashes)
+
+    # Заявка сначала ложится в outbox, админам её разносят фоновые воркеры
+    spot = {k: d.get(k) for k in ARCHIVE_FIELDS}
+    payload = {
+        "photos": d['photos'], "post_text": post_text, "service_info": service_info,
+        "user_id": message.from_user.id, "spot": spot, "fingerprint": fingerprint,
+    }
+    try:
+        created = await outbox.enqueue(
+            submission_id, payload, _delivery_targets(), source_chat_id=_relay_source(), fingerprint=fingerprint, dedup_window=DEDUP_WINDOW,
+        )
+    except Exception:
+        dedup.forget(fingerprint)
+        raise
+    if not created:
+        await _reject_duplicate(message, state)  # тот же пост уже записал другой воркер
+        return
+    archive.add(submission_id, message.from_user.id, spot)
+    if photo_hashes:
+        await archive.add_photo_hashes(submission_id, message.from_user.id, photo_hashes)
+
+    await message.answer("Отправлено на модерацию!", reply_markup=render.REMOVE_KEYBOARD)
+    await state.clear()
+
+async def _reject_duplicate(message: types.Message, state: FSMContext):
+    DEDUP_HITS.inc()
+    await message.answer("Эта точка с этими же фото уже отправлена на модерацию.", reply_markup=render.REMOVE_KEYBOARD)
     await state.clear()
 
+async def _photo_reuse_warnings(submission_id: str, user_id: int, photo_uids: list[str], hashes: dict[str, int]) -> str:
+    """Ищет похожие фото в прошлых заявках и возвращает строки-предупреждения для админов."""
+    if not hashes:
+        return ""
+    await _sync_photo_index()
+    lines = []
+    for number, uid in enumerate(photo_uids, 1):
+        if uid not in hashes:
+            continue
+        matches = [(dist, item) for dist, item in photo_index.search(hashes[uid]) if item[0] != submission_id]
+        if not matches:
+            continue
+        PHOTO_REUSE.inc()
+        dist, (other_id, other_user, ts) = matches[0]
+        when = time.strftime("%d.%m.%Y", time.localtime(ts))
+        who = "тот же автор" if other_user == user_id else f"ID: {other_user}"
+        lines.append(f"\n⚠️ Фото {number} похоже на присланное {when} ({who}, отличие {dist} бит)")
+    return "".join(lines)
+
+async def _sync_photo_index():
+    # Как и точки на карте, хэши дочитываем из базы (их могли записать другие процессы)
+    global photo_index_last_id
+    async with photo_index_lock:
+        while True:
+            rows = await archive.photo_hashes_since(photo_index_last_id)
+            if not rows:
+                break
+            for row_id, submission_id, value, user_id, ts in rows:
+                photo_index.add(value, (submission_id, user_id, ts))
+            photo_index_last_id = rows[-1][0]
+
+ARCHIVE_FIELDS = (
+    "waterbody_name", "waterbody_hashtag", "coordinates", "coord_x", "coord_y",
+    "tackle", "clip", "depth", "temperature", "comment", "game_nickname", "photos",
+)
+
+def _relay_source() -> int | None:
+    if not ADMIN_RELAY or DIGEST_MODE:
+        return None
+    return STAGING_CHAT_ID or ADMIN_CHAT_IDS[0]
+
+def _delivery_targets() -> list[tuple[int, str]]:
+    # Релей: альбом загружается один раз (в служебный чат или первому админу), остальным — copy_messages
+    if DIGEST_MODE:
+        return [(admin_id, KIND_DIGEST) for admin_id in ADMIN_CHAT_IDS]
+    source = _relay_source()
+    if source is None:
+        return [(admin_id, KIND_ALBUM) for admin_id in ADMIN_CHAT_IDS]
+    targets = [(STAGING_CHAT_ID, KIND_STAGE)] if STAGING_CHAT_ID else []
+    targets += [(admin_id, KIND_ALBUM if admin_id == source else KIND_COPY) for admin_id in ADMIN_CHAT_IDS]
+    return targets
+
+async def deliver_job(job: Job):
+    with count_api_calls() as calls:
+        try:
+            await _deliver_job(job)
+        finally:
+            # Неудачные попытки тоже стоят вызовов: считаем их до повтора
+            await _account_api_calls(job.submission_id, sum(calls.values()))
+    logging.info(f"Submission {job.submission_id} delivered to {job.chat_id}, API calls: {dict(calls)}")
+
+async def _account_api_calls(submission_id: str, calls: float):
+    # Стоимость заявки копится в outbox по всем чатам, попыткам и процессам; в гистограмму — когда доставлена всем
+    OUTBOX_API_CALLS.inc(value=calls)
+    try:
+        total = await outbox.add_api_calls(submission_id, calls)
+    except Exception as e:
+        logging.warning(f"API call accounting for {submission_id} failed: {e}")
+        return
+    if total is not None:
+        SUBMISSION_API_CALLS.observe(value=total)
+        logging.info(f"Submission {submission_id} delivered to all admins, API calls: {total:g}")
+
+async def _deliver_job(job: Job):
+    p = job.payload
+    if job.step == STEP_NEW:
+        if job.kind == KIND_COPY and not job.source_message_ids:
+            status = await outbox.delivery_status(job.submission_id, job.source_chat_id)
+            if status == "dead":
+                logging.error(f"Relay source {job.source_chat_id} failed, sending album directly to {job.chat_id}")
+                await outbox.set_kind(job, KIND_ALBUM)
+            else:
+                raise RetryLater("waiting for relay source", delay=0.5, count_attempt=False)
+
+        if job.kind == KIND_COPY:
+            res = await delivery.send(
+                job.chat_id,
+                lambda: bot.copy_messages(chat_id=job.chat_id, from_chat_id=job.source_chat_id, message_ids=job.source_message_ids),
+                cost=len(job.source_message_ids),
+            )
+        else:
+            media = render.album(p['photos'], p['post_text'])
+            res = await delivery.send(job.chat_id, lambda: bot.send_media_group(chat_id=job.chat_id, media=media), cost=len(media))
+        if not res.ok:
+            raise RetryLater(res.error)
+        ADMIN_MESSAGES.inc(job.kind, value=len(res.result))
+        await outbox.media_sent(job, [m.message_id for m in res.result])
+
+    control_message_id = None
+    if job.kind != KIND_STAGE:
+        res = await delivery.send(
+            job.chat_id,
+            lambda: bot.send_message(chat_id=job.chat_id, text=p['service_info'], reply_markup=_moderation_keyboard(job.submission_id)),
+        )
+        if not res.ok:
+            raise RetryLater(res.error)
+        ADMIN_MESSAGES.inc(job.kind)
+        control_message_id = res.result.message_id
+    await outbox.done(job, control_message_id)
+    OUTBOX_DELIVERY_LAG.observe(value=time.time() - job.created_at)
+
+# --- Модерация ---
+class ModerationAction(CallbackData, prefix="md"):
+    action: str  # ok — одобрить (и опубликовать), no — отклонить, show — прислать альбом, done — уже решено
+    sid: str     # id заявки, ":" заменено на "_" (двоеточие — разделитель CallbackData)
+
+DECISIONS = {"ok": "approved", "no": "rejected"}
+DECISION_LABELS = {"approved": "✅ опубликовано" if CHANNEL_ID else "✅ одобрено", "rejected": "❌ отклонено"}
+
+def _callback_sid(submission_id: str) -> str:
+    return submission_id.replace(":", "_")
+
+def _moderation_keyboard(submission_id: str) -> types.InlineKeyboardMarkup:
+    sid = _callback_sid(submission_id)
+    return types.InlineKeyboardMarkup(inline_keyboard=[[
+        types.InlineKeyboardButton(text="Опубликовать" if CHANNEL_ID else "Одобрить", callback_data=ModerationAction(action="ok", sid=sid).pack()),
+        types.InlineKeyboardButton(text="Отклонить", callback_data=ModerationAction(action="no", sid=sid).pack()),
+    ]])
+
+def _digest_line(number: int, job: Job) -> str:
+    spot, p = job.payload.get("spot") or {}, job.payload
+    return (
+        f"\n<b>{number}.</b> {spot.get('waterbody_hashtag')} · {spot.get('coordinates')} · {spot.get('tackle')} · "
+        f"{html.escape(spot.get('game_nickname') or '')} · 📷{len(p['photos'])}\n{p['service_info']}"
+    )
+
+def _digest_text(jobs: list[Job]) -> str:
+    return "\n".join([f"<b>📋 Заявки на модерацию: {len(jobs)}</b>"] + [_digest_line(number, job) for number, job in enumerate(jobs, 1)])
+
+def _digest_fit(jobs: list[Job]) -> int:
+    """Сколько первых заявок влезает в одно сообщение сводки (хотя бы одна)."""
+    # Заголовок считаем с полным числом заявок: с меньшим он не длиннее
+    length = render.visible_length(f"<b>📋 Заявки на модерацию: {len(jobs)}</b>")
+    for count, job in enumerate(jobs):
+        length += 1 + render.visible_length(_digest_line(count + 1, job))
+        if length > render.MESSAGE_LIMIT:
+            return max(count, 1)
+    return len(jobs)
+
+def _digest_keyboard(items: list[tuple[str, str | None]]) -> types.InlineKeyboardMarkup:
+    # items — (submission_id, решение); решённые строки показывают итог вместо кнопок
+    rows = []
+    for number, (submission_id, decision) in enumerate(items, 1):
+        sid = _callback_sid(submission_id)
+        show = types.InlineKeyboardButton(text=f"🖼 {number}", callback_data=ModerationAction(action="show", sid=sid).pack())
+        if decision in DECISION_LABELS:
+            rows.append([
+                types.InlineKeyboardButton(text=f"{number}. {DECISION_LABELS[decision]}", callback_data=ModerationAction(action="done", sid=sid).pack()),
+                show,
+            ])
+        else:
+            rows.append([
+                types.InlineKeyboardButton(text=f"✅ {number}", callback_data=ModerationAction(action="ok", sid=sid).pack()),
+                types.InlineKeyboardButton(text=f"❌ {number}", callback_data=ModerationAction(action="no", sid=sid).pack()),
+                show,
+            ])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def digest_loop():
+    # Сводка уходит, когда набралось DIGEST_MAX_ITEMS заявок; остаток — когда самая старая ждёт DIGEST_WINDOW
+    while True:
+        try:
+            for chat_id, count, oldest in await outbox.digest_backlog():
+                expired = time.time() - oldest >= DIGEST_WINDOW
+                batches = -(-count // DIGEST_MAX_ITEMS) if expired else count // DIGEST_MAX_ITEMS
+                for _ in range(batches):
+                    if not await _send_digest(chat_id):
+                        break
+        except Exception as e:
+            logging.error(f"Digest loop failed: {e}")
+        await asyncio.sleep(min(DIGEST_WINDOW / 4, 5))
+
+async def _send_digest(chat_id: int) -> bool:
+    jobs = await outbox.claim_digest(chat_id, DIGEST_MAX_ITEMS)
+    if not jobs:
+        return False
+    # Длинные service_info (предупреждения о повторных фото) не должны вывести сводку за лимит сообщения:
+    # что не влезло, возвращаем в очередь без траты попытки — уйдёт следующей сводкой
+    fit = _digest_fit(jobs)
+    for job in jobs[fit:]:
+        await outbox.retry(job, "digest message limit", delay=0, count_attempt=False)
+    jobs = jobs[:fit]
+    with count_api_calls() as calls:
+        async with outbox.holding(jobs):
+            res = await delivery.send(
+                chat_id, lambda: bot.send_message(chat_id=chat_id, text=_digest_text(jobs), reply_markup=_digest_keyboard([(job.submission_id, None) for job in jobs])),
+            )
+    if res.ok:
+        ADMIN_MESSAGES.inc(KIND_DIGEST)
+        await outbox.digest_sent(jobs, res.result.message_id)
+    else:
+        for job in jobs:
+            await outbox.retry(job, res.error)
+    for job in jobs:
+        # Сводка — одно сообщение на несколько заявок: её стоимость делится поровну
+        await _account_api_calls(job.submission_id, sum(calls.values()) / len(jobs))
+        if res.ok:
+            OUTBOX_DELIVERY_LAG.observe(value=time.time() - job.created_at)
+    return res.ok
+
+@dp.callback_query(ModerationAction.filter(), F.message.chat.id.in_(ADMIN_CHAT_IDS))
+async def moderation_callback(callback: types.CallbackQuery, callback_data: ModerationAction):
+    started = time.perf_counter()
+    submission_id = callback_data.sid.replace("_", ":")
+    chat_id = callback.message.chat.id
+    if callback_data.action == "show":
+        # Полный альбом — только по запросу, в тот чат, где нажали
+        p = await outbox.get_submission(submission_id)
+        if p is None:
+            await callback.answer("Заявка не найдена.")
+            return
+        await callback.answer()
+        media = render.album(p['photos'], p['post_text'])
+        res = await delivery.send(chat_id, lambda: bot.send_media_group(chat_id=chat_id, media=media), cost=len(media))
+        if res.ok:
+            ADMIN_MESSAGES.inc("on_request", value=len(media))
+        return
+
+    if callback_data.action not in DECISIONS:
+        decision, decided_by = await outbox.decision(submission_id)
+        await callback.answer(f"Уже обработано: {DECISION_LABELS.get(decision, 'не найдена')} (ID: {decided_by})")
+        return
+
+    # Решение фиксируется атомарно в общей базе: из нескольких админов побеждает первый
+    won, decision, decided_by = await outbox.decide(submission_id, DECISIONS[callback_data.action], callback.from_user.id)
+    if not won:
+        await callback.answer(f"Уже обработано: {DECISION_LABELS.get(decision, 'не найдена')} (ID: {decided_by})")
+        return
+    if decision == "approved" and CHANNEL_ID:
+        if not await _publish(submission_id):
+            await outbox.undecide(submission_id, callback.from_user.id)
+            await callback.answer("Не удалось опубликовать, попробуйте ещё раз.", show_alert=True)
+            return
+    MODERATION_ROUND_TRIP.observe(decision, value=time.perf_counter() - started)
+    await callback.answer(f"Заявка: {DECISION_LABELS[decision]}")
+    admin = f"<a href='tg://user?id={callback.from_user.id}'>{html.escape(callback.from_user.full_name)}</a>"
+    await _update_control_messages(submission_id, decision, admin)
+
+async def _publish(submission_id: str) -> bool:
+    # Альбом уже загружен в чат админа: копируем его в канал вместо повторной загрузки
+    album = await outbox.uploaded_album(submission_id)
+    if album is not None:
+        from_chat_id, message_ids = album
+        res = await delivery.send(
+            CHANNEL_ID, lambda: bot.copy_messages(chat_id=CHANNEL_ID, from_chat_id=from_chat_id, message_ids=message_ids),
+            cost=len(message_ids),
+        )
+    else:
+        p = await outbox.get_submission(submission_id)
+        media = render.album(p['photos'], p['post_text'])
+        res = await delivery.send(CHANNEL_ID, lambda: bot.send_media_group(chat_id=CHANNEL_ID, media=media), cost=len(media))
+    if not res.ok:
+        logging.error(f"Publish {submission_id} to {CHANNEL_ID} failed: {res.error}")
+    return res.ok
+
+async def _update_control_messages(submission_id: str, decision: str, admin: str):
+    # Кнопки у всех админов заменяются итогом: кто и что сделал с заявкой
+    p = await outbox.get_submission(submission_id)
+    text = f"{p['service_info']}\n\n<b>{DECISION_LABELS[decision]}</b> — {admin}"
+
+    async def edit(chat_id: int, kind: str, message_id: int):
+        if kind == KIND_DIGEST:
+            markup = _digest_keyboard(await outbox.digest_items(chat_id, message_id))
+            call = lambda: bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
+        else:
+            call = lambda: bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        res = await delivery.send(chat_id, call)
+        if not res.ok:
+            logging.warning(f"Moderation message {chat_id}/{message_id} not updated: {res.error}")
+
+    await asyncio.gather(*(edit(*row) for row in await outbox.control_messages(submission_id)))
+
 @dp.message(PostCreation.confirm_post, F.text == "Редактировать")
 async def edit_back(message: types.Message, state: FSMContext):
     await command_start_handler(message, state)
 
-async def main():
-    await dp.start_polling(bot)
+# --- Запуск ---
+@dp.startup()
+async def start_background_jobs():
+    if PROFILER_ENABLED:
+        profiler.start()
+    if hasattr(dp.storage, "purge_expired"):
+        background_jobs.append(asyncio.create_task(sweep_sessions(dp.storage, FSM_SWEEP_INTERVAL)))
+    await outbox.setup()
+    await archive.setup()
+    await _backfill_archive()
+    await _restore_dedup()
+    await stats.setup()
+    if not await stats.load():
+        stats.merge(await archive.aggregate_all())
+    archive.on_flush = _on_archive_flush
+    await _on_archive_flush()
+    background_jobs.append(asyncio.create_task(save_stats(stats, STATS_SAVE_INTERVAL)))
+    if photo_hasher is not None:
+        await _sync_photo_index()
+    outbox.start(deliver_job, OUTBOX_WORKERS)
+    if DIGEST_MODE and WORKER_INDEX == 0:
+        # Сводку собирает один процесс, иначе воркеры делили бы заявки на несколько сводок
+        background_jobs.append(asyncio.create_task(digest_loop()))
+
+async def _backfill_archive():
+    # Архив пишется пачками; то, что не успело попасть в него до падения, берём из outbox.
+    # Ищем именно заявки без строки в архиве: по времени нельзя — другой процесс мог записать более поздние
+    items = [(sid, ts, p.get("user_id"), p["spot"]) for sid, ts, p in await archive.unarchived() if "spot" in p]
+    if items:
+        await archive.add_many(items)
+        logging.info(f"Archive backfilled from outbox: {len(items)} submissions checked")
+
+async def _restore_dedup():
+    # После рестарта окно дедупликации восстанавливаем по недавним заявкам из outbox
+    for _, ts, p in await outbox.submissions_since(time.time() - DEDUP_WINDOW):
+        if "fingerprint" in p:
+            dedup.remember(p["fingerprint"], ts)
+
+async def _on_archive_flush():
+    await _sync_spot_index()
+    await _sync_stats()
+
+async def _sync_stats():
+    # Счётчики /stats дочитывают архив после last_id: и свои заявки, и записанные другими процессами
+    async with stats_lock:
+        while rows := await archive.stats_rows_since(stats.last_id):
+            for row in rows:
+                stats.add(*row)
+
+async def _sync_spot_index():
+    # Дочитываем из архива точки после последнего проиндексированного id (в т.ч. записанные другими процессами)
+    async with spot_index_lock:
+        while True:
+            rows = await archive.points_since(spot_index.last_id)
+            if not rows:
+                break
+            for item_id, hashtag, x, y, coordinates in rows:
+                if x is None:
+                    x, y = parse_coordinates(coordinates) or (None, None)
+                if x is not None:
+                    spot_index.add(hashtag, x, y, item_id)
+            spot_index.last_id = rows[-1][0]
+
+@dp.shutdown()
+async def stop_background_jobs():
+    for task in background_jobs:
+        task.cancel()
+    background_jobs.clear()
+    await outbox.stop()
+    await archive.close()
+    await stats.save()
+    if photo_hasher is not None:
+        photo_hasher.close()
+    profiler.stop()
+
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f"Webhook установлен: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    # handle_in_background: Telegram получает 200 сразу, апдейт обрабатывается отдельной задачей
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    app.router.add_get("/metrics", metrics_handler)
+    return app
+
+async def run_polling():
+    # В режиме polling веб-сервер отдаёт только /metrics (и держит порт web-процесса)
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT).start()
+    try:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+
+def run_supervisor():
+    if FSM_STORAGE == "memory":
+        logging.warning("FSM_STORAGE=memory with several workers: a restarted worker loses its users' unfinished posts")
+    supervisor = Supervisor(
+        WORKER_PROCESSES, [sys.executable, os.path.abspath(__file__)], dict(os.environ, RUN_MODE="worker"),
+        max_backlog=WORKER_MAX_BACKLOG, drain_timeout=WORKER_DRAIN_TIMEOUT,
+    )
+    app = supervisor.web_app(WEBHOOK_PATH, WEBHOOK_SECRET)
+
+    async def _set_webhook(app: web.Application):
+        await on_webhook_startup(bot)
+        await bot.session.close()
+
+    app.on_startup.append(_set_webhook)
+    web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+
+def main():
+    if RUN_MODE == "worker":
+        asyncio.run(serve_worker(dp, bot, drain_timeout=WORKER_DRAIN_TIMEOUT))
+    elif RUN_MODE == "webhook" and WORKER_PROCESSES > 1:
+        run_supervisor()
+    elif RUN_MODE == "webhook":
+        dp.startup.register(on_webhook_startup)
+        web.run_app(build_web_app(), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    else:
+        asyncio.run(run_polling())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
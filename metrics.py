@@ -0,0 +1,256 @@
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _Counter, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware, Bot, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: Sequence[Tuple[str, Any]] = ()) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+    def dec(self, *labels: str, value: float = 1):
+        self.inc(*labels, value=-value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, *labels: str, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+        self.collectors: List[Callable[[], Awaitable[None]]] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Awaitable[None]]):
+        """Коллектор обновляет гауги прямо перед выдачей /metrics."""
+        self.collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                await collector()
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_DURATION = registry.histogram("bot_handler_duration_seconds", "Handler latency", ("state", "handler"))
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Handler exceptions", ("state", "handler"))
+UPDATES_TOTAL = registry.counter("bot_updates_total", "Updates received")
+UPDATES_IN_PROGRESS = registry.gauge("bot_updates_in_progress", "Updates accepted but not finished (queue depth)")
+API_REQUESTS = registry.counter("bot_api_requests_total", "Bot API requests", ("method",))
+API_ERRORS = registry.counter("bot_api_errors_total", "Bot API requests that raised", ("method",))
+API_FLOOD_WAITS = registry.counter("bot_api_flood_waits_total", "Bot API 429 responses", ("method",))
+API_DURATION = registry.histogram("bot_api_request_duration_seconds", "Bot API request latency", ("method",))
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешняя мидлварь на update: счётчик и глубина очереди, профилирование медленных апдейтов."""
+
+    def __init__(self, profiler: Optional["SlowUpdateProfiler"] = None):
+        self.profiler = profiler
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]) -> Any:
+        UPDATES_TOTAL.inc()
+        UPDATES_IN_PROGRESS.inc()
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATES_IN_PROGRESS.dec()
+            if self.profiler is not None and self.profiler.enabled:
+                self.profiler.check(event, started, time.monotonic())
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренняя мидлварь: время хендлера по состоянию FSM и имени функции."""
+
+    async def __call__(self, handler, event: types.TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        state = data.get("raw_state") or "none"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(state, name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(state, name, value=time.perf_counter() - started)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        name = method.__api_method__
+        API_REQUESTS.inc(name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            API_FLOOD_WAITS.inc(name)
+            API_ERRORS.inc(name)
+            raise
+        except Exception:
+            API_ERRORS.inc(name)
+            raise
+        finally:
+            API_DURATION.observe(name, value=time.perf_counter() - started)
+
+
+class SlowUpdateProfiler:
+    """Сэмплирующий профайлер: пока включён, раз в `interval` секунд снимает стек
+    потока event loop и пишет в лог самые частые стеки апдейтов дольше `threshold`.
+    """
+
+    def __init__(self, interval: float = 0.005, threshold: float = 1.0, max_samples: int = 20000):
+        self.interval = interval
+        self.threshold = threshold
+        self._samples: deque = deque(maxlen=max_samples)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._target: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def start(self, threshold: Optional[float] = None):
+        if threshold is not None:
+            self.threshold = threshold
+        if self._thread is not None:
+            return
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="slow-update-profiler", daemon=True)
+        self._thread.start()
+        logging.info(f"Profiler enabled, threshold {self.threshold}s")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._samples.clear()
+        logging.info("Profiler disabled")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < 30:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rpartition('/')[2]}:{frame.f_lineno} {code.co_name}")
+                frame = frame.f_back
+            self._samples.append((time.monotonic(), tuple(stack)))
+
+    def check(self, update: types.Update, started: float, finished: float):
+        if finished - started < self.threshold:
+            return
+        stacks = _Counter(stack for ts, stack in list(self._samples) if started <= ts <= finished)
+        lines = [f"{count:5d}  " + " <- ".join(stack[:8]) for stack, count in stacks.most_common(5)]
+        logging.warning(
+            f"Slow update id={update.update_id}: {finished - started:.3f}s, {sum(stacks.values())} samples\n" + "\n".join(lines)
+        )
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    body = (await registry.render()).encode()
+    return web.Response(body=body, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -0,0 +1,333 @@
+import asyncio
+import copy
+import heapq
+import itertools
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware, Bot, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from delivery import TokenBucket
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """Собирает фото одного альбома (media_group_id) и вызывает хендлер один раз.
+
+    Первое сообщение группы ждёт `latency` секунд, пока дойдут остальные,
+    и передаёт весь список в хендлер через data["album"]. Остальные сообщения
+    группы только дописываются в буфер.
+    """
+
+    def __init__(self, latency: float = 0.6):
+        self.latency = latency
+        self._albums: Dict[str, List[types.Message]] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Message, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not event.media_group_id:
+            return await handler(event, data)
+
+        key = f"{event.chat.id}:{event.media_group_id}"
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+
+        self._albums[key] = album = [event]
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self._albums.pop(key, None)
+        album.sort(key=lambda m: m.message_id)
+        data["album"] = album
+        return await handler(event, data)
+
+
+# --- Антифлуд и ограничение нагрузки ---
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Антифлуд на пользователя (внешняя мидлварь).
+
+    У каждого пользователя свой token bucket (`rate` апдейтов в секунду, запас
+    `burst`); сверх него апдейты молча отбрасываются, а пользователь получает
+    одно предупреждение на всю серию. Альбом считается одним апдейтом; апдейты,
+    для которых `exempt(event, raw_state)` истинно, ведро не тратят.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        burst: float = 5,
+        exempt: Optional[Callable[[types.TelegramObject, Optional[str]], bool]] = None,
+        notice: str = "Слишком много сообщений, подождите пару секунд.",
+        max_buckets: int = 10000,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.exempt = exempt
+        self.notice = notice
+        self.max_buckets = max_buckets
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._noticed: Set[int] = set()
+        self._albums: Dict[int, str] = {}  # последний альбом пользователя: его фото считаются одним апдейтом
+        self.throttled = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and not (self.exempt and self.exempt(event, data.get("raw_state"))) and not self._allow(user.id, event):
+            self.throttled += 1
+            if user.id not in self._noticed:
+                self._noticed.add(user.id)
+                await self._send_notice(event)
+            return None
+        return await handler(event, data)
+
+    def _allow(self, user_id: int, event: types.TelegramObject) -> bool:
+        media_group_id = getattr(event, "media_group_id", None)
+        if media_group_id is not None:
+            if self._albums.get(user_id) == media_group_id:
+                return True
+            self._albums[user_id] = media_group_id
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._evict_idle()
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if bucket.try_acquire():
+            self._noticed.discard(user_id)
+            return True
+        return False
+
+    def _evict_idle(self):
+        for user_id in [u for u, b in self._buckets.items() if b.is_full()]:
+            del self._buckets[user_id]
+            self._albums.pop(user_id, None)
+            self._noticed.discard(user_id)
+
+    async def _send_notice(self, event: types.TelegramObject):
+        try:
+            if isinstance(event, (types.Message, types.CallbackQuery)):
+                await event.answer(self.notice)
+        except Exception as e:
+            logging.warning(f"Throttle notice failed: {e}")
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Общий лимит одновременно работающих хендлеров (внутренняя мидлварь).
+
+    Хендлеров одновременно работает не больше `max_concurrent`: при перегрузке
+    апдейты с низким приоритетом сбрасываются сразу, остальные ждут в очереди,
+    высокий приоритет — первым. Приоритет апдейта определяет
+    `classify(event, raw_state)`. Регистрируется после AlbumMiddleware: части
+    альбома только дописываются в буфер и слот не занимают.
+    """
+
+    def __init__(self, max_concurrent: int = 50, classify: Optional[Callable[[types.TelegramObject, Optional[str]], int]] = None):
+        self.max_concurrent = max_concurrent
+        self.classify = classify
+        self._active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.shed = 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        priority = self.classify(event, data.get("raw_state")) if self.classify else PRIORITY_NORMAL
+        if not await self._enter(priority):
+            self.shed += 1
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            self._leave()
+
+    async def _enter(self, priority: int) -> bool:
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return True
+        if priority >= PRIORITY_LOW:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот мог быть передан нам в момент отмены — вернём его следующему
+            if future.done() and not future.cancelled():
+                self._leave()
+            raise
+        return True
+
+    def _leave(self):
+        # Слот переходит к следующему ожидающему, счётчик активных не меняется
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self._active -= 1
+
+
+# --- Кэш состояния на время одного апдейта ---
+class CachedFSMContext(FSMContext):
+    """FSMContext, который читает хранилище один раз и пишет обратно один раз в flush()."""
+
+    _MISSING = object()
+
+    def __init__(self, context: FSMContext):
+        super().__init__(storage=context.storage, key=context.key)
+        self._data: Optional[Dict[str, Any]] = None
+        self._state: Any = self._MISSING
+        self._data_dirty = False
+        self._state_dirty = False
+        self.storage_ops = 0
+
+    async def _load_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+            self.storage_ops += 1
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_state(self) -> Optional[str]:
+        if self._state is self._MISSING:
+            self._state = await self.storage.get_state(key=self.key)
+            self.storage_ops += 1
+        return self._state
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        self._data = copy.deepcopy(dict(data))
+        self._data_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        return copy.deepcopy(await self._load_data())
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return copy.deepcopy((await self._load_data()).get(key, default))
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        current = await self._load_data()
+        if data:
+            kwargs.update(data)
+        current.update(copy.deepcopy(kwargs))
+        self._data_dirty = True
+        return copy.deepcopy(current)
+
+    async def clear(self) -> None:
+        await self.set_state(None)
+        await self.set_data({})
+
+    async def flush(self) -> None:
+        if self._state_dirty:
+            await self.storage.set_state(key=self.key, state=self._state)
+            self.storage_ops += 1
+            self._state_dirty = False
+        if self._data_dirty:
+            await self.storage.set_data(key=self.key, data=self._data)
+            self.storage_ops += 1
+            self._data_dirty = False
+
+
+class StateCacheMiddleware(BaseMiddleware):
+    """Подменяет data["state"] на CachedFSMContext и пишет изменения после хендлера.
+
+    Запись откладывается до конца хендлера, поэтому апдейты одного ключа FSM
+    выполняются по очереди: иначе параллельный апдейт (фото, присланные по
+    одному) прочитал бы данные до записи и затёр бы её своей. Между процессами
+    апдейты пользователя не пересекаются: супервизор держит его на одном воркере.
+    """
+
+    def __init__(self):
+        self.updates = 0
+        self.storage_ops = 0
+        self._locks: Dict[Any, List[Any]] = {}  # ключ FSM -> [замок, сколько апдейтов его держат или ждут]
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+
+        entry = self._locks.setdefault(context.key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Ждали другой апдейт — прочитанное FSM-мидлварью состояние могло устареть
+            fresh = not entry[0].locked()
+            async with entry[0]:
+                cached = CachedFSMContext(context)
+                if fresh:
+                    # Состояние уже прочитано FSM-мидлварью для фильтров, повторно не ходим
+                    cached._state = data.get("raw_state")
+                data["state"] = cached
+                try:
+                    return await handler(event, data)
+                finally:
+                    await cached.flush()
+                    self.updates += 1
+                    self.storage_ops += cached.storage_ops
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[context.key]
+
+
+# --- Подсчёт запросов к Bot API ---
+_api_calls: ContextVar[Optional[Counter]] = ContextVar("api_calls", default=None)
+
+
+@contextmanager
+def count_api_calls():
+    """Считает запросы к Bot API внутри блока (и в задачах, созданных из него)."""
+    counter = Counter()
+    token = _api_calls.set(counter)
+    try:
+        yield counter
+    finally:
+        _api_calls.reset(token)
+
+
+class ApiCallCounter(BaseRequestMiddleware):
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        counter = _api_calls.get()
+        if counter is not None:
+            counter[method.__api_method__] += 1
+        return await make_request(bot, method)
@@ -0,0 +1,465 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from db import SQLiteDB
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    source_chat_id INTEGER,
+    source_message_ids TEXT,
+    decision TEXT,
+    decided_by INTEGER,
+    decided_at REAL,
+    api_calls REAL NOT NULL DEFAULT 0,
+    api_calls_reported INTEGER NOT NULL DEFAULT 0,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS submissions_fingerprint ON submissions (fingerprint, created_at);
+CREATE TABLE IF NOT EXISTS deliveries (
+    submission_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    step INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    owner TEXT,
+    message_ids TEXT,
+    last_error TEXT,
+    delivered_at REAL,
+    control_message_id INTEGER,
+    PRIMARY KEY (submission_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS deliveries_ready ON deliveries (status, next_attempt_at);
+"""
+
+# Доставка в чат проходит шаги: 0 — ничего не отправлено, 1 — медиа отправлено, 2 — готово.
+# Шаг фиксируется в базе сразу после успешного вызова API, поэтому после рестарта
+# уже отправленное не повторяется.
+STEP_NEW, STEP_MEDIA_SENT, STEP_DONE = 0, 1, 2
+
+# kind: album — загрузить альбом; copy — скопировать альбом из чата-источника; stage — только альбом в служебный чат;
+# digest — строка в сводке, которую собирает отдельный цикл, а не воркеры
+KIND_ALBUM, KIND_COPY, KIND_STAGE, KIND_DIGEST = "album", "copy", "stage", "digest"
+
+
+class RetryLater(Exception):
+    """Доставку нужно повторить позже; `delay` — через сколько секунд (None — по backoff)."""
+
+    def __init__(self, message: str, delay: Optional[float] = None, count_attempt: bool = True):
+        super().__init__(message)
+        self.delay = delay
+        self.count_attempt = count_attempt
+
+
+class LeaseLost(Exception):
+    """Аренда задания истекла и его забрал другой воркер: дальше делает он."""
+
+
+@dataclass
+class Job:
+    submission_id: str
+    chat_id: int
+    kind: str
+    step: int
+    attempts: int
+    payload: Dict[str, Any]
+    created_at: float
+    source_chat_id: Optional[int]
+    source_message_ids: Optional[List[int]]
+    message_ids: Optional[List[int]]
+
+
+class Outbox:
+    """Надёжная очередь отправок на модерацию в SQLite.
+
+    Заявка сначала записывается в базу, потом разбирается воркерами с
+    повторами, backoff и dead-letter. Забор задания атомарный (UPDATE ...
+    RETURNING), поэтому воркеры нескольких процессов не берут одно и то же.
+    Пока задание в работе, аренда продлевается; чужое задание (аренда
+    истекла и его забрали) воркер не отмечает.
+    """
+
+    def __init__(self, db: SQLiteDB, max_attempts: int = 8, lease: float = 60, poll_interval: float = 1.0):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+    async def setup(self):
+        columns = (
+            ("submissions", "decision", "TEXT"), ("submissions", "decided_by", "INTEGER"), ("submissions", "decided_at", "REAL"),
+            ("deliveries", "control_message_id", "INTEGER"),
+            ("submissions", "api_calls", "REAL NOT NULL DEFAULT 0"), ("submissions", "api_calls_reported", "INTEGER NOT NULL DEFAULT 0"),
+            ("submissions", "fingerprint", "TEXT"),
+        )
+        for table, column, kind in columns:
+            try:
+                await self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+            except sqlite3.OperationalError:
+                pass  # колонка уже есть или таблицы ещё нет
+        await self.db.executescript(_SCHEMA)
+
+    async def enqueue(
+        self, submission_id: str, payload: Dict[str, Any], targets: Sequence[Tuple[int, str]], source_chat_id: Optional[int] = None,
+        fingerprint: Optional[str] = None, dedup_window: float = 0,
+    ) -> bool:
+        """Записывает заявку и её доставки. Повтор с тем же id ничего не делает (идемпотентность).
+
+        Заявка с тем же `fingerprint`, записанная за последние `dedup_window` секунд
+        любым процессом, — дубль: ничего не пишется. False — заявка не записана.
+        """
+        now = time.time()
+
+        def _run(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Проверка и вставка в одной транзакции IMMEDIATE: два процесса не запишут один дубль дважды
+                if fingerprint is not None and dedup_window > 0 and conn.execute(
+                    "SELECT 1 FROM submissions WHERE fingerprint = ? AND created_at > ? LIMIT 1", (fingerprint, now - dedup_window),
+                ).fetchone():
+                    conn.execute("ROLLBACK")
+                    return False
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO submissions (id, payload, created_at, source_chat_id, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                    (submission_id, json.dumps(payload, ensure_ascii=False), now, source_chat_id, fingerprint),
+                )
+                if cur.rowcount:
+                    conn.executemany(
+                        "INSERT INTO deliveries (submission_id, chat_id, kind, next_attempt_at) VALUES (?, ?, ?, ?)",
+                        [(submission_id, chat_id, kind, now) for chat_id, kind in targets],
+                    )
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return cur.rowcount > 0
+
+        created = await self.db.run(_run)
+        if created:
+            self._wakeup.set()
+        return created
+
+    async def claim(self) -> Optional[Job]:
+        now = time.time()
+        # fetchall: RETURNING-запрос должен быть дочитан, иначе транзакция не закроется
+        rows = await self.db.fetchall(
+            """
+            UPDATE deliveries SET status = 'processing', owner = ?, lease_until = ?, attempts = attempts + 1
+            WHERE rowid = (
+                SELECT rowid FROM deliveries
+                WHERE ((status = 'pending' AND next_attempt_at <= ?) OR (status = 'processing' AND lease_until < ?))
+                    AND kind != 'digest'
+                ORDER BY next_attempt_at LIMIT 1
+            )
+            RETURNING submission_id, chat_id, kind, step, attempts, message_ids
+            """,
+            (self.owner, now + self.lease, now, now),
+        )
+        if not rows:
+            return None
+        return (await self._jobs(rows))[0]
+
+    async def _jobs(self, rows: List[tuple]) -> List[Job]:
+        subs = await self.db.fetchall(
+            f"SELECT id, payload, created_at, source_chat_id, source_message_ids FROM submissions WHERE id IN ({', '.join('?' * len(rows))})",
+            tuple({row[0] for row in rows}),
+        )
+        subs = {sub[0]: sub[1:] for sub in subs}
+        jobs = []
+        for submission_id, chat_id, kind, step, attempts, message_ids in rows:
+            payload, created_at, source_chat_id, source_message_ids = subs[submission_id]
+            jobs.append(Job(
+                submission_id=submission_id, chat_id=chat_id, kind=kind, step=step, attempts=attempts,
+                payload=json.loads(payload), created_at=created_at, source_chat_id=source_chat_id,
+                source_message_ids=json.loads(source_message_ids) if source_message_ids else None,
+                message_ids=json.loads(message_ids) if message_ids else None,
+            ))
+        return jobs
+
+    # --- Сводки ---
+    async def digest_backlog(self) -> List[Tuple[int, int, float]]:
+        """Ожидающие строки сводок по чатам: (chat_id, сколько, время самой старой заявки)."""
+        now = time.time()
+        return await self.db.fetchall(
+            "SELECT d.chat_id, COUNT(*), MIN(s.created_at) FROM deliveries d JOIN submissions s ON s.id = d.submission_id "
+            "WHERE d.kind = 'digest' AND ((d.status = 'pending' AND d.next_attempt_at <= ?) OR (d.status = 'processing' AND d.lease_until < ?)) "
+            "GROUP BY d.chat_id",
+            (now, now),
+        )
+
+    async def claim_digest(self, chat_id: int, limit: int) -> List[Job]:
+        """Атомарно забирает до `limit` строк сводки для одного чата (старые первыми)."""
+        now = time.time()
+        rows = await self.db.fetchall(
+            """
+            UPDATE deliveries SET status = 'processing', owner = ?, lease_until = ?, attempts = attempts + 1
+            WHERE rowid IN (
+                SELECT rowid FROM deliveries
+                WHERE chat_id = ? AND kind = 'digest'
+                    AND ((status = 'pending' AND next_attempt_at <= ?) OR (status = 'processing' AND lease_until < ?))
+                ORDER BY next_attempt_at LIMIT ?
+            )
+            RETURNING submission_id, chat_id, kind, step, attempts, message_ids
+            """,
+            (self.owner, now + self.lease, chat_id, now, now, limit),
+        )
+        jobs = await self._jobs(rows) if rows else []
+        jobs.sort(key=lambda job: job.created_at)
+        return jobs
+
+    async def digest_sent(self, jobs: Sequence[Job], message_id: int):
+        now = time.time()
+        await self.db.transaction([(
+            "UPDATE deliveries SET step = ?, status = 'done', delivered_at = ?, control_message_id = ?, "
+            "lease_until = NULL, owner = NULL, last_error = NULL WHERE submission_id = ? AND chat_id = ? AND owner = ?",
+            [(STEP_DONE, now, message_id, job.submission_id, job.chat_id, self.owner) for job in jobs],
+        )])
+
+    async def digest_items(self, chat_id: int, message_id: int) -> List[Tuple[str, Optional[str]]]:
+        """Заявки одной сводки в исходном порядке: (submission_id, решение)."""
+        return await self.db.fetchall(
+            "SELECT s.id, s.decision FROM deliveries d JOIN submissions s ON s.id = d.submission_id "
+            "WHERE d.chat_id = ? AND d.control_message_id = ? AND d.kind = 'digest' ORDER BY s.created_at",
+            (chat_id, message_id),
+        )
+
+    # --- Решения модераторов ---
+    async def control_messages(self, submission_id: str) -> List[Tuple[int, str, int]]:
+        """Сообщения с кнопками по заявке во всех чатах: (chat_id, kind, message_id)."""
+        return await self.db.fetchall(
+            "SELECT chat_id, kind, control_message_id FROM deliveries WHERE submission_id = ? AND control_message_id IS NOT NULL",
+            (submission_id,),
+        )
+
+    async def uploaded_album(self, submission_id: str) -> Optional[Tuple[int, List[int]]]:
+        """Чат и id уже отправленного альбома заявки (источник для copy_messages), если есть."""
+        row = await self.db.fetchone(
+            "SELECT d.chat_id, d.message_ids FROM deliveries d JOIN submissions s ON s.id = d.submission_id "
+            "WHERE d.submission_id = ? AND d.message_ids IS NOT NULL ORDER BY d.chat_id = s.source_chat_id DESC LIMIT 1",
+            (submission_id,),
+        )
+        return (row[0], json.loads(row[1])) if row else None
+
+    async def get_submission(self, submission_id: str) -> Optional[Dict[str, Any]]:
+        row = await self.db.fetchone("SELECT payload FROM submissions WHERE id = ?", (submission_id,))
+        return json.loads(row[0]) if row else None
+
+    async def decide(self, submission_id: str, decision: str, admin_id: int) -> Tuple[bool, Optional[str], Optional[int]]:
+        """Атомарно фиксирует решение по заявке. Возвращает (успех, решение, кто решил);
+        если заявку уже обработал другой админ — (False, его решение, его id)."""
+        rows = await self.db.fetchall(
+            "UPDATE submissions SET decision = ?, decided_by = ?, decided_at = ? WHERE id = ? AND decision IS NULL "
+            "RETURNING decision, decided_by",
+            (decision, admin_id, time.time(), submission_id),
+        )
+        if rows:
+            return True, rows[0][0], rows[0][1]
+        return (False, *await self.decision(submission_id))
+
+    async def undecide(self, submission_id: str, admin_id: int):
+        """Снимает решение (например, публикация не удалась), чтобы заявку можно было обработать снова."""
+        await self.db.execute(
+            "UPDATE submissions SET decision = NULL, decided_by = NULL, decided_at = NULL WHERE id = ? AND decided_by = ?",
+            (submission_id, admin_id),
+        )
+
+    async def decision(self, submission_id: str) -> Tuple[Optional[str], Optional[int]]:
+        row = await self.db.fetchone("SELECT decision, decided_by FROM submissions WHERE id = ?", (submission_id,))
+        return (row[0], row[1]) if row else (None, None)
+
+    async def media_sent(self, job: Job, message_ids: List[int]):
+        """Фиксирует шаг 1; если это чат-источник, сохраняет id сообщений для копирования."""
+        ids = json.dumps(message_ids)
+
+        def _run(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                owned = conn.execute(
+                    "UPDATE deliveries SET step = ?, message_ids = ? WHERE submission_id = ? AND chat_id = ? AND owner = ?",
+                    (STEP_MEDIA_SENT, ids, job.submission_id, job.chat_id, self.owner),
+                ).rowcount
+                if owned and job.chat_id == job.source_chat_id:
+                    conn.execute("UPDATE submissions SET source_message_ids = ? WHERE id = ?", (ids, job.submission_id))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return owned
+
+        if not await self.db.run(_run):
+            raise LeaseLost(f"{job.submission_id} -> {job.chat_id}")
+        job.step, job.message_ids = STEP_MEDIA_SENT, message_ids
+        self._wakeup.set()  # копии у других админов могли ждать этот альбом
+
+    async def done(self, job: Job, control_message_id: Optional[int] = None):
+        """Фиксирует доставку; control_message_id — сообщение с кнопками модерации в этом чате."""
+        owned = await self.db.execute(
+            "UPDATE deliveries SET step = ?, status = 'done', delivered_at = ?, control_message_id = ?, "
+            "lease_until = NULL, owner = NULL, last_error = NULL WHERE submission_id = ? AND chat_id = ? AND owner = ?",
+            (STEP_DONE, time.time(), control_message_id, job.submission_id, job.chat_id, self.owner),
+        )
+        if not owned:
+            raise LeaseLost(f"{job.submission_id} -> {job.chat_id}")
+
+    async def retry(self, job: Job, error: str, delay: Optional[float] = None, count_attempt: bool = True):
+        attempts = job.attempts if count_attempt else job.attempts - 1
+        if attempts >= self.max_attempts:
+            logging.error(f"Outbox dead letter {job.submission_id} -> {job.chat_id}: {error}")
+            status, next_at = "dead", time.time()
+        else:
+            status = "pending"
+            next_at = time.time() + (delay if delay is not None else min(2 ** attempts, 300))
+        await self.db.execute(
+            "UPDATE deliveries SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, lease_until = NULL, owner = NULL "
+            "WHERE submission_id = ? AND chat_id = ? AND owner = ?",
+            (status, attempts, next_at, error, job.submission_id, job.chat_id, self.owner),
+        )
+
+    async def set_kind(self, job: Job, kind: str):
+        await self.db.execute(
+            "UPDATE deliveries SET kind = ? WHERE submission_id = ? AND chat_id = ? AND owner = ?",
+            (kind, job.submission_id, job.chat_id, self.owner),
+        )
+        job.kind = kind
+
+    async def delivery_status(self, submission_id: str, chat_id: int) -> Optional[str]:
+        row = await self.db.fetchone(
+            "SELECT status FROM deliveries WHERE submission_id = ? AND chat_id = ?", (submission_id, chat_id)
+        )
+        return row[0] if row else None
+
+    async def submissions_since(self, created_at: float) -> List[Tuple[str, float, Dict[str, Any]]]:
+        rows = await self.db.fetchall(
+            "SELECT id, created_at, payload FROM submissions WHERE created_at >= ? ORDER BY created_at", (created_at,)
+        )
+        return [(sid, ts, json.loads(payload)) for sid, ts, payload in rows]
+
+    async def add_api_calls(self, submission_id: str, calls: float) -> Optional[float]:
+        """Добавляет вызовы Bot API к стоимости заявки (по всем чатам, попыткам и процессам).
+
+        Возвращает итог ровно один раз — когда все доставки заявки завершены; иначе None.
+        """
+        def _run(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("UPDATE submissions SET api_calls = api_calls + ? WHERE id = ?", (calls, submission_id))
+                row = conn.execute(
+                    "UPDATE submissions SET api_calls_reported = 1 WHERE id = ? AND api_calls_reported = 0 AND NOT EXISTS "
+                    "(SELECT 1 FROM deliveries WHERE submission_id = ? AND status NOT IN ('done', 'dead')) RETURNING api_calls",
+                    (submission_id, submission_id),
+                ).fetchone()
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return row[0] if row else None
+
+        return await self.db.run(_run)
+
+    async def release(self):
+        """Возвращает в очередь задания, взятые этим процессом (при штатной остановке)."""
+        await self.db.execute(
+            "UPDATE deliveries SET status = 'pending', attempts = MAX(attempts - 1, 0), lease_until = NULL, owner = NULL "
+            "WHERE status = 'processing' AND owner = ?",
+            (self.owner,),
+        )
+
+    async def stats(self) -> Dict[str, float]:
+        """Глубина очереди по статусам и возраст самой старой недоставленной заявки (lag)."""
+        rows = await self.db.fetchall("SELECT status, COUNT(*) FROM deliveries WHERE status != 'done' GROUP BY status")
+        result = {"pending": 0, "processing": 0, "dead": 0, "lag": 0.0}
+        for status, count in rows:
+            result[status] = count
+        row = await self.db.fetchone(
+            "SELECT MIN(s.created_at) FROM deliveries d JOIN submissions s ON s.id = d.submission_id "
+            "WHERE d.status IN ('pending', 'processing')"
+        )
+        if row and row[0] is not None:
+            result["lag"] = time.time() - row[0]
+        return result
+
+    # --- Аренда ---
+    @asynccontextmanager
+    async def holding(self, jobs: Sequence[Job]):
+        """Продлевает аренду заданий, пока выполняется блок (очередь лимитов, ожидание 429)."""
+        keeper = asyncio.create_task(self._renew(jobs))
+        try:
+            yield
+        finally:
+            keeper.cancel()
+
+    async def _renew(self, jobs: Sequence[Job]):
+        def _run(conn, until: float):
+            return sum(
+                conn.execute(
+                    "UPDATE deliveries SET lease_until = ? WHERE submission_id = ? AND chat_id = ? AND owner = ? AND status = 'processing'",
+                    (until, job.submission_id, job.chat_id, self.owner),
+                ).rowcount
+                for job in jobs
+            )
+
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await self.db.run(_run, time.time() + self.lease)
+            except Exception as e:
+                logging.error(f"Outbox lease renewal failed: {e}")
+                continue
+            if renewed < len(jobs):
+                logging.error(f"Outbox lease lost for {len(jobs) - renewed} of {len(jobs)} jobs")
+                return
+
+    # --- Воркеры ---
+    def start(self, handler: Callable[[Job], Awaitable[None]], concurrency: int = 4):
+        for _ in range(concurrency):
+            self._workers.append(asyncio.create_task(self._worker(handler)))
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        await self.release()
+
+    async def _worker(self, handler: Callable[[Job], Awaitable[None]]):
+        while True:
+            try:
+                job = await self.claim()
+            except Exception as e:
+                logging.error(f"Outbox claim failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                async with self.holding([job]):
+                    await handler(job)
+            except RetryLater as e:
+                await self.retry(job, str(e), e.delay, e.count_attempt)
+            except LeaseLost:
+                logging.error(f"Outbox delivery {job.submission_id} -> {job.chat_id} was taken over by another worker")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"Outbox delivery {job.submission_id} -> {job.chat_id} failed")
+                await self.retry(job, f"{type(e).__name__}: {e}")
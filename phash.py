@@ -0,0 +1,133 @@
+import asyncio
+import io
+import logging
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from aiogram import Bot
+
+try:
+    from PIL import Image
+except ImportError:  # пакет необязательный: без Pillow проверка фото просто выключена
+    Image = None
+
+
+def dhash(data: bytes, size: int = 8) -> int:
+    """Разностный перцептивный хэш (size*size бит): устойчив к пересжатию, масштабу и мелким правкам."""
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (size * 4, size * 4))  # JPEG декодируется сразу в уменьшенном виде
+        pixels = image.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR).tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+class HammingIndex:
+    """Индекс 64-битных хэшей для поиска по расстоянию Хэмминга (multi-index hashing).
+
+    Хэш режется на `max_distance + 1` полос; у хэшей на расстоянии не больше
+    `max_distance` хотя бы одна полоса совпадает целиком, поэтому кандидаты
+    берутся из словарей по полосам, а точное расстояние считается только для них.
+    """
+
+    def __init__(self, max_distance: int = 5, bits: int = 64):
+        self.max_distance = max_distance
+        count = max_distance + 1
+        widths = [bits // count + (i < bits % count) for i in range(count)]
+        self._bands: List[Tuple[int, int]] = []
+        shift = bits
+        for width in widths:
+            shift -= width
+            self._bands.append((shift, (1 << width) - 1))
+        self._tables: List[Dict[int, array]] = [{} for _ in self._bands]
+        self._hashes = array("Q")
+        self._items: List[Hashable] = []
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, value: int, item: Hashable):
+        position = len(self._hashes)
+        self._hashes.append(value)
+        self._items.append(item)
+        for (shift, mask), table in zip(self._bands, self._tables):
+            bucket = table.get((value >> shift) & mask)
+            if bucket is None:
+                bucket = table[(value >> shift) & mask] = array("I")
+            bucket.append(position)
+
+    def search(self, value: int, max_distance: Optional[int] = None) -> List[Tuple[int, Hashable]]:
+        """Все записи не дальше `max_distance`: список (расстояние, item) по возрастанию."""
+        limit = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        checked = set()
+        found = []
+        for (shift, mask), table in zip(self._bands, self._tables):
+            for position in table.get((value >> shift) & mask, ()):
+                if position in checked:
+                    continue
+                checked.add(position)
+                distance = (self._hashes[position] ^ value).bit_count()
+                if distance <= limit:
+                    found.append((distance, self._items[position]))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class PhotoHasher:
+    """Скачивает фото потоком и считает dhash в пуле процессов, не блокируя event loop.
+
+    Хэширование запускается при получении фото (`schedule`), а к моменту
+    отправки заявки результат обычно уже готов (`hashes`).
+    """
+
+    def __init__(self, bot: Bot, workers: int = 2, max_pending: int = 1000):
+        if Image is None:
+            raise ValueError("Для проверки фото по хэшу установите пакет Pillow.")
+        self.bot = bot
+        self.max_pending = max_pending
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, file_id: str, file_unique_id: str):
+        if file_unique_id in self._tasks:
+            return
+        if len(self._tasks) >= self.max_pending:
+            # Старые результаты никто не забрал (пользователь бросил анкету) — выкидываем
+            oldest = next(iter(self._tasks))
+            self._tasks.pop(oldest).cancel()
+        self._tasks[file_unique_id] = asyncio.create_task(self._hash(file_id))
+
+    async def _hash(self, file_id: str) -> int:
+        buffer = io.BytesIO()
+        await self.bot.download(file_id, destination=buffer)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, dhash, buffer.getvalue())
+
+    async def hashes(self, photos: Iterable[Tuple[str, str]], timeout: float = 5.0) -> Dict[str, int]:
+        """Хэши фото (file_id, file_unique_id) по file_unique_id; не успевшие или упавшие пропускаются."""
+        photos = list(photos)
+        for file_id, file_unique_id in photos:
+            self.schedule(file_id, file_unique_id)
+        tasks = {uid: self._tasks[uid] for _, uid in photos}
+        await asyncio.wait(tasks.values(), timeout=timeout)
+        result = {}
+        for uid, task in tasks.items():
+            if not task.done():
+                continue
+            self._tasks.pop(uid, None)
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                logging.warning(f"Photo hash failed for {uid}: {task.exception()}")
+                continue
+            result[uid] = task.result()
+        return result
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,135 @@
+import html
+import re
+from typing import Any, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from aiogram import types
+
+CAPTION_LIMIT = 1024  # Telegram считает видимый текст подписи (после разбора HTML) в UTF-16
+MESSAGE_LIMIT = 4096  # то же для текста сообщения
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def escape(value: Any) -> str:
+    return html.escape(str(value), quote=False)
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def visible_length(text: str) -> int:
+    """Длина HTML-текста так, как её считает Telegram: без тегов, сущности раскрыты, в единицах UTF-16."""
+    return utf16_length(html.unescape(_TAG_RE.sub("", text)))
+
+
+class _Template:
+    """Шаблон с `{}` под пользовательский текст: видимая длина разметки считается один раз,
+    поэтому длина подписи — это сумма длин исходных значений, без разбора готового HTML."""
+
+    __slots__ = ("format", "static_length")
+
+    def __init__(self, template: str):
+        self.format = template.format
+        self.static_length = visible_length(template.replace("{}", ""))
+
+
+# Строки поста: (поле, шаблон). Пустые поля и "Нет клипсы" пропускаются.
+_FIELDS = (
+    ("clip", _Template("<b>Клипса:</b> {}\n")),
+    ("depth", _Template("<b>Глубина:</b> {}\n")),
+    ("temperature", _Template("<b>Температура:</b> {}\n")),
+)
+_COMMENT = _Template("<b>Комментарий:</b>\n<blockquote>{}</blockquote>\n")
+_HEAD = _Template("<b>Локация:</b> {}\n<b>Координаты:</b> {}\n")
+_PREVIEW = _Template("<b>Предпросмотр:</b>\n\n{}<b>Ник:</b> {}")
+_POST = _Template("{}<b>Игровой ник:</b> {}\n\n🎁 Автору отправлено 200 кофе\n<a href='{}'>ПРЕДЛОЖИТЬ ПОСТ</a>")
+_SENDER = "<b>👤 Отправитель:</b> <a href='tg://user?id={0}'>{1}</a> ({2})".format
+_NICK_RESERVE = "x" * 32  # ник на шаге комментария ещё не введён — оставляем место под него
+
+
+def _body(d: Mapping[str, Any]) -> Tuple[str, int, List[str]]:
+    """Всё, кроме ника и комментария: (HTML, длина разметки, исходные значения полей)."""
+    values = [str(d["waterbody_hashtag"]), str(d["coordinates"])]
+    parts = [_HEAD.format(escape(values[0]), escape(values[1]))]
+    static = _HEAD.static_length
+    for key, template in _FIELDS:
+        value = d.get(key)
+        if value and not (key == "clip" and value == "Нет клипсы"):
+            values.append(str(value))
+            parts.append(template.format(escape(values[-1])))
+            static += template.static_length
+    return "".join(parts), static, values
+
+
+def _overflow(static: int, values: List[str]) -> int:
+    # Больше двух единиц UTF-16 символ не занимает: короткие подписи не перекодируем вовсе
+    if static + 2 * sum(map(len, values)) <= CAPTION_LIMIT:
+        return 0
+    return max(static + utf16_length("".join(values)) - CAPTION_LIMIT, 0)
+
+
+def _truncate(text: str, units: int) -> str:
+    # Режем по единицам UTF-16, как считает Telegram; половинка суррогатной пары отбрасывается
+    return text.encode("utf-16-le")[:max(units, 0) * 2].decode("utf-16-le", errors="ignore").rstrip() + "…"
+
+
+def _render(d: Mapping[str, Any], template: _Template, *tail: str) -> str:
+    body, static, values = _body(d)
+    nickname = str(d.get("game_nickname") or _NICK_RESERVE)
+    comment = str(d.get("comment") or "")
+    static += template.static_length  # хвост (ссылка) стоит внутри тега и в длину не входит
+    values.append(nickname)
+    if comment:
+        overflow = _overflow(static + _COMMENT.static_length, values + [comment])
+        if overflow > 0:
+            # Не влезает в подпись — укорачиваем комментарий: остальные поля на своих шагах проверены caption_overflow
+            comment = _truncate(comment, utf16_length(comment) - overflow - 1)
+        body += _COMMENT.format(escape(comment))
+    return template.format(body, escape(nickname), *tail)
+
+
+def preview_caption(d: Mapping[str, Any]) -> str:
+    return _render(d, _PREVIEW)
+
+
+def post_caption(d: Mapping[str, Any], offer_url: str) -> str:
+    return _render(d, _POST, html.escape(offer_url))
+
+
+def caption_overflow(d: Mapping[str, Any]) -> int:
+    """На сколько символов пост длиннее лимита подписи без обрезки комментария (0 — влезает)."""
+    _, static, values = _body(d)
+    static += _POST.static_length
+    values.append(str(d.get("game_nickname") or _NICK_RESERVE))
+    if d.get("comment"):
+        static += _COMMENT.static_length
+        values.append(str(d["comment"]))
+    return _overflow(static, values)
+
+
+def sender_info(user_id: int, full_name: str, username: Optional[str]) -> str:
+    return _SENDER(user_id, escape(full_name), f"@{escape(username)}" if username else f"ID: {user_id}")
+
+
+def album(photos: Sequence[str], caption: str) -> List[types.InputMediaPhoto]:
+    return [types.InputMediaPhoto(media=photo, caption=caption if i == 0 else None) for i, photo in enumerate(photos)]
+
+
+# --- Клавиатуры: собираются один раз при импорте и переиспользуются ---
+def reply_keyboard(rows: Iterable[Iterable[str]]) -> types.ReplyKeyboardMarkup:
+    return types.ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text=text) for text in row] for row in rows], resize_keyboard=True,
+    )
+
+
+def chunked(items: Sequence[str], size: int) -> List[Sequence[str]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+REMOVE_KEYBOARD = types.ReplyKeyboardRemove()
+CLIP_SKIP_KEYBOARD = reply_keyboard([["Пропустить клипсу"]])
+COMMENT_CHOICE_KEYBOARD = reply_keyboard([["Добавить комментарий"], ["Пропустить комментарий"]])
+PHOTO_KEYBOARD = reply_keyboard([])
+PHOTO_DONE_KEYBOARD = reply_keyboard([["Готово"]])
+CONFIRM_KEYBOARD = reply_keyboard([["Отправить пост"], ["Редактировать"], ["Отмена"]])
@@ -0,0 +1,74 @@
+import heapq
+import math
+import re
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# Игровые координаты: "75:42", "75 42", "75,42", "75;42", "75/42"
+_COORDINATES_RE = re.compile(r"^\s*(\d{1,3})\s*(?:[:;,/]|\s)\s*(\d{1,3})\s*$")
+
+
+def parse_coordinates(text: str) -> Optional[Tuple[int, int]]:
+    match = _COORDINATES_RE.match(text or "")
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def format_coordinates(x: int, y: int) -> str:
+    return f"{x}:{y}"
+
+
+class _Cell:
+    __slots__ = ("xs", "ys", "ids")
+
+    def __init__(self):
+        self.xs = array("H")
+        self.ys = array("H")
+        self.ids = array("q")
+
+
+class GridIndex:
+    """Сеточный пространственный индекс: отдельная сетка на каждый водоём.
+
+    Точки лежат в ячейках `cell`×`cell` компактными массивами, поэтому миллион
+    точек занимает единицы мегабайт; запрос смотрит только ячейки, задетые
+    кругом поиска.
+    """
+
+    def __init__(self, cell: int = 8):
+        self.cell = cell
+        self._grids: Dict[str, Dict[Tuple[int, int], _Cell]] = {}
+        self.size = 0
+        self.last_id = 0
+
+    def add(self, group: str, x: int, y: int, item_id: int):
+        grid = self._grids.setdefault(group, {})
+        key = (x // self.cell, y // self.cell)
+        cell = grid.get(key)
+        if cell is None:
+            cell = grid[key] = _Cell()
+        cell.xs.append(x)
+        cell.ys.append(y)
+        cell.ids.append(item_id)
+        self.size += 1
+        self.last_id = max(self.last_id, item_id)
+
+    def nearby(self, group: str, x: int, y: int, radius: float, limit: int = 10) -> List[Tuple[float, int]]:
+        """Ближайшие к (x, y) точки в радиусе: список (расстояние, id) по возрастанию."""
+        grid = self._grids.get(group)
+        if not grid:
+            return []
+        r2 = radius * radius
+        found = []
+        c = self.cell
+        for cx in range(int((x - radius) // c), int((x + radius) // c) + 1):
+            for cy in range(int((y - radius) // c), int((y + radius) // c) + 1):
+                cell = grid.get((cx, cy))
+                if cell is None:
+                    continue
+                for px, py, item_id in zip(cell.xs, cell.ys, cell.ids):
+                    d2 = (px - x) * (px - x) + (py - y) * (py - y)
+                    if d2 <= r2:
+                        found.append((d2, item_id))
+        return [(math.sqrt(d2), item_id) for d2, item_id in heapq.nsmallest(limit, found)]
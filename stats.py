@@ -0,0 +1,142 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import SQLiteDB
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats_snapshot (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    last_id INTEGER NOT NULL
+);
+"""
+
+
+def day_key(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(ts))
+
+
+class TopCounter:
+    """Счётчик с готовым топом: счётчики только растут, поэтому ключ попадает в топ,
+    лишь обогнав последнее место, и обновление топа стоит O(size), а не O(всех ключей)."""
+
+    def __init__(self, size: int = 10):
+        self.size = size
+        self.counts: Dict[str, int] = {}
+        self.labels: Dict[str, str] = {}  # как показывать ключ (ник в исходном написании)
+        self._top: List[str] = []
+
+    def inc(self, key: str, label: Optional[str] = None, value: int = 1):
+        self.counts[key] = count = self.counts.get(key, 0) + value
+        if label is not None:
+            self.labels[key] = label
+        top = self._top
+        if key in top:
+            pass
+        elif len(top) < self.size:
+            top.append(key)
+        elif count > self.counts[top[-1]]:
+            top[-1] = key
+        else:
+            return
+        top.sort(key=lambda k: -self.counts[k])
+
+    def top(self) -> List[Tuple[str, int]]:
+        return [(self.labels.get(k, k), self.counts[k]) for k in self._top]
+
+    def rebuild_top(self):
+        self._top = heapq.nlargest(self.size, self.counts, key=self.counts.__getitem__)
+
+
+class SubmissionStats:
+    """Счётчики заявок по водоёмам, снастям, дням и никам.
+
+    Идут следом за архивом по id точек (как пространственный индекс), поэтому
+    ответ на /stats не зависит от объёма истории. Снимок периодически пишется в
+    базу; после падения недостающее добирается из архива после `last_id` снимка.
+    """
+
+    def __init__(self, db: SQLiteDB, top_size: int = 10):
+        self.db = db
+        self.total = 0
+        self.by_waterbody: Dict[str, int] = {}
+        self.by_tackle: Dict[str, int] = {}
+        self.by_day: Dict[str, int] = {}
+        self.nicknames = TopCounter(top_size)
+        self.last_id = 0
+        self._changes = 0  # правки счётчиков; снимок пишется, если их стало больше, чем в последнем сохранённом
+        self._saved = 0
+
+    async def setup(self):
+        await self.db.executescript(_SCHEMA)
+
+    def add(self, spot_id: int, waterbody: str, tackle: str, nickname_key: str, nickname: str, created_at: float):
+        self.total += 1
+        self.by_waterbody[waterbody] = self.by_waterbody.get(waterbody, 0) + 1
+        self.by_tackle[tackle] = self.by_tackle.get(tackle, 0) + 1
+        day = day_key(created_at)
+        self.by_day[day] = self.by_day.get(day, 0) + 1
+        self.nicknames.inc(nickname_key, nickname.strip())
+        self.last_id = max(self.last_id, spot_id)
+        self._changes += 1
+
+    def merge(self, aggregate: Dict[str, Any]):
+        """Добавляет агрегаты из архива (см. Archive.aggregate_all)."""
+        self.total += aggregate["total"]
+        for target, name in ((self.by_waterbody, "waterbody"), (self.by_tackle, "tackle"), (self.by_day, "day")):
+            for key, count in aggregate[name]:
+                target[key] = target.get(key, 0) + count
+        for key, label, count in aggregate["nickname"]:
+            self.nicknames.counts[key] = self.nicknames.counts.get(key, 0) + count
+            self.nicknames.labels[key] = label.strip()
+        self.nicknames.rebuild_top()
+        self.last_id = max(self.last_id, aggregate["last_id"])
+        self._changes += 1
+
+    async def load(self) -> bool:
+        row = await self.db.fetchone("SELECT data, last_id FROM stats_snapshot WHERE name = 'submissions'")
+        if row is None:
+            return False
+        data = json.loads(row[0])
+        self.total = data["total"]
+        self.by_waterbody, self.by_tackle, self.by_day = data["by_waterbody"], data["by_tackle"], data["by_day"]
+        self.nicknames.counts, self.nicknames.labels = data["nicknames"], data["labels"]
+        self.nicknames.rebuild_top()
+        self.last_id = row[1]
+        return True
+
+    async def save(self):
+        if self._changes == self._saved:
+            return
+        changes = self._changes
+        # Копия снимается в event loop (согласованное состояние), JSON и запись — в потоке базы
+        snapshot = {
+            "total": self.total, "by_waterbody": dict(self.by_waterbody), "by_tackle": dict(self.by_tackle),
+            "by_day": dict(self.by_day), "nicknames": dict(self.nicknames.counts), "labels": dict(self.nicknames.labels),
+        }
+        last_id = self.last_id
+
+        def _run(conn):
+            conn.execute(
+                "INSERT INTO stats_snapshot (name, data, last_id) VALUES ('submissions', ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET data = excluded.data, last_id = excluded.last_id",
+                (json.dumps(snapshot, ensure_ascii=False), last_id),
+            )
+
+        await self.db.run(_run)
+        # Отмечаем только после записи: при ошибке снимок повторится, правки во время записи уйдут следующим
+        self._saved = changes
+
+
+async def save_stats(stats: SubmissionStats, interval: float):
+    """Фоновая задача: периодически сохраняет снимок счётчиков."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await stats.save()
+        except Exception as e:
+            logging.error(f"Stats snapshot failed: {e}")
@@ -0,0 +1,304 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage, MemoryStorageRecord
+
+from db import BatchWriter, SQLiteDB
+
+class SessionTTL:
+    """Время жизни простаивающей сессии в зависимости от текущего состояния FSM.
+
+    Сессия без состояния (после state.clear()) считается завершённой и
+    удаляется сразу.
+    """
+
+    def __init__(self, default: Optional[float], per_state: Optional[Mapping[str, float]] = None):
+        self.default = default
+        self.per_state = dict(per_state or {})
+
+    @classmethod
+    def parse(cls, default: Optional[float], overrides: str) -> "SessionTTL":
+        """Разбирает строку вида "waiting_for_photos=86400,confirm_post=86400"."""
+        per_state = {}
+        for item in filter(None, (part.strip() for part in overrides.split(","))):
+            name, _, seconds = item.partition("=")
+            per_state[name.strip()] = float(seconds)
+        return cls(default, per_state)
+
+    def __call__(self, state: Optional[str]) -> Optional[float]:
+        if state is None:
+            return 0.0
+        # Состояния можно задавать и полным именем, и коротким: "PostCreation:waiting_for_photos" / "waiting_for_photos"
+        ttl = self.per_state.get(state)
+        if ttl is None:
+            ttl = self.per_state.get(state.rpartition(":")[2], self.default)
+        return ttl
+
+
+class ExpiringMemoryStorage(MemoryStorage):
+    """MemoryStorage с вытеснением простаивающих сессий.
+
+    Сроки лежат в куче (ленивый индекс истечения): фоновая чистка снимает с
+    вершины только просроченные ключи, без полного прохода по хранилищу.
+    """
+
+    def __init__(self, ttl: SessionTTL):
+        super().__init__()
+        self.ttl = ttl
+        self.evicted = 0
+        self._deadlines: Dict[StorageKey, float] = {}
+        self._heap: List[Tuple[float, int, StorageKey]] = []
+        # Самый ранний срок ключа, уже лежащий в куче
+        self._queued: Dict[StorageKey, float] = {}
+        self._seq = itertools.count()
+
+    @property
+    def live_sessions(self) -> int:
+        return len(self.storage)
+
+    def _touch(self, key: StorageKey):
+        record = self.storage.get(key)
+        if record is None:
+            return
+        ttl = self.ttl(record.state)
+        if record.state is None and not record.data:
+            self._drop(key)
+            return
+        if ttl is None:
+            self._deadlines.pop(key, None)
+            return
+        deadline = time.monotonic() + ttl
+        self._deadlines[key] = deadline
+        queued = self._queued.get(key)
+        if queued is None or deadline < queued:
+            self._queued[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+
+    def _drop(self, key: StorageKey):
+        self.storage.pop(key, None)
+        self._deadlines.pop(key, None)
+
+    def _record(self, key: StorageKey) -> Optional[MemoryStorageRecord]:
+        record = self.storage.get(key)
+        deadline = self._deadlines.get(key)
+        if record is not None and deadline is not None and deadline <= time.monotonic():
+            self._drop(key)
+            self.evicted += 1
+            return None
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        # В отличие от MemoryStorage, чтение не создаёт пустую запись
+        record = self._record(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await super().set_data(key, data)
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._record(key)
+        return record.data.copy() if record else {}
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return (await self.get_data(storage_key)).get(dict_key, default)
+
+    async def purge_expired(self) -> int:
+        """Вытесняет все сессии, срок которых истёк."""
+        now = time.monotonic()
+        purged = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            self._queued.pop(key, None)
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                continue
+            if deadline <= now:
+                self._drop(key)
+                purged += 1
+            else:
+                # Сессию продлили: возвращаем в кучу с актуальным сроком
+                self._queued[key] = deadline
+                heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        self.evicted += purged
+        return purged
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS fsm_expires_at ON fsm (expires_at);
+"""
+
+_UPSERT_STATE = (
+    "INSERT INTO fsm (key, state, ttl, expires_at) VALUES (?, ?, ?, ? + ?) "
+    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, ttl = excluded.ttl, expires_at = excluded.expires_at"
+)
+# Данные продлевают сессию на ttl её текущего состояния
+_UPSERT_DATA = (
+    "INSERT INTO fsm (key, data, ttl, expires_at) VALUES (?, ?, ?, ? + ?) "
+    "ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = ? + COALESCE(fsm.ttl, ?)"
+)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в файле SQLite (WAL), общее для нескольких процессов.
+
+    Записи копятся в памяти и сбрасываются одной транзакцией раз в
+    `flush_interval` секунд (или когда набралось `batch_size` ключей); чтения
+    сначала смотрят в этот буфер. Срок жизни сессии задаёт `ttl` по её состоянию.
+    """
+
+    def __init__(self, path: str, ttl: Optional[SessionTTL] = None, flush_interval: float = 0.05, batch_size: int = 500, pool_size: int = 4):
+        self.db = SQLiteDB(path, pool_size=pool_size)
+        self.ttl = ttl or SessionTTL(None)
+        self.evicted = 0
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._pending_state: Dict[str, Optional[str]] = {}
+        self._pending_data: Dict[str, str] = {}
+        self._touched: Dict[str, float] = {}
+        # То, что сейчас пишется в базу: чтения видят это до коммита
+        self._inflight_state: Dict[str, Optional[str]] = {}
+        self._inflight_data: Dict[str, str] = {}
+        self._writer = BatchWriter(self.flush, "FSM", flush_interval, batch_size)
+        self._flush_lock = asyncio.Lock()
+        self._ready = False
+
+    async def _ensure_schema(self):
+        if not self._ready:
+            await self.db.executescript(_SCHEMA)
+            try:
+                await self.db.execute("ALTER TABLE fsm ADD COLUMN ttl REAL")
+            except sqlite3.OperationalError:
+                pass  # колонка уже есть
+            self._ready = True
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    def _schedule_flush(self, key: str):
+        self._touched[key] = time.time()
+        self._writer.touch(len(self._touched))
+
+    async def flush(self):
+        """Сбрасывает накопленные записи в базу одной транзакцией."""
+        async with self._flush_lock:
+            if not self._touched:
+                return
+            states, datas, touched = self._pending_state, self._pending_data, self._touched
+            self._pending_state, self._pending_data, self._touched = {}, {}, {}
+            self._inflight_state, self._inflight_data = states, datas
+            try:
+                await self._ensure_schema()
+                # TTL None = бессрочно: храним как NULL, expires_at тоже станет NULL
+                default = self.ttl.default
+                await self.db.transaction([
+                    (_UPSERT_STATE, [(k, v, self.ttl(v), touched[k], self.ttl(v)) for k, v in states.items()]),
+                    (_UPSERT_DATA, [(k, v, default, touched[k], default, touched[k], default) for k, v in datas.items()]),
+                ])
+            except Exception:
+                # Не теряем буфер: более свежие записи, сделанные во время сброса, приоритетнее
+                for k, v in states.items(): self._pending_state.setdefault(k, v)
+                for k, v in datas.items(): self._pending_data.setdefault(k, v)
+                for k, v in touched.items(): self._touched.setdefault(k, v)
+                raise
+            finally:
+                self._inflight_state, self._inflight_data = {}, {}
+
+    async def _load(self, key: str, column: str) -> Optional[str]:
+        await self._ensure_schema()
+        row = await self.db.fetchone(f"SELECT {column}, expires_at FROM fsm WHERE key = ?", (key,))
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        self._pending_state[k] = state.state if isinstance(state, State) else state
+        self._schedule_flush(k)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        k = self._key(key)
+        for pending in (self._pending_state, self._inflight_state):
+            if k in pending:
+                return pending[k]
+        return await self._load(k, "state")
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = self._key(key)
+        self._pending_data[k] = json.dumps(dict(data), ensure_ascii=False)
+        self._schedule_flush(k)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        k = self._key(key)
+        for pending in (self._pending_data, self._inflight_data):
+            if k in pending:
+                return json.loads(pending[k])
+        raw = await self._load(k, "data")
+        return json.loads(raw) if raw else {}
+
+    async def purge_expired(self) -> int:
+        """Удаляет просроченные сессии по индексу expires_at."""
+        await self._ensure_schema()
+        purged = await self.db.execute("DELETE FROM fsm WHERE expires_at <= ?", (time.time(),))
+        self.evicted += purged
+        return purged
+
+    async def count_live_sessions(self) -> int:
+        await self._ensure_schema()
+        row = await self.db.fetchone("SELECT COUNT(*) FROM fsm WHERE expires_at IS NULL OR expires_at > ?", (time.time(),))
+        return row[0]
+
+    async def close(self) -> None:
+        await self._writer.close()
+        self.db.close()
+
+
+async def sweep_sessions(storage: BaseStorage, interval: float = 60):
+    """Фоновая чистка просроченных сессий для хранилищ с purge_expired()."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            purged = await storage.purge_expired()
+            if purged:
+                logging.info(f"Evicted {purged} idle FSM sessions")
+        except Exception as e:
+            logging.error(f"FSM session sweep failed: {e}")
+
+
+def create_storage(kind: str, *, db_path: str = "bot.db", redis_url: Optional[str] = None, ttl: Optional[SessionTTL] = None) -> BaseStorage:
+    """Создаёт FSM-хранилище по имени: memory, sqlite или redis."""
+    ttl = ttl or SessionTTL(None)
+    if kind == "memory":
+        return ExpiringMemoryStorage(ttl)
+    if kind == "sqlite":
+        return SQLiteStorage(db_path, ttl=ttl)
+    if kind == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise ValueError("Для FSM_STORAGE=redis установите пакет redis.")
+        if not redis_url:
+            raise ValueError("Для FSM_STORAGE=redis нужен REDIS_URL.")
+        # Redis истекает ключи сам; TTL по состояниям он не различает, берём общий
+        expiry = int(ttl.default) if ttl.default else None
+        return RedisStorage.from_url(redis_url, connection_kwargs={"max_connections": 20}, state_ttl=expiry, data_ttl=expiry)
+    raise ValueError(f"Неизвестный FSM_STORAGE: {kind}")
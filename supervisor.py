@@ -0,0 +1,452 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from metrics import Registry, registry
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+PIPE_LIMIT = 16 * 1024 * 1024  # самая длинная строка в канале: апдейт или выдача /metrics воркера
+
+
+def update_user_id(update: Mapping[str, Any]) -> int:
+    """Пользователь, от которого пришёл апдейт (для чатов без отправителя — id чата, иначе 0)."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+def shard(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+
+def merge_metrics(texts: Sequence[Tuple[int, str]]) -> str:
+    """Сливает /metrics воркеров в одну выдачу с меткой worker, не разрывая семейства метрик."""
+    headers: Dict[Optional[str], List[str]] = {}
+    samples: Dict[Optional[str], List[str]] = {}
+    for worker, text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                family = line.split(" ", 3)[2]
+                family_headers = headers.setdefault(family, [])
+                if line not in family_headers:
+                    family_headers.append(line)
+                samples.setdefault(family, [])
+                continue
+            name, brace, rest = line.partition("{")
+            if brace:
+                line = f'{name}{{worker="{worker}",{rest}'
+            else:
+                name, _, value = line.partition(" ")
+                line = f'{name}{{worker="{worker}"}} {value}'
+            samples.setdefault(family, []).append(line)
+    lines = []
+    for family, family_samples in samples.items():
+        lines.extend(headers.get(family, []))
+        lines.extend(family_samples)
+    return "\n".join(lines) + "\n"
+
+
+class UserOrder:
+    """Порядок апдейтов пользователя внутри воркера: следующий начинается, когда закончен предыдущий.
+
+    Фото одного альбома ждут общего предшественника и идут вместе, иначе
+    AlbumMiddleware не собрал бы их в один вызов хендлера.
+    """
+
+    def __init__(self):
+        self._tails: Dict[int, asyncio.Future] = {}
+        self._albums: Dict[int, Tuple[str, Optional[asyncio.Future], List[asyncio.Task]]] = {}
+
+    def submit(self, update: Dict[str, Any], run: Callable[[Dict[str, Any]], Awaitable[None]]) -> asyncio.Task:
+        user_id = update_user_id(update)
+        if not user_id:
+            return asyncio.create_task(run(update))
+        group = (update.get("message") or {}).get("media_group_id")
+        album = self._albums.get(user_id)
+        if group and album and album[0] == group:
+            before = album[1]
+        else:
+            before = self._tails.get(user_id)
+            album = (group, before, []) if group else None
+            if album:
+                self._albums[user_id] = album
+            else:
+                self._albums.pop(user_id, None)
+        task = asyncio.create_task(self._run(before, run, update))
+        if album:
+            album[2].append(task)
+            tail = asyncio.gather(*album[2])
+        else:
+            tail = task
+        self._tails[user_id] = tail
+        tail.add_done_callback(lambda _: self._release(user_id, tail))
+        return task
+
+    @staticmethod
+    async def _run(before: Optional[asyncio.Future], run: Callable[[Dict[str, Any]], Awaitable[None]], update: Dict[str, Any]):
+        if before is not None:
+            await asyncio.wait((before,))
+        await run(update)
+
+    def _release(self, user_id: int, tail: asyncio.Future):
+        if self._tails.get(user_id) is tail:
+            del self._tails[user_id]
+            self._albums.pop(user_id, None)
+
+
+class WorkerProcess:
+    """Процесс-воркер и очередь его апдейтов.
+
+    Апдейты пишутся в stdin строками JSON; пока воркер перезапускается, они
+    копятся здесь же, поэтому порядок апдейтов пользователя не нарушается.
+    Воркер подтверждает каждый обработанный апдейт и раз в интервал присылает
+    отчёт о нагрузке. Неподтверждённые апдейты упавшего воркера отдаются новому
+    процессу первыми — каждый не больше одного раза, чтобы апдейт, из-за
+    которого воркер падает, не ронял его снова и снова.
+    """
+
+    def __init__(self, index: int, argv: Sequence[str], env: Mapping[str, str], max_backlog: int = 10000):
+        self.index = index
+        self.argv = list(argv)
+        self.env = dict(env, WORKER_INDEX=str(index))
+        self.max_backlog = max_backlog
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.backlog: Deque[Tuple[int, bytes]] = deque()
+        self.routed = 0
+        self.handled = 0
+        self.replayed = 0
+        self.restarts = 0
+        self.lost = 0
+        self.load: Dict[str, float] = {}
+        self._unacked: Dict[int, bytes] = {}  # отдано воркеру, порядок — как писали
+        self._retried: Set[int] = set()
+        self._closed = False  # остановлен намеренно: упавший процесс не перезапускать
+        self._wakeup = asyncio.Event()
+        self._ready = asyncio.Event()  # первый отчёт: startup-хуки воркера отработали
+        self._tasks: List[asyncio.Task] = []
+        self._metrics: Optional[asyncio.Future] = None
+
+    @property
+    def in_flight(self) -> int:
+        """Отдано воркеру, но ещё не обработано (в канале и в работе)."""
+        return len(self._unacked)
+
+    def put(self, update_id: int, line: bytes) -> bool:
+        if len(self.backlog) >= self.max_backlog:
+            return False
+        self.backlog.append((update_id, line))
+        self.routed += 1
+        self._wakeup.set()
+        return True
+
+    async def start(self, timeout: float = 120.0):
+        self._closed = False
+        self._ready.clear()
+        self.process = process = await asyncio.create_subprocess_exec(
+            *self.argv, env=self.env, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=PIPE_LIMIT,
+        )
+        self._tasks = [
+            asyncio.create_task(self._pump(process)),
+            asyncio.create_task(self._read(process)),
+            asyncio.create_task(self._watch(process)),
+        ]
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Worker {self.index} is not ready after {timeout}s")
+        logging.info(f"Worker {self.index} started, pid {process.pid}")
+
+    async def stop(self, timeout: float = 30.0):
+        """Мягкая остановка: воркер дочитывает stdin, доделывает начатые апдейты и выходит."""
+        self._closed = True
+        process = self.process
+        if process is None:
+            return
+        pump, reader, watcher = self._tasks
+        pump.cancel()
+        await asyncio.gather(pump, return_exceptions=True)
+        self._write(process.stdin)
+        process.stdin.close()  # уже записанное в канал воркер ещё получит
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Worker {self.index} did not drain in {timeout}s, killing")
+            process.kill()
+            await process.wait()
+        await asyncio.gather(reader, watcher, return_exceptions=True)
+        self._retire()
+        logging.info(f"Worker {self.index} stopped, handled {self.handled}")
+
+    async def restart(self, timeout: float = 30.0):
+        await self.stop(timeout)
+        await self.start()
+
+    def _retire(self):
+        # Неподтверждённое — в начало очереди для следующего процесса; уже повторённое второй раз не отдаём
+        retry = [(update_id, line) for update_id, line in self._unacked.items() if update_id not in self._retried]
+        dropped = len(self._unacked) - len(retry)
+        self._retried.difference_update(self._unacked)
+        self._retried.update(update_id for update_id, _ in retry)
+        self._unacked.clear()
+        self.backlog.extendleft(reversed(retry))
+        self.replayed += len(retry)
+        self.lost += dropped
+        self.load = {}
+        self.process = None
+        if retry or dropped:
+            logging.warning(f"Worker {self.index}: {len(retry)} unfinished updates will be replayed, {dropped} dropped")
+
+    def _write(self, stdin: asyncio.StreamWriter):
+        # Всё накопленное — одной записью
+        items = list(self.backlog)
+        self.backlog.clear()
+        stdin.write(b"".join(line for _, line in items))
+        self._unacked.update(items)
+
+    async def _pump(self, process: asyncio.subprocess.Process):
+        while True:
+            if not self.backlog:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._write(process.stdin)
+            try:
+                await process.stdin.drain()
+            except ConnectionError:
+                return  # воркер упал; перезапуском займётся _watch
+
+    async def _read(self, process: asyncio.subprocess.Process):
+        async for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if "done" in message:
+                for update_id in message["done"]:
+                    if self._unacked.pop(update_id, None) is not None:
+                        self.handled += 1
+                    self._retried.discard(update_id)
+            elif "load" in message:
+                self.load = message["load"]
+                self._ready.set()
+            elif "metrics" in message and self._metrics is not None and not self._metrics.done():
+                self._metrics.set_result(message["metrics"])
+
+    async def _watch(self, process: asyncio.subprocess.Process):
+        code = await process.wait()
+        if self._closed:
+            return
+        # Упал сам: backlog и неподтверждённые апдейты дождутся нового процесса
+        self._tasks[0].cancel()
+        await asyncio.gather(self._tasks[1], return_exceptions=True)
+        self._retire()
+        self.restarts += 1
+        delay = min(2 ** min(self.restarts - 1, 5), 30)
+        logging.error(f"Worker {self.index} exited with code {code}, restarting in {delay}s")
+        await asyncio.sleep(delay)
+        if self.process is None and not self._closed:
+            await self.start()
+
+    async def metrics(self, timeout: float = 2.0) -> Optional[str]:
+        if self.process is None or self._closed:
+            return None
+        if self._metrics is None or self._metrics.done():
+            self._metrics = asyncio.get_running_loop().create_future()
+            self.process.stdin.write(b"!metrics\n")
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._metrics), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Supervisor:
+    """Принимает webhook и раздаёт апдейты `processes` воркерам по user id.
+
+    Все апдейты одного пользователя попадают в один воркер и приходят туда
+    в порядке поступления, поэтому FSM, альбомы и антифлуд работают как в
+    одном процессе. SIGHUP — поочерёдный перезапуск воркеров без потери апдейтов.
+    """
+
+    def __init__(self, processes: int, argv: Sequence[str], env: Mapping[str, str], max_backlog: int = 10000, drain_timeout: float = 30.0):
+        self.workers = [WorkerProcess(i, argv, env, max_backlog) for i in range(processes)]
+        self.drain_timeout = drain_timeout
+        self.rejected = 0
+        self._restart_lock = asyncio.Lock()
+        self.registry = Registry()
+        self._routed = self.registry.gauge("bot_worker_updates_routed", "Updates routed to the worker slot since supervisor start", ("worker",))
+        self._handled = self.registry.gauge("bot_worker_updates_handled", "Updates handled by the worker slot since supervisor start", ("worker",))
+        self._backlog = self.registry.gauge("bot_worker_backlog", "Updates waiting in the supervisor for the worker", ("worker",))
+        self._in_flight = self.registry.gauge("bot_worker_in_flight", "Updates given to the worker and not finished yet", ("worker",))
+        self._lag = self.registry.gauge("bot_worker_loop_lag_seconds", "Worker event loop lag at the last report", ("worker",))
+        self._up = self.registry.gauge("bot_worker_up", "Worker process is running", ("worker",))
+        self._restarts = self.registry.gauge("bot_worker_restarts", "Unexpected worker exits", ("worker",))
+        self._lost = self.registry.gauge("bot_worker_lost_updates", "Updates lost with crashed workers", ("worker",))
+        self._rejected = self.registry.gauge("bot_supervisor_rejected_updates", "Webhook requests answered 503 because a backlog was full")
+        self.registry.add_collector(self._collect)
+
+    async def start(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+
+    async def stop(self):
+        await asyncio.gather(*(worker.stop(self.drain_timeout) for worker in self.workers))
+        for worker in self.workers:
+            if worker.backlog:
+                # Пришли, пока воркеры останавливались: Telegram их уже не повторит
+                logging.warning(f"Worker {worker.index}: {len(worker.backlog)} updates not delivered at shutdown")
+                worker.lost += len(worker.backlog)
+
+    async def restart(self):
+        # По одному: остальные воркеры продолжают работать, апдейты перезапускаемого ждут в backlog
+        async with self._restart_lock:
+            for worker in self.workers:
+                await worker.restart(self.drain_timeout)
+
+    def route(self, update: Mapping[str, Any], line: bytes) -> bool:
+        return self.workers[shard(update_user_id(update), len(self.workers))].put(update["update_id"], line)
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        if request.app["webhook_secret"] and request.headers.get(SECRET_HEADER) != request.app["webhook_secret"]:
+            return web.Response(status=401)
+        body = await request.read()
+        update = json.loads(body)
+        if b"\n" in body:
+            body = json.dumps(update, ensure_ascii=False).encode()
+        if not self.route(update, body + b"\n"):
+            # Telegram повторит апдейт позже
+            self.rejected += 1
+            return web.Response(status=503)
+        return web.Response()
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        texts = await asyncio.gather(*(worker.metrics() for worker in self.workers))
+        body = await self.registry.render() + merge_metrics([(w.index, t) for w, t in zip(self.workers, texts) if t])
+        return web.Response(body=body.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def _collect(self):
+        for worker in self.workers:
+            label = str(worker.index)
+            self._routed.set(label, value=worker.routed)
+            self._handled.set(label, value=worker.handled)
+            self._backlog.set(label, value=len(worker.backlog))
+            self._in_flight.set(label, value=worker.in_flight)
+            self._lag.set(label, value=worker.load.get("lag", 0))
+            self._up.set(label, value=worker.process is not None)
+            self._restarts.set(label, value=worker.restarts)
+            self._lost.set(label, value=worker.lost)
+        self._rejected.set(value=self.rejected)
+
+    def web_app(self, path: str, secret: Optional[str]) -> web.Application:
+        app = web.Application()
+        app["webhook_secret"] = secret
+        app.router.add_post(path, self.handle_webhook)
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        async def _startup(app: web.Application):
+            await self.start()
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(self.restart()))
+
+        async def _cleanup(app: web.Application):
+            await self.stop()
+
+        app.on_startup.append(_startup)
+        app.on_cleanup.append(_cleanup)
+        return app
+
+
+async def serve_worker(dispatcher: Dispatcher, bot: Bot, report_interval: float = 1.0, drain_timeout: float = 30.0):
+    """Цикл воркера: апдейты из stdin, отчёты о нагрузке и /metrics — в stdout.
+
+    Каждый обработанный апдейт подтверждается (`{"done": [update_id, ...]}`,
+    пачкой за итерацию цикла). Конец stdin (или SIGTERM) — сигнал к мягкой
+    остановке: начатые апдейты доделываются, затем выполняются shutdown-хуки.
+    """
+    loop = asyncio.get_running_loop()
+    # stdout занят отчётами: всё, что пишут туда библиотеки, уходит в stderr
+    out = open(os.dup(sys.stdout.fileno()), "w", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    reader = asyncio.StreamReader(limit=PIPE_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C получает и супервизор, он и остановит воркер
+    loop.add_signal_handler(signal.SIGTERM, reader.feed_eof)
+
+    order = UserOrder()
+    active: set = set()
+    handled = 0
+    done: List[int] = []
+    lag = 0.0
+
+    def send(message: Dict[str, Any]):
+        try:
+            out.write(json.dumps(message) + "\n")
+        except BrokenPipeError:
+            reader.feed_eof()  # супервизора нет — доделываем начатое и выходим
+
+    def report():
+        send({"load": {"handled": handled, "active": len(active), "lag": round(lag, 4)}})
+
+    def acknowledge():
+        send({"done": done[:]})
+        done.clear()
+
+    async def feed(update: Dict[str, Any]):
+        nonlocal handled
+        try:
+            await dispatcher.feed_raw_update(bot, update)
+        except Exception:
+            logging.exception(f"Update {update.get('update_id')} failed")
+        finally:
+            handled += 1
+            done.append(update["update_id"])
+            if len(done) == 1:
+                loop.call_soon(acknowledge)
+
+    async def reporter():
+        nonlocal lag
+        while True:
+            started = loop.time()
+            await asyncio.sleep(report_interval)
+            lag = loop.time() - started - report_interval
+            report()
+
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+    report()  # готов принимать апдейты
+    reporting = asyncio.create_task(reporter())
+    try:
+        while (line := await reader.readline()).endswith(b"\n"):
+            if line == b"!metrics\n":
+                send({"metrics": await registry.render()})
+                continue
+            task = order.submit(json.loads(line), feed)
+            active.add(task)
+            task.add_done_callback(active.discard)
+        if active:
+            await asyncio.wait(active, timeout=drain_timeout)
+    finally:
+        reporting.cancel()
+        if done:
+            acknowledge()
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+        await bot.session.close()
+        report()
+        try:
+            out.close()
+        except BrokenPipeError:
+            pass
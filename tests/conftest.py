@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main.py читает конфигурацию при импорте: тестовый бот без сети, база во временном каталоге
+os.environ.update({
+    "BOT_TOKEN": "123456:TEST",
+    "ADMIN_CHAT_IDS": "900000001,900000002",
+    "RUN_MODE": "polling",
+    "WEBHOOK_BASE_URL": "",
+    "FSM_STORAGE": "memory",
+    "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "bot.db"),
+    "ALBUM_LATENCY": "0.05",
+    "THROTTLE_RATE": "1000",
+    "THROTTLE_BURST": "1000",
+    "SEND_GLOBAL_RATE": "1000",
+    "SEND_PER_CHAT_RATE": "1000",
+})
+
+
+@pytest.fixture
+def make_dispatcher():
+    """Фабрика отдельных диспетчеров: свой MemoryStorage и только нужные хендлеры.
+
+    `outer` и `inner` — мидлвари сообщений в порядке регистрации (как в main.py);
+    `callback_inner` — внутренние мидлвари callback_query. Без `handlers`
+    регистрируется приём фото main.process_photos.
+    """
+    from aiogram import Dispatcher, F, Router
+    from aiogram.fsm.storage.memory import MemoryStorage
+
+    import main
+
+    def build(outer=(), inner=(), callback_inner=(), handlers=None) -> Dispatcher:
+        router = Router()
+        for middleware in outer:
+            router.message.outer_middleware(middleware)
+        for middleware in inner:
+            router.message.middleware(middleware)
+        for middleware in callback_inner:
+            router.callback_query.middleware(middleware)
+        if handlers is None:
+            router.message.register(main.process_photos, main.PostCreation.waiting_for_photos, F.photo)
+        else:
+            handlers(router)
+        dp = Dispatcher(storage=MemoryStorage())
+        dp.include_router(router)
+        return dp
+
+    return build
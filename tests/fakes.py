@@ -0,0 +1,82 @@
+"""Фейковая сессия Bot API и конструкторы апдейтов для тестов."""
+import asyncio
+import itertools
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot, methods, types
+from aiogram.client.session.base import BaseSession
+
+USER_ID = 100001
+
+
+class RecordingSession(BaseSession):
+    """Сессия без сети: запоминает каждый вызов API и отвечает правдоподобным результатом.
+
+    `files` — содержимое файлов по file_id, их отдаёт bot.download();
+    `latency` — задержка каждого ответа, секунд.
+    """
+
+    def __init__(self, files: Optional[Dict[str, bytes]] = None, latency: float = 0.0):
+        super().__init__()
+        self.files = files or {}
+        self.latency = latency
+        self.calls: List[methods.TelegramMethod] = []
+        self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id: Any, **extra) -> types.Message:
+        return types.Message(
+            message_id=next(self._message_ids), date=datetime.now(), chat=types.Chat(id=int(chat_id), type="private"), **extra,
+        )
+
+    async def make_request(self, bot: Bot, method: methods.TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls.append(method)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, methods.SendMediaGroup):
+            return [self._message(method.chat_id) for _ in method.media]
+        if isinstance(method, methods.CopyMessages):
+            return [types.MessageId(message_id=next(self._message_ids)) for _ in method.message_ids]
+        if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+            return self._message(method.chat_id, text=method.text)
+        if isinstance(method, methods.GetFile):
+            return types.File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f"photos/{method.file_id}")
+        return True
+
+    async def stream_content(self, url: str, headers=None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True):
+        data = self.files[url.rpartition("/")[2]]
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    async def close(self):
+        pass
+
+    def names(self) -> List[str]:
+        return [call.__api_method__ for call in self.calls]
+
+
+def make_bot(files: Optional[Dict[str, bytes]] = None, latency: float = 0.0) -> Bot:
+    return Bot("123456:TEST", session=RecordingSession(files, latency))
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def message_update(user_id: int = USER_ID, **fields) -> types.Update:
+    message = types.Message(
+        message_id=next(_message_ids), date=datetime.now(),
+        chat=types.Chat(id=user_id, type="private"),
+        from_user=types.User(id=user_id, is_bot=False, first_name=f"User{user_id}"),
+        **fields,
+    )
+    return types.Update(update_id=next(_update_ids), message=message)
+
+
+def text_update(text: str, user_id: int = USER_ID) -> types.Update:
+    return message_update(user_id, text=text)
+
+
+def photo_update(index: int, user_id: int = USER_ID, media_group_id: Optional[str] = None) -> types.Update:
+    photo = types.PhotoSize(file_id=f"photo{user_id}_{index}", file_unique_id=f"u{user_id}_{index}", width=1280, height=720)
+    return message_update(user_id, photo=[photo], media_group_id=media_group_id)
@@ -0,0 +1,26 @@
+import asyncio
+
+import main
+from fakes import USER_ID, make_bot, photo_update
+from middlewares import AlbumMiddleware
+
+
+async def _send_album(dp, size: int = 10):
+    bot = make_bot()
+    state = dp.fsm.get_context(bot, chat_id=USER_ID, user_id=USER_ID)
+    await state.set_state(main.PostCreation.waiting_for_photos)
+    # Части альбома приходят отдельными апдейтами почти одновременно
+    await asyncio.gather(*(dp.feed_update(bot, photo_update(i, media_group_id="album1")) for i in range(size)))
+    return bot.session.names(), await state.get_data()
+
+
+def test_album_is_one_reply_and_one_state_write(make_dispatcher):
+    calls, data = asyncio.run(_send_album(make_dispatcher(inner=[AlbumMiddleware(latency=0.05)])))
+    assert calls == ["sendMessage"]
+    assert data["photos"] == [f"photo{USER_ID}_{i}" for i in range(10)]
+
+
+def test_album_without_middleware_replies_per_photo(make_dispatcher):
+    calls, data = asyncio.run(_send_album(make_dispatcher()))
+    assert calls == ["sendMessage"] * 10
+    assert len(data["photos"]) == 10
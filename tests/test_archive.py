@@ -0,0 +1,44 @@
+import asyncio
+import os
+import tempfile
+
+import main
+from archive import Archive
+from db import SQLiteDB
+from outbox import KIND_ALBUM, Outbox
+
+
+def _payload(number: int) -> dict:
+    spot = {
+        "waterbody_name": "оз.Медное", "waterbody_hashtag": main.waterbody_hashtag("медное"),
+        "coordinates": f"{number}:{number}", "tackle": "Мах", "game_nickname": f"nick{number}",
+    }
+    return {"photos": ["p"], "post_text": "post", "service_info": "info", "user_id": number, "spot": spot}
+
+
+def test_backfill_restores_rows_older_than_archived_ones(monkeypatch):
+    async def scenario(db: SQLiteDB):
+        outbox, archive = Outbox(db), Archive(db)
+        await outbox.setup()
+        await archive.setup()
+        for number in range(1, 4):
+            await outbox.enqueue(f"sub{number}", _payload(number), [(900000001, KIND_ALBUM)])
+        # Процесс упал, не записав из буфера sub1 и sub2; другой процесс уже записал более позднюю sub3
+        await archive.add_many([("sub3", 2e9, 3, _payload(3)["spot"])])
+        monkeypatch.setattr(main, "outbox", outbox)
+        monkeypatch.setattr(main, "archive", archive)
+        await main._backfill_archive()
+        await main._backfill_archive()  # повторный запуск ничего не дублирует
+        return await db.fetchall("SELECT submission_id FROM spots ORDER BY submission_id"), await archive.unarchived()
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = SQLiteDB(os.path.join(tmp, "bot.db"))
+            try:
+                return await scenario(db)
+            finally:
+                db.close()
+
+    archived, missing = asyncio.run(run())
+    assert archived == [("sub1",), ("sub2",), ("sub3",)]
+    assert missing == []
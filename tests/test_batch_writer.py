@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+from aiogram.fsm.storage.base import StorageKey
+
+from archive import Archive
+from db import SQLiteDB
+from storage import SQLiteStorage
+
+SPOT = {"waterbody_name": "оз.Медное", "waterbody_hashtag": "#медное@rr4world", "coordinates": "1:1", "tackle": "Мах", "game_nickname": "nick"}
+
+
+def _fail_once(db: SQLiteDB) -> list:
+    """Первая транзакция падает, как при занятой базе; возвращает список попыток."""
+    attempts, transaction = [], db.transaction
+
+    async def flaky(statements):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        await transaction(statements)
+
+    db.transaction = flaky
+    return attempts
+
+
+def test_archive_retries_failed_background_flush():
+    async def scenario(db: SQLiteDB):
+        archive = Archive(db, flush_interval=0.02)
+        archive._writer.retry_interval = 0.05
+        await archive.setup()
+        attempts = _fail_once(db)
+        archive.add("sub1", 1, SPOT)
+        await asyncio.sleep(0.3)  # новых add нет: повтор ставит сам планировщик
+        rows = await db.fetchall("SELECT submission_id FROM spots")
+        return rows, len(attempts), archive._writer.failures
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SQLiteDB(os.path.join(tmp, "bot.db"))
+        try:
+            rows, attempts, failures = asyncio.run(scenario(db))
+        finally:
+            db.close()
+    assert (rows, attempts, failures) == ([("sub1",)], 2, 1)
+
+
+def test_fsm_storage_retries_failed_background_flush():
+    async def scenario(path: str):
+        storage = SQLiteStorage(path, flush_interval=0.02)
+        storage._writer.retry_interval = 0.05
+        await storage._ensure_schema()
+        attempts = _fail_once(storage.db)
+        key = StorageKey(bot_id=1, chat_id=2, user_id=2)
+        await storage.set_data(key, {"photos": ["p1"]})
+        await asyncio.sleep(0.3)
+        row = await storage.db.fetchone("SELECT data FROM fsm")
+        await storage.close()
+        return row, len(attempts)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        row, attempts = asyncio.run(scenario(os.path.join(tmp, "fsm.db")))
+    assert row == ('{"photos": ["p1"]}',)
+    assert attempts == 2
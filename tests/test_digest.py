@@ -0,0 +1,46 @@
+import asyncio
+import os
+import tempfile
+
+import main
+import render
+from db import SQLiteDB
+from fakes import make_bot
+from outbox import KIND_DIGEST, Outbox
+
+ADMIN = 900000001
+
+
+def _payload(number: int, warnings: int) -> dict:
+    # Предупреждения о повторных фото удлиняют service_info заявки
+    service_info = render.sender_info(100000 + number, f"User {number}", None) + "".join(
+        f"\n⚠️ Фото {i} похоже на присланное 01.01.2026 (ID: 123456789, отличие 3 бит)" for i in range(1, warnings + 1)
+    )
+    spot = {"waterbody_hashtag": "#озеро", "coordinates": "10:20", "tackle": "Спиннинг", "game_nickname": f"nick{number}"}
+    return {"photos": ["p1", "p2"], "post_text": "post", "service_info": service_info, "user_id": 1, "spot": spot}
+
+
+def test_digest_stays_within_message_limit(monkeypatch):
+    async def scenario():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = SQLiteDB(os.path.join(tmp, "bot.db"))
+            try:
+                outbox = Outbox(db)
+                await outbox.setup()
+                for number in range(10):
+                    await outbox.enqueue(f"sub{number}", _payload(number, warnings=10), [(ADMIN, KIND_DIGEST)])
+                monkeypatch.setattr(main, "outbox", outbox)
+                monkeypatch.setattr(main, "bot", make_bot())
+                while await main._send_digest(ADMIN):
+                    pass
+                return main.bot.session.calls, await outbox.stats()
+            finally:
+                db.close()
+
+    calls, stats = asyncio.run(scenario())
+    texts = [call.text for call in calls]
+    assert len(texts) > 1
+    assert all(render.visible_length(text) <= render.MESSAGE_LIMIT for text in texts)
+    # Все заявки разошлись по сводкам по одному разу, попытки на перенос не потрачены
+    assert sum(len(call.reply_markup.inline_keyboard) for call in calls) == 10
+    assert (stats["pending"], stats["processing"], stats["dead"]) == (0, 0, 0)
@@ -0,0 +1,15 @@
+import asyncio
+import os
+
+import loadtest
+
+
+def test_repeated_runs_are_not_deduplicated(tmp_path, monkeypatch):
+    # Тот же seed — те же заявки; дедупликация восстанавливается из базы при старте бота
+    monkeypatch.chdir(tmp_path)
+    args = loadtest.parse_args(["--users", "10", "--concurrency", "10", "--drain", "30"])
+    for _ in range(2):
+        report = asyncio.run(loadtest.run(args))
+        assert (report["completed"], report["failed"]) == (10, 0), report["errors"]
+        assert report["admin_pending"] == 0
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".db")]
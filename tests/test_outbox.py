@@ -0,0 +1,252 @@
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+from collections import Counter
+
+from aiohttp import web
+
+import main
+from db import SQLiteDB
+from fakes import make_bot
+from loadtest import BOT_TOKEN, SEND_METHODS, FakeBotAPI, free_port
+from middlewares import ApiCallCounter
+from outbox import KIND_ALBUM, KIND_COPY, LeaseLost, Outbox
+
+ADMINS = [900000001, 900000002, 900000003]
+SUBMISSIONS = 30
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+def _payload(sid: str) -> dict:
+    return {"photos": [f"{sid}-photo{i}" for i in range(3)], "post_text": f"post {sid}", "service_info": f"info {sid}", "user_id": 1}
+
+
+async def _enqueue(outbox: Outbox, count: int):
+    # Как в режиме релея: альбом грузится первому админу, остальным — копия
+    targets = [(ADMINS[0], KIND_ALBUM)] + [(chat_id, KIND_COPY) for chat_id in ADMINS[1:]]
+    for i in range(count):
+        await outbox.enqueue(f"sub{i}", _payload(f"sub{i}"), targets, source_chat_id=ADMINS[0])
+
+
+def _with_db(test):
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = SQLiteDB(os.path.join(tmp, "bot.db"))
+            try:
+                return await test(db)
+            finally:
+                db.close()
+    return asyncio.run(run())
+
+
+def test_lease_is_renewed_while_delivery_runs():
+    async def scenario(db: SQLiteDB):
+        holder, other = Outbox(db, lease=0.3), Outbox(db, lease=0.3)
+        await holder.setup()
+        await _enqueue(holder, 1)
+        delivered = []
+
+        async def slow_delivery(job):
+            await asyncio.sleep(1.2)  # дольше четырёх сроков аренды: очередь лимитов или 429
+            await holder.done(job)
+            delivered.append(job.chat_id)
+
+        holder.start(slow_delivery, concurrency=len(ADMINS))
+        stolen = []
+        for _ in range(12):
+            await asyncio.sleep(0.1)
+            job = await other.claim()
+            if job is not None:
+                stolen.append(job)
+        while len(delivered) < len(ADMINS):
+            await asyncio.sleep(0.05)
+        await holder.stop()
+        return stolen, delivered, await holder.stats()
+
+    stolen, delivered, stats = _with_db(scenario)
+    assert stolen == []
+    assert sorted(delivered) == ADMINS
+    assert stats["pending"] == stats["processing"] == 0
+
+
+def test_dedup_window_is_shared_between_processes():
+    async def scenario():
+        with tempfile.TemporaryDirectory() as tmp:
+            # Два соединения к одному файлу — как два воркера
+            first_db, second_db = SQLiteDB(os.path.join(tmp, "bot.db")), SQLiteDB(os.path.join(tmp, "bot.db"))
+            try:
+                first, second = Outbox(first_db), Outbox(second_db)
+                await first.setup()
+                await second.setup()
+                targets = [(ADMINS[0], KIND_ALBUM)]
+                results = [
+                    await first.enqueue("sub0", _payload("sub0"), targets, fingerprint="fp", dedup_window=60),
+                    await second.enqueue("sub1", _payload("sub1"), targets, fingerprint="fp", dedup_window=60),
+                    await second.enqueue("sub2", _payload("sub2"), targets, fingerprint="other", dedup_window=60),
+                ]
+                await asyncio.sleep(0.05)
+                results.append(await second.enqueue("sub3", _payload("sub3"), targets, fingerprint="fp", dedup_window=0.01))
+                return results, (await first.stats())["pending"]
+            finally:
+                first_db.close()
+                second_db.close()
+
+    results, pending = asyncio.run(scenario())
+    assert results == [True, False, True, True]  # после окна тот же пост снова принимается
+    assert pending == 3
+
+
+def test_expired_holder_cannot_record_progress():
+    async def scenario(db: SQLiteDB):
+        stale, fresh = Outbox(db, lease=0.1), Outbox(db, lease=60)
+        await stale.setup()
+        await stale.enqueue("sub0", _payload("sub0"), [(ADMINS[0], KIND_ALBUM)])
+        job = await stale.claim()
+        await asyncio.sleep(0.15)
+        taken = await fresh.claim()
+        assert (taken.submission_id, taken.chat_id) == (job.submission_id, job.chat_id)
+
+        for record in (lambda: stale.media_sent(job, [1, 2, 3]), lambda: stale.done(job)):
+            try:
+                await record()
+            except LeaseLost:
+                pass
+            else:
+                raise AssertionError("stale holder recorded progress")
+        await stale.retry(job, "late failure")  # ничего не меняет
+        await fresh.done(taken)
+        return await fresh.delivery_status(job.submission_id, job.chat_id)
+
+    assert _with_db(scenario) == "done"
+
+
+class KillingBotAPI(FakeBotAPI):
+    """Фейковый API, который на `kill_at`-й отправке убивает бота (SIGKILL) посреди рассылки.
+
+    Запросы, пришедшие после этого, не выполняются и не получают ответа: для
+    Telegram они не дошли. Каждая выполненная отправка записывается в `sends`.
+    """
+
+    def __init__(self, kill_at: int):
+        super().__init__()
+        self.kill_at = kill_at
+        self.process = None
+        self.killed = asyncio.Event()
+        self.sent = 0
+        self.sends: Counter = Counter()  # (чат, заявка, метод) -> сколько раз
+        self._albums = {}  # id сообщения альбома -> заявка (для copyMessages)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if request.match_info["method"] in SEND_METHODS:
+            if self.killed.is_set():
+                await asyncio.Event().wait()
+            self.sent += 1
+            if self.sent == self.kill_at:
+                # Уже выполненные отправки бот успел зафиксировать, остальные висят у нас
+                self.killed.set()
+                await asyncio.sleep(0.5)
+                self.process.send_signal(signal.SIGKILL)
+                await asyncio.Event().wait()
+        return await super().handle(request)
+
+    async def api_sendMediaGroup(self, params):
+        messages = await super().api_sendMediaGroup(params)
+        sid = messages[0]["caption"].split()[-1]
+        self._albums.update((m["message_id"], sid) for m in messages)
+        self.sends[(int(params["chat_id"]), sid, "album")] += 1
+        return messages
+
+    async def api_copyMessages(self, params):
+        sid = self._albums[params["message_ids"][0]]
+        self.sends[(int(params["chat_id"]), sid, "copy")] += 1
+        return await super().api_copyMessages(params)
+
+    async def api_sendMessage(self, params):
+        self.sends[(int(params["chat_id"]), params["text"].split()[-1], "info")] += 1
+        return await super().api_sendMessage(params)
+
+
+async def _start_bot(api_port: int, db_path: str):
+    env = dict(
+        os.environ, BOT_TOKEN=BOT_TOKEN, ADMIN_CHAT_IDS=",".join(map(str, ADMINS)), TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+        RUN_MODE="polling", WEBHOOK_BASE_URL="", PORT=str(free_port()), DB_PATH=db_path, OUTBOX_LEASE="1",
+        SEND_GLOBAL_RATE="1000", SEND_PER_CHAT_RATE="1000",
+    )
+    return await asyncio.create_subprocess_exec(sys.executable, MAIN, env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+
+
+def test_submission_api_cost_is_summed_over_all_chats(monkeypatch):
+    async def scenario(db: SQLiteDB):
+        outbox = Outbox(db)
+        await outbox.setup()
+        monkeypatch.setattr(main, "outbox", outbox)
+        bot = make_bot()
+        bot.session.middleware(ApiCallCounter())
+        monkeypatch.setattr(main, "bot", bot)
+        # Релей на двух админов: альбом + сообщение первому, копия + сообщение второму
+        await outbox.enqueue("cost1", _payload("cost1"), main._delivery_targets(), source_chat_id=main._relay_source())
+        outbox.start(main.deliver_job, concurrency=2)
+        try:
+            while (await outbox.stats())["pending"] + (await outbox.stats())["processing"]:
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.05)
+        finally:
+            await outbox.stop()
+        return main.bot.session.names()
+
+    histogram = main.SUBMISSION_API_CALLS
+    _, before_sum, before_count = histogram.values.get((), [None, 0.0, 0])
+    calls = _with_db(scenario)
+    _, after_sum, after_count = histogram.values[()]
+    assert sorted(calls) == ["copyMessages", "sendMediaGroup", "sendMessage", "sendMessage"]
+    assert (after_count - before_count, after_sum - before_sum) == (1, 4)
+
+
+def test_killed_process_resumes_without_loss_or_duplicates():
+    async def scenario(tmp: str):
+        db_path = os.path.join(tmp, "bot.db")
+        db = SQLiteDB(db_path)
+        outbox = Outbox(db)
+        await outbox.setup()
+        await _enqueue(outbox, SUBMISSIONS)
+
+        # Каждому админу: альбом или копия + сообщение с кнопками — 180 отправок; убиваем на 60-й
+        api = KillingBotAPI(kill_at=60)
+        runner = web.AppRunner(api.app(), handler_cancellation=True)
+        await runner.setup()
+        api_port = free_port()
+        await web.TCPSite(runner, "127.0.0.1", api_port).start()
+        try:
+            api.process = await _start_bot(api_port, db_path)
+            await asyncio.wait_for(api.killed.wait(), timeout=60)
+            assert await api.process.wait() == -signal.SIGKILL
+            sent_before_kill = sum(api.sends.values())
+            api.killed.clear()
+
+            api.process = await _start_bot(api_port, db_path)
+            for _ in range(600):
+                stats = await outbox.stats()
+                if not stats["pending"] and not stats["processing"] and not stats["dead"]:
+                    break
+                await asyncio.sleep(0.1)
+            api.process.terminate()
+            await api.process.wait()
+            return sent_before_kill, api.sends, await outbox.stats()
+        finally:
+            if api.process.returncode is None:
+                api.process.kill()
+            await runner.cleanup()
+            db.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sent_before_kill, sends, stats = asyncio.run(scenario(tmp))
+
+    assert 0 < sent_before_kill < SUBMISSIONS * len(ADMINS) * 2
+    assert stats["pending"] == stats["processing"] == stats["dead"] == 0
+    expected = {(ADMINS[0], f"sub{i}", "album") for i in range(SUBMISSIONS)}
+    expected |= {(chat_id, f"sub{i}", "copy") for chat_id in ADMINS[1:] for i in range(SUBMISSIONS)}
+    expected |= {(chat_id, f"sub{i}", "info") for chat_id in ADMINS for i in range(SUBMISSIONS)}
+    assert set(sends) == expected, "lost deliveries"
+    assert [key for key, count in sends.items() if count > 1] == [], "duplicated deliveries"
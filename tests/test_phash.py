@@ -0,0 +1,95 @@
+import asyncio
+import io
+import os
+import random
+
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image, ImageDraw, ImageEnhance
+
+from fakes import make_bot
+from phash import HammingIndex, PhotoHasher, dhash
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+DISTANCE = 5  # PHOTO_HASH_DISTANCE по умолчанию
+
+
+def _fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def _jpeg(image: Image.Image, quality: int = 85) -> bytes:
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _variants(data: bytes) -> dict:
+    """Как присылают тот же скриншот повторно: пересжатый, уменьшенный, осветлённый, с подписью, обрезанный."""
+    image = Image.open(io.BytesIO(data))
+    w, h = image.size
+    captioned = image.copy()
+    ImageDraw.Draw(captioned).text((10, h - 30), "75:42 Медное", fill=(255, 255, 255))
+    return {
+        "recompressed": _jpeg(image, quality=40),
+        "downscaled": _jpeg(image.resize((w // 2, h // 2))),
+        "brightened": _jpeg(ImageEnhance.Brightness(image).enhance(1.15)),
+        "captioned": _jpeg(captioned),
+        "cropped": _jpeg(image.crop((w // 100, h // 100, w - w // 100, h - h // 100)).resize((w, h))),
+    }
+
+
+def test_reused_photo_stays_within_distance():
+    original = dhash(_fixture("catch.jpg"))
+    for name, data in _variants(_fixture("catch.jpg")).items():
+        assert (dhash(data) ^ original).bit_count() <= DISTANCE, name
+
+
+def test_different_photos_are_far_apart():
+    hashes = [dhash(_fixture(name)) for name in ("catch.jpg", "other_catch.jpg", "third_catch.jpg")]
+    for i in range(len(hashes)):
+        for j in range(i + 1, len(hashes)):
+            assert (hashes[i] ^ hashes[j]).bit_count() > 3 * DISTANCE
+
+
+def test_hamming_index_matches_brute_force():
+    rng = random.Random(1)
+    values = [rng.getrandbits(64) for _ in range(20000)]
+    # Близкие к существующим хэши: от 0 до 7 перевёрнутых бит
+    queries = []
+    for _ in range(200):
+        value = rng.choice(values)
+        for bit in rng.sample(range(64), rng.randint(0, 7)):
+            value ^= 1 << bit
+        queries.append(value)
+    index = HammingIndex(max_distance=DISTANCE)
+    for position, value in enumerate(values):
+        index.add(value, position)
+    assert len(index) == len(values)
+    for query in queries:
+        expected = sorted(((value ^ query).bit_count(), position) for position, value in enumerate(values) if (value ^ query).bit_count() <= DISTANCE)
+        assert sorted(index.search(query)) == expected
+        assert sorted(index.search(query, max_distance=2)) == [pair for pair in expected if pair[0] <= 2]
+
+
+def test_photo_hasher_flags_reuploads_from_streamed_files():
+    files = {"original": _fixture("catch.jpg"), "other": _fixture("other_catch.jpg"), **_variants(_fixture("catch.jpg"))}
+
+    async def scenario():
+        hasher = PhotoHasher(make_bot(files), workers=1)
+        try:
+            hasher.schedule("original", "u-original")  # как в process_photos: хэш считается заранее
+            hashes = await hasher.hashes([(file_id, f"u-{file_id}") for file_id in files])
+        finally:
+            hasher.close()
+        return hashes
+
+    hashes = asyncio.run(scenario())
+    assert set(hashes) == {f"u-{file_id}" for file_id in files}
+    index = HammingIndex(max_distance=DISTANCE)
+    index.add(hashes["u-original"], "sub-1")
+    assert index.search(hashes["u-other"]) == []
+    for name in ("recompressed", "downscaled", "brightened", "captioned", "cropped"):
+        assert [item for _, item in index.search(hashes[f"u-{name}"])] == ["sub-1"], name
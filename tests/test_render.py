@@ -0,0 +1,55 @@
+import asyncio
+
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import main
+import render
+from fakes import USER_ID, make_bot, text_update
+
+# Ветка со всеми полями подписи: Матч (клипса и глубина) + Медное (температура)
+HEAD = ["/start", "оз.Медное", "75:42", "Матч"]
+
+
+async def _replies(texts: list) -> tuple:
+    """Отправляет тексты по порядку через main.dp; возвращает ответы бота и итоговые данные анкеты."""
+    bot = make_bot()
+    original, main.dp.fsm.storage = main.dp.fsm.storage, MemoryStorage()
+    try:
+        replies = []
+        for text in texts:
+            before = len(bot.session.calls)
+            await main.dp.feed_update(bot, text_update(text))
+            replies.append(" ".join(call.text or "" for call in bot.session.calls[before:] if hasattr(call, "text")))
+        state = main.dp.fsm.get_context(bot, chat_id=USER_ID, user_id=USER_ID)
+        return replies, await state.get_state(), await state.get_data()
+    finally:
+        main.dp.fsm.storage = original
+
+
+def test_long_field_is_rejected_at_its_own_step():
+    for position, field in enumerate(("Клипса", "Глубина", "Температура")):
+        inputs = HEAD + ["20", "3.5", "15"][:position] + ["9" * 1100]
+        replies, state, data = asyncio.run(_replies(inputs))
+        assert replies[-1].startswith(f"{field} не помещается в подпись"), replies[-1]
+        assert "9" * 1100 not in data.values()
+
+
+def test_nick_is_blamed_only_when_it_overflows():
+    fields = ["20", "3.5", "9" * 800, "Пропустить комментарий"]
+    replies, state, data = asyncio.run(_replies(HEAD + fields + ["abc"]))
+    assert state == main.PostCreation.waiting_for_photos.state, replies[-1]
+    assert render.visible_length(render.post_caption(data, "https://t.me/offer")) <= render.CAPTION_LIMIT
+
+    replies, state, _ = asyncio.run(_replies(HEAD + fields + ["n" * 200]))
+    assert replies[-1].startswith("Ник не помещается в подпись"), replies[-1]
+    assert state == main.PostCreation.waiting_for_game_nickname.state
+
+
+def test_long_comment_is_truncated_to_the_caption_limit():
+    data = {
+        "waterbody_hashtag": "#медное", "coordinates": "75:42", "tackle": "Матч", "clip": "20", "depth": "3.5",
+        "temperature": "15", "game_nickname": "Рыбак", "comment": "Клюёт 🐟 " * 300,
+    }
+    assert render.caption_overflow(data) > 0
+    for caption in (render.preview_caption(data), render.post_caption(data, "https://t.me/offer")):
+        assert render.visible_length(caption) <= render.CAPTION_LIMIT
@@ -0,0 +1,104 @@
+import asyncio
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from aiogram.fsm.storage.base import StorageKey
+
+from storage import ExpiringMemoryStorage, SessionTTL, SQLiteStorage
+
+WAVES = 5
+WAVE_SIZE = 20000  # 5 волн по 20k — 100k брошенных анкет
+ABANDONED_STATE = "PostCreation:waiting_for_photos"
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=123456, chat_id=user_id, user_id=user_id)
+
+
+async def _abandon(storage, first_user: int):
+    # Пользователь дошёл до фото, прислал 10 штук и ушёл
+    photos = [f"AgACAgIAAxkBAAI{first_user:08d}{i:02d}" for i in range(10)]
+    for user_id in range(first_user, first_user + WAVE_SIZE):
+        key = _key(user_id)
+        await storage.set_state(key, ABANDONED_STATE)
+        await storage.set_data(key, {"waterbody_name": "оз.Медное", "coordinates": "75:42", "photos": photos})
+
+
+def test_ttl_overrides_by_state_name():
+    ttl = SessionTTL.parse(3600, "waiting_for_photos=86400, PostCreation:confirm_post=600")
+    assert ttl(ABANDONED_STATE) == 86400
+    assert ttl("PostCreation:confirm_post") == 600
+    assert ttl("PostCreation:waiting_for_coordinates") == 3600
+    assert ttl(None) == 0.0
+
+
+def test_memory_storage_stays_flat_under_abandoned_sessions():
+    async def soak():
+        storage = ExpiringMemoryStorage(SessionTTL(0.001))
+        sizes = []
+        tracemalloc.start()
+        try:
+            for wave in range(WAVES):
+                await _abandon(storage, 100000 + wave * WAVE_SIZE)
+                await asyncio.sleep(0.01)
+                assert await storage.purge_expired() == WAVE_SIZE
+                gc.collect()
+                sizes.append(tracemalloc.get_traced_memory()[0])
+        finally:
+            tracemalloc.stop()
+        return storage, sizes
+
+    storage, sizes = asyncio.run(soak())
+    assert storage.evicted == WAVES * WAVE_SIZE
+    assert storage.live_sessions == 0
+    assert not storage._heap and not storage._queued and not storage._deadlines
+    # После каждой волны память та же, что после первой: сессии не копятся
+    assert max(sizes) - sizes[0] < 64 * 1024, sizes
+
+
+def test_memory_storage_reads_do_not_create_sessions():
+    async def reads():
+        storage = ExpiringMemoryStorage(SessionTTL(3600))
+        for user_id in range(1000):
+            await storage.get_state(_key(user_id))
+            await storage.get_data(_key(user_id))
+        return storage
+
+    assert asyncio.run(reads()).live_sessions == 0
+
+
+def test_memory_storage_extends_active_session():
+    async def scenario():
+        storage = ExpiringMemoryStorage(SessionTTL(0.05))
+        key = _key(1)
+        await storage.set_state(key, ABANDONED_STATE)
+        for _ in range(4):
+            await asyncio.sleep(0.02)
+            await storage.set_data(key, {"photos": ["a"]})
+            assert await storage.purge_expired() == 0
+        await asyncio.sleep(0.06)
+        return storage, await storage.get_state(key)
+
+    storage, state = asyncio.run(scenario())
+    assert state is None and storage.evicted == 1
+
+
+def test_sqlite_storage_purges_abandoned_sessions():
+    async def soak(path: str):
+        storage = SQLiteStorage(path, ttl=SessionTTL(0.5))
+        try:
+            for wave in range(WAVES):
+                await _abandon(storage, 100000 + wave * WAVE_SIZE)
+            await storage.flush()
+            await asyncio.sleep(0.6)
+            purged = await storage.purge_expired()
+            return purged, await storage.count_live_sessions(), storage.evicted
+        finally:
+            await storage.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        purged, live_after, evicted = asyncio.run(soak(os.path.join(tmp, "fsm.db")))
+    assert purged == evicted == WAVES * WAVE_SIZE
+    assert live_after == 0
@@ -0,0 +1,44 @@
+import asyncio
+
+from aiogram import types
+
+import main
+from fakes import USER_ID, make_bot, message_update, text_update
+
+MAX_ID = 2 ** 63 - 1  # id точки в SQLite — INTEGER, не больше int64
+
+
+def test_every_filter_fits_callback_data():
+    for water in range(len(main.WATERBODY_SLUGS)):
+        for tackle in (None, *range(len(main.TACKLES))):
+            for cursor in ({"before": MAX_ID}, {"after": MAX_ID}):
+                page = main.SpotsPage(water=water, tackle=tackle, **cursor)
+                packed = page.pack()
+                assert len(packed.encode()) <= 64
+                assert main.SpotsPage.unpack(packed) == page
+
+
+def test_spots_pages_for_long_names():
+    async def scenario():
+        await main.archive.setup()
+        spot = {
+            "waterbody_name": "Норвежское море", "waterbody_hashtag": main.waterbody_hashtag("норвежское_море"),
+            "coordinates": "10:20", "tackle": "Морская ловля", "game_nickname": "Рыбак",
+        }
+        await main.archive.add_many([(f"spots-test:{i}", 1.7e9 + i, USER_ID, spot) for i in range(main.SPOTS_PAGE_SIZE + 2)])
+        bot = make_bot()
+        await main.dp.feed_update(bot, text_update("/spots Норвежское море Морская ловля"))
+        first = bot.session.calls[-1]
+        [[older]] = first.reply_markup.inline_keyboard
+        query = types.CallbackQuery(
+            id="1", from_user=types.User(id=USER_ID, is_bot=False, first_name="User"), chat_instance="1",
+            message=message_update(USER_ID, text=first.text).message, data=older.callback_data,
+        )
+        await main.dp.feed_update(bot, types.Update(update_id=10 ** 6, callback_query=query))
+        return first, older, bot.session.calls[-2]
+
+    first, older, edited = asyncio.run(scenario())
+    assert older.text == "Старше ▶"
+    assert first.text.count("Морская ловля") == main.SPOTS_PAGE_SIZE
+    assert edited.text.count("Морская ловля") == 2
+    assert [button.text for button in edited.reply_markup.inline_keyboard[0]] == ["◀ Новее"]
@@ -0,0 +1,122 @@
+import asyncio
+from collections import Counter
+
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import main
+from fakes import USER_ID, make_bot, photo_update, text_update
+
+# Самая длинная ветка анкеты: Матч (клипса и глубина) + Медное (температура) + комментарий
+FLOW = [
+    ("start", text_update, "/start"),
+    ("waterbody", text_update, "оз.Медное"),
+    ("coordinates", text_update, "75:42"),
+    ("tackle", text_update, "Матч"),
+    ("clip", text_update, "20"),
+    ("depth", text_update, "3.5"),
+    ("temperature", text_update, "15"),
+    ("comment_choice", text_update, "Добавить комментарий"),
+    ("comment", text_update, "Клюёт на опарыша"),
+    ("nickname", text_update, "Рыбак"),
+    ("photos", photo_update, 0),
+    ("done", text_update, "Готово"),
+]
+
+
+class CountingStorage(MemoryStorage):
+    """MemoryStorage, который считает обращения (каждое — сетевой запрос у Redis/SQLite)."""
+
+    def __init__(self):
+        super().__init__()
+        self.ops: Counter = Counter()
+
+    async def get_state(self, key):
+        self.ops["get_state"] += 1
+        return await super().get_state(key)
+
+    async def set_state(self, key, state=None):
+        self.ops["set_state"] += 1
+        await super().set_state(key, state)
+
+    async def get_data(self, key):
+        self.ops["get_data"] += 1
+        return await super().get_data(key)
+
+    async def set_data(self, key, data):
+        self.ops["set_data"] += 1
+        await super().set_data(key, data)
+
+    async def get_value(self, storage_key, dict_key, default=None):
+        self.ops["get_value"] += 1
+        return await super().get_value(storage_key, dict_key, default)
+
+
+async def _run_flow() -> dict:
+    """Проходит анкету через main.dp; возвращает операции хранилища по шагам."""
+    storage, bot = CountingStorage(), make_bot()
+    original, main.dp.fsm.storage = main.dp.fsm.storage, storage
+    per_step = {}
+    try:
+        for step, make_update, payload in FLOW:
+            storage.ops.clear()
+            await main.dp.feed_update(bot, make_update(payload))
+            per_step[step] = Counter(storage.ops)
+    finally:
+        main.dp.fsm.storage = original
+    assert bot.session.names()[-2:] == ["sendMediaGroup", "sendMessage"], "анкета должна дойти до предпросмотра"
+    return per_step
+
+
+def _without_cache(coro_fn):
+    main.dp.message.middleware.unregister(main.state_cache)
+    try:
+        return asyncio.run(coro_fn())
+    finally:
+        main.dp.message.middleware(main.state_cache)
+
+
+def _report(title: str, per_step: dict):
+    total = sum(sum(ops.values()) for ops in per_step.values())
+    print(f"\n{title}: {total} ops, {total / len(per_step):.2f} per update")
+    for step, ops in per_step.items():
+        print(f"  {step:<15} {sum(ops.values())}  {dict(ops)}")
+    return total
+
+
+def test_storage_ops_per_update():
+    raw = _without_cache(_run_flow)
+    cached = asyncio.run(_run_flow())
+    raw_total = _report("without StateCacheMiddleware", raw)
+    cached_total = _report("with StateCacheMiddleware", cached)
+
+    assert cached_total < raw_total
+    for step, ops in cached.items():
+        # Состояние читает FSM-мидлварь для фильтров; дальше — не больше одного чтения данных и одной записи каждого
+        assert ops["get_state"] == 1, step
+        assert ops["get_data"] <= 1 and ops["get_value"] == 0, step
+        assert ops["set_state"] <= 1 and ops["set_data"] <= 1, step
+        assert sum(ops.values()) <= sum(raw[step].values()), step
+    # process_clip: update_data, get_data и ещё get_data в _check_temp_or_comment
+    assert sum(raw["clip"].values()) > sum(cached["clip"].values())
+
+
+async def _single_photos(count: int) -> list:
+    """Фото по одному, с интервалом меньше задержки API: апдейты одного пользователя идут параллельно."""
+    bot = make_bot(latency=0.05)
+    original, main.dp.fsm.storage = main.dp.fsm.storage, MemoryStorage()
+    try:
+        state = main.dp.fsm.get_context(bot, chat_id=USER_ID, user_id=USER_ID)
+        await state.set_state(main.PostCreation.waiting_for_photos)
+        tasks = []
+        for i in range(count):
+            tasks.append(asyncio.create_task(main.dp.feed_update(bot, photo_update(i))))
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        return (await state.get_data())["photos"]
+    finally:
+        main.dp.fsm.storage = original
+
+
+def test_concurrent_single_photos_are_not_lost():
+    assert asyncio.run(_single_photos(3)) == [f"photo{USER_ID}_{i}" for i in range(3)]
+    assert len(_without_cache(lambda: _single_photos(3))) == 3
@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+from db import SQLiteDB
+from stats import SubmissionStats
+
+
+def test_failed_snapshot_is_retried():
+    async def scenario(db: SQLiteDB):
+        stats = SubmissionStats(db)
+        await stats.setup()
+        stats.add(1, "Озеро", "Спиннинг", "nick", "Nick", 1.7e9)
+        run = db.run
+
+        async def failing_run(fn, *args):
+            raise sqlite3.OperationalError("database is locked")
+
+        db.run = failing_run
+        with pytest.raises(sqlite3.OperationalError):
+            await stats.save()
+        db.run = run
+        await stats.save()
+        restored = SubmissionStats(db)
+        assert await restored.load()
+        return restored
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SQLiteDB(os.path.join(tmp, "bot.db"))
+        try:
+            restored = asyncio.run(scenario(db))
+        finally:
+            db.close()
+    assert (restored.total, restored.last_id, restored.nicknames.top()) == (1, 1, [("Nick", 1)])
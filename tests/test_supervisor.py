@@ -0,0 +1,231 @@
+import asyncio
+import itertools
+import os
+import signal
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+from aiohttp import ClientSession, web
+
+from loadtest import BOT_TOKEN, FakeBotAPI, free_port
+from supervisor import Supervisor, UserOrder, merge_metrics, shard
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+REPLY_TIMEOUT = 30
+
+
+class KillingBotAPI(FakeBotAPI):
+    """Bot API, на ответе пользователю из `kills` убивающий воркер, который этот ответ отправляет."""
+
+    def __init__(self, kills: Dict[int, int], **kwargs):
+        super().__init__(**kwargs)
+        self.kills = dict(kills)  # chat_id -> сколько раз убить
+        self.supervisor: Supervisor = None
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        if self.kills.get(chat_id):
+            self.kills[chat_id] -= 1
+            workers = self.supervisor.workers
+            workers[shard(chat_id, len(workers))].process.kill()
+            return self._message(chat_id, text=params.get("text"))  # пользователь ответа не получил
+        return await super().api_sendMessage(params)
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _update(user_id: int, **message) -> dict:
+    message.update({
+        "message_id": next(_message_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+    })
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def _photo(user_id: int, number: int, group: str) -> dict:
+    photo = [{"file_id": f"photo{user_id}_{number}", "file_unique_id": f"u{user_id}_{number}", "width": 1280, "height": 720}]
+    return _update(user_id, photo=photo, media_group_id=group)
+
+
+@asynccontextmanager
+async def _running(api: FakeBotAPI, processes: int):
+    """Фейковый Bot API и супервизор с воркерами main.py; отдаёт функцию отправки апдейта в webhook."""
+    api_runner = web.AppRunner(api.app())
+    await api_runner.setup()
+    api_port = free_port()
+    await web.TCPSite(api_runner, "127.0.0.1", api_port).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ, BOT_TOKEN=BOT_TOKEN, TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}", RUN_MODE="worker",
+            WORKER_PROCESSES=str(processes), DB_PATH=os.path.join(tmp, "bot.db"), WORKER_DRAIN_TIMEOUT="10",
+        )
+        supervisor = Supervisor(processes, [sys.executable, MAIN], env, drain_timeout=10)
+        if isinstance(api, KillingBotAPI):
+            api.supervisor = supervisor
+        runner = web.AppRunner(supervisor.web_app("/webhook", None))
+        await runner.setup()  # запускает воркеры и ставит обработчик SIGHUP
+        port = free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        try:
+            async with ClientSession() as http:
+                async def send(update: dict):
+                    async with http.post(f"http://127.0.0.1:{port}/webhook", json=update) as resp:
+                        assert resp.status == 200
+
+                yield supervisor, send
+        finally:
+            await runner.cleanup()
+            await api_runner.cleanup()
+
+
+async def _replies(api: FakeBotAPI, chat_id: int, count: int) -> List[str]:
+    queue = api.replies(chat_id)
+    texts = []
+    while len(texts) < count:
+        message = await asyncio.wait_for(queue.get(), REPLY_TIMEOUT)
+        texts.append(message.get("text") or message.get("caption") or "")
+    return texts
+
+
+# --- UserOrder ---
+def test_user_order_runs_user_updates_in_turn_and_album_together():
+    async def scenario():
+        order = UserOrder()
+        events = []
+
+        async def run(update):
+            events.append(("start", update["update_id"]))
+            await asyncio.sleep(0.05 if update["update_id"] == 1 else 0.01)
+            events.append(("end", update["update_id"]))
+
+        updates = [
+            {"update_id": 1, "message": {"from": {"id": 7}, "text": "Спиннинг"}},
+            {"update_id": 2, "message": {"from": {"id": 7}, "media_group_id": "g", "photo": []}},
+            {"update_id": 3, "message": {"from": {"id": 7}, "media_group_id": "g", "photo": []}},
+            {"update_id": 4, "message": {"from": {"id": 7}, "text": "Готово"}},
+            {"update_id": 5, "message": {"from": {"id": 8}, "text": "/start"}},
+        ]
+        await asyncio.gather(*(order.submit(update, run) for update in updates))
+        await asyncio.sleep(0)
+        return events, order
+
+    events, order = asyncio.run(scenario())
+    at = {event: i for i, event in enumerate(events)}
+    assert at["end", 1] < at["start", 2] and at["end", 1] < at["start", 3]
+    # Фото альбома идут вместе: AlbumMiddleware соберёт их в один вызов
+    assert max(at["start", 2], at["start", 3]) < min(at["end", 2], at["end", 3])
+    assert max(at["end", 2], at["end", 3]) < at["start", 4]
+    # Другой пользователь не ждёт чужих апдейтов
+    assert at["start", 5] < at["end", 1]
+    assert not order._tails and not order._albums
+
+
+def test_whole_post_sent_without_pauses_keeps_order_in_workers():
+    # Все шаги сценария подряд, не дожидаясь ответов: без порядка FSM ушла бы не туда, альбом разбился бы
+    steps = ["/start", "оз.Комариное", "10:20", "Спиннинг", "Пропустить клипсу", "Пропустить комментарий", "nick1"]
+    expected = [
+        "Выберите водоем", "Введите координаты", "Выберите снасть", "Укажите клипсу", "Добавить комментарий",
+        "игровой ник", "Прикрепите фото", "Фото добавлено (3/10)", "", "", "", "Все верно?", "Отправлено на модерацию",
+    ]
+    users = [100000, 100001]  # по одному на воркер
+
+    async def scenario():
+        api = FakeBotAPI(latency=0.01)
+        async with _running(api, processes=2) as (supervisor, send):
+            for user_id in users:
+                updates = [_update(user_id, text=text) for text in steps]
+                updates += [_photo(user_id, number, f"album{user_id}") for number in range(3)]
+                updates += [_update(user_id, text="Готово"), _update(user_id, text="Отправить пост")]
+                for update in updates:
+                    await send(update)
+            replies = await asyncio.gather(*(_replies(api, user_id, len(expected)) for user_id in users))
+        return replies, [worker.handled for worker in supervisor.workers]  # после остановки: все подтверждения дочитаны
+
+    replies, handled = asyncio.run(scenario())
+    for texts in replies:
+        assert all(part in text for part, text in zip(expected, texts)), texts
+    assert handled == [12, 12]
+
+
+# --- Падение воркера ---
+def test_unacked_update_is_replayed_after_worker_crash():
+    user_id = 100000
+
+    async def scenario():
+        api = KillingBotAPI(kills={user_id: 1})
+        async with _running(api, processes=1) as (supervisor, send):
+            await send(_update(user_id, text="/start"))
+            texts = await _replies(api, user_id, 1)
+            worker = supervisor.workers[0]
+            return texts, worker.restarts, worker.replayed, worker.lost
+
+    texts, restarts, replayed, lost = asyncio.run(scenario())
+    assert "Выберите водоем" in texts[0]
+    assert (restarts, replayed, lost) == (1, 1, 0)
+
+
+def test_update_crashing_worker_twice_is_dropped():
+    poison, other = 100000, 100001
+
+    async def scenario():
+        api = KillingBotAPI(kills={poison: 2})
+        async with _running(api, processes=1) as (supervisor, send):
+            worker = supervisor.workers[0]
+            await send(_update(poison, text="/start"))
+            while worker.restarts < 2 or worker.process is None:
+                await asyncio.sleep(0.1)
+            # Второй раз апдейт не повторяется: воркер не падает по кругу и обслуживает остальных
+            await send(_update(other, text="/start"))
+            texts = await _replies(api, other, 1)
+            return texts, api.delivered[poison], worker.restarts, worker.replayed, worker.lost
+
+    texts, poison_delivered, restarts, replayed, lost = asyncio.run(scenario())
+    assert "Выберите водоем" in texts[0]
+    assert poison_delivered == 0
+    assert (restarts, replayed, lost) == (2, 1, 1)
+
+
+# --- SIGHUP ---
+def test_sighup_restarts_workers_without_losing_updates():
+    users = range(100000, 100040)
+
+    async def scenario():
+        api = FakeBotAPI(latency=0.2)  # апдейты ещё в работе, когда приходит SIGHUP
+        async with _running(api, processes=2) as (supervisor, send):
+            old_pids = {worker.process.pid for worker in supervisor.workers}
+            for user_id in users[:20]:
+                await send(_update(user_id, text="/start"))
+            os.kill(os.getpid(), signal.SIGHUP)
+            for user_id in users[20:]:
+                await send(_update(user_id, text="/start"))  # ждут в backlog перезапускаемого воркера
+            replies = await asyncio.gather(*(_replies(api, user_id, 1) for user_id in users))
+            while not all(worker.process and worker.process.pid not in old_pids for worker in supervisor.workers):
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.5)  # повторный ответ успел бы прийти
+        return replies, dict(api.delivered), supervisor.workers
+
+    replies, delivered, workers = asyncio.run(scenario())
+    assert all("Выберите водоем" in texts[0] for texts in replies)
+    assert all(delivered[user_id] == 1 for user_id in users)
+    assert [(w.restarts, w.replayed, w.lost) for w in workers] == [(0, 0, 0), (0, 0, 0)]
+    assert sum(w.handled for w in workers) == len(users)
+
+
+# --- /metrics ---
+def test_merge_metrics_labels_workers_and_keeps_families_together():
+    worker = (
+        "# HELP bot_updates_total Updates\n# TYPE bot_updates_total counter\nbot_updates_total {n}\n"
+        '# HELP bot_lag Lag\n# TYPE bot_lag gauge\nbot_lag{{kind="loop"}} {n}\n'
+    )
+    merged = merge_metrics([(0, worker.format(n=1)), (1, worker.format(n=2))])
+    assert merged == (
+        "# HELP bot_updates_total Updates\n# TYPE bot_updates_total counter\n"
+        'bot_updates_total{worker="0"} 1\nbot_updates_total{worker="1"} 2\n'
+        "# HELP bot_lag Lag\n# TYPE bot_lag gauge\n"
+        'bot_lag{worker="0",kind="loop"} 1\nbot_lag{worker="1",kind="loop"} 2\n'
+    )
@@ -0,0 +1,134 @@
+import asyncio
+
+from aiogram import F, types
+from aiogram.filters import Command
+
+import main
+from fakes import USER_ID, make_bot, message_update, photo_update, text_update
+from middlewares import AlbumMiddleware, ConcurrencyLimitMiddleware, ThrottlingMiddleware
+
+BUSY_USER = USER_ID + 1
+
+
+async def _feed(make_dispatcher, updates, max_concurrent: int = 50, concurrent: bool = False):
+    throttling = ThrottlingMiddleware(rate=1, burst=5, exempt=main.throttle_exempt)
+    limit = ConcurrencyLimitMiddleware(max_concurrent=max_concurrent, classify=main.update_priority)
+    # Тот же порядок, что в main.py: антифлуд снаружи, лимит хендлеров после буфера альбомов
+    dp, bot = make_dispatcher(outer=[throttling], inner=[AlbumMiddleware(latency=0.05), limit]), make_bot()
+    state = dp.fsm.get_context(bot, chat_id=USER_ID, user_id=USER_ID)
+    await state.set_state(main.PostCreation.waiting_for_photos)
+    if concurrent:
+        await asyncio.gather(*(dp.feed_update(bot, update) for update in updates))
+    else:
+        for update in updates:
+            await dp.feed_update(bot, update)
+    return bot.session.names(), await state.get_data(), throttling, limit
+
+
+def test_single_photos_are_not_throttled(make_dispatcher):
+    updates = [photo_update(i) for i in range(10)] + [text_update("ещё") for _ in range(6)]
+    calls, data, throttling, _ = asyncio.run(_feed(make_dispatcher, updates))
+    assert len(data["photos"]) == 10
+    # Фото ведро не тратят: из шести текстов отброшен только шестой (и отправлено одно предупреждение)
+    assert throttling.throttled == 1
+    assert calls == ["sendMessage"] * 11
+
+
+def test_album_is_buffered_before_concurrency_cap(make_dispatcher):
+    updates = [photo_update(i, media_group_id="album1") for i in range(10)]
+    calls, data, _, limit = asyncio.run(_feed(make_dispatcher, updates, max_concurrent=1, concurrent=True))
+    assert calls == ["sendMessage"]
+    assert data["photos"] == [f"photo{USER_ID}_{i}" for i in range(10)]
+    assert (limit.active, limit.waiting, limit.shed) == (0, 0, 0)
+
+
+class _Overload:
+    """Диспетчер с лимитом в один хендлер; `hold()` занимает слот, пока не вызван `release()`."""
+
+    def __init__(self, make_dispatcher):
+        self.handled = []
+        self.limit = ConcurrencyLimitMiddleware(max_concurrent=1, classify=main.update_priority)
+        self._released = asyncio.Event()
+        self.dp = make_dispatcher(inner=[self.limit], callback_inner=[self.limit], handlers=self._register)
+        self.bot = make_bot()
+
+    def _register(self, router):
+        async def busy(message: types.Message):
+            await self._released.wait()
+
+        async def record(event: types.TelegramObject):
+            user = event.from_user
+            text = event.data if isinstance(event, types.CallbackQuery) else event.text
+            self.handled.append((user.id, text))
+
+        router.message.register(busy, F.text == "busy")
+        router.message.register(record, Command("start"))
+        router.message.register(record, F.text)
+        router.callback_query.register(record)
+
+    async def set_state(self, user_id: int, state):
+        await self.dp.fsm.get_context(self.bot, chat_id=user_id, user_id=user_id).set_state(state)
+
+    async def hold(self) -> asyncio.Task:
+        task = asyncio.create_task(self.dp.feed_update(self.bot, text_update("busy", BUSY_USER)))
+        while not self.limit.active:
+            await asyncio.sleep(0)
+        return task
+
+    def feed(self, update: types.Update) -> asyncio.Task:
+        return asyncio.create_task(self.dp.feed_update(self.bot, update))
+
+    async def release(self, busy: asyncio.Task, tasks):
+        # Даём апдейтам дойти до лимита, потом освобождаем слот
+        await asyncio.sleep(0.05)
+        self._released.set()
+        await asyncio.gather(busy, *tasks)
+
+
+def _callback(user_id: int, data: str) -> types.Update:
+    query = types.CallbackQuery(
+        id=str(user_id), chat_instance="1", data=data, message=message_update(user_id, text="Все верно?").message,
+        from_user=types.User(id=user_id, is_bot=False, first_name=f"User{user_id}"),
+    )
+    return types.Update(update_id=user_id, callback_query=query)
+
+
+def test_low_priority_updates_are_shed_under_overload(make_dispatcher):
+    async def scenario():
+        overload = _Overload(make_dispatcher)
+        repeat_start, stray, choice = USER_ID + 10, USER_ID + 11, USER_ID + 12
+        await overload.set_state(repeat_start, main.PostCreation.waiting_for_waterbody_selection)
+        await overload.set_state(stray, main.PostCreation.waiting_for_tackle_choice)
+        await overload.set_state(choice, main.PostCreation.waiting_for_tackle_choice)
+        busy = await overload.hold()
+        tasks = [
+            overload.feed(text_update("/start", repeat_start)),  # анкета только что начата
+            overload.feed(text_update("привет", stray)),          # не кнопка там, где ждём кнопку
+            overload.feed(text_update("Мах", choice)),            # кнопка — ждёт слот
+        ]
+        await overload.release(busy, tasks)
+        # Без перегрузки те же апдейты обрабатываются
+        await overload.dp.feed_update(overload.bot, text_update("привет", stray))
+        return overload
+
+    overload = asyncio.run(scenario())
+    assert overload.limit.shed == 2
+    assert overload.handled == [(USER_ID + 12, "Мах"), (USER_ID + 11, "привет")]
+
+
+def test_finishing_updates_overtake_queued_ones(make_dispatcher):
+    async def scenario():
+        overload = _Overload(make_dispatcher)
+        starting, confirming, sending = USER_ID + 20, USER_ID + 21, USER_ID + 22
+        await overload.set_state(confirming, main.PostCreation.confirm_post)
+        await overload.set_state(sending, main.PostCreation.confirm_post)
+        busy = await overload.hold()
+        tasks = [overload.feed(text_update("/start", starting))]
+        await asyncio.sleep(0.01)
+        tasks += [overload.feed(_callback(confirming, "confirm")), overload.feed(text_update("Отправить пост", sending))]
+        await overload.release(busy, tasks)
+        return overload.handled
+
+    handled = asyncio.run(scenario())
+    # /start пришёл первым, но завершение поста (кнопка или сообщение) обрабатывается раньше
+    assert handled == [(USER_ID + 21, "confirm"), (USER_ID + 22, "Отправить пост"), (USER_ID + 20, "/start")]